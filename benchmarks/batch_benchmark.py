@@ -0,0 +1,140 @@
+"""Serial /search calls vs one /search/batch over the same catalogue.
+
+Upstreams are replaced with in-process fakes that sleep for a fixed
+latency, so this measures the app's own scheduling and sharing: images are
+drawn from a smaller set of products (same product query) with some exact
+repeats. Redis is used if REDIS_HOST points at one, otherwise the caches
+fail soft and only in-process sharing applies.
+
+    python -m benchmarks.batch_benchmark --items 200 --products 40 --repeats 0.1
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+import main
+from services.image_service import Gallery
+
+CALLS: Counter = Counter()
+
+
+def install_fakes(latency: float, product_of: dict[str, str]):
+    async def upstream(name: str, value):
+        CALLS[name] += 1
+        await asyncio.sleep(latency)
+        return value
+
+    async def product_query(image_url):
+        return await upstream("gpt_query", json.dumps(
+            {"query": f"Product {product_of.get(image_url, '0')}"}))
+
+    async def amazon_search(query):
+        return await upstream("amazon", json.dumps({"results": [{"content": {"results": {
+            "results": {"organic": [{"pos": 1, "url_image": "https://example.com/a.jpg",
+                                     "title": query, "url": "/dp/1", "price": 9.99}],
+                        "amazons_choices": []}}}}]}))
+
+    async def google_search(query):
+        return await upstream("google", {"organic_results": [
+            {"position": 1, "thumbnail": "https://example.com/g.jpg", "title": query, "link": "l"}]})
+
+    async def google_image_search(image_url):
+        return await upstream("google_images", {"image_results": [
+            {"position": 1, "thumbnail": "https://example.com/gi.jpg", "title": "t", "link": "l"}]})
+
+    async def google_lens_search(image_url):
+        return await upstream("lens", {"visual_matches": [
+            {"position": 1, "thumbnail": "https://example.com/l.jpg", "title": "t", "link": "l"}]})
+
+    async def build_gallery(engine, results, image_url, inline=None, prerank=True, publish=True):
+        return await upstream("gallery", Gallery(engine, url=f"https://example.com/{engine}.png"))
+
+    async def query_phash(image_url, contents=None):
+        return None
+
+    async def get_matching_images(galleries):
+        return await upstream("gpt_match", json.dumps({engine: 1 for engine in galleries}))
+
+    main.image_service.get_product_query = product_query
+    main.image_service.build_gallery = build_gallery
+    main.image_service.query_phash = query_phash
+    main.search_service.amazon_search = amazon_search
+    main.search_service.google_search = google_search
+    main.search_service.google_image_search = google_image_search
+    main.search_service.google_lens_search = google_lens_search
+    main.matching_service.get_matching_images = get_matching_images
+
+
+def make_catalogue(items: int, products: int, repeats: float,
+                   seed: int) -> tuple[list[str], dict[str, str]]:
+    rng = random.Random(seed)
+    run = uuid.uuid4().hex[:8]
+    urls: list[str] = []
+    product_of: dict[str, str] = {}
+    for i in range(items):
+        if urls and rng.random() < repeats:
+            urls.append(rng.choice(urls))
+            continue
+        url = f"https://catalogue.example.com/{run}/{i}.jpg"
+        product_of[url] = f"{run}-{rng.randrange(products)}"
+        urls.append(url)
+    return urls, product_of
+
+
+async def run_serial(client: httpx.AsyncClient, urls: list[str]) -> int:
+    ok = 0
+    for url in urls:
+        response = await client.post('/search', params={'image_url': url})
+        ok += response.status_code == 200
+    return ok
+
+
+async def run_batch(client: httpx.AsyncClient, urls: list[str]) -> int:
+    ok = 0
+    async with client.stream('POST', '/search/batch', data={'image_urls': urls}) as response:
+        async for line in response.aiter_lines():
+            event = json.loads(line)
+            if event["event"] == "item":
+                ok += event["status"] == 200
+    return ok
+
+
+async def main_async():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--products', type=int, default=40,
+                        help="Distinct product queries the images map to")
+    parser.add_argument('--repeats', type=float, default=0.1,
+                        help="Fraction of items that repeat an earlier URL")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Simulated latency of every upstream call in seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"batch concurrency {main.BATCH_CONCURRENCY}, upstream latency {args.latency}s")
+    print(f"{'mode':<8} {'items':>6} {'ok':>5} {'wall s':>8} {'items/s':>8}  upstream calls")
+    async with main.lifespan(main.app):
+        install_fakes(args.latency, {})
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench',
+                                     timeout=None) as client:
+            for mode, runner in (('serial', run_serial), ('batch', run_batch)):
+                # Fresh URLs per mode so neither benefits from the other's cache
+                urls, product_of = make_catalogue(args.items, args.products, args.repeats, args.seed)
+                install_fakes(args.latency, product_of)
+                CALLS.clear()
+                start = time.perf_counter()
+                ok = await runner(client, urls)
+                wall = time.perf_counter() - start
+                print(f"{mode:<8} {len(urls):>6} {ok:>5} {wall:>8.2f} {len(urls) / wall:>8.1f}  "
+                      f"{dict(sorted(CALLS.items()))}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main_async())
@@ -0,0 +1,201 @@
+"""Local stand-ins for every service the pipeline calls.
+
+One aiohttp app serves:
+
+    GET  /search                                     SerpAPI (google, google_reverse_image, google_lens)
+    POST /v2/scrape                                  smartproxy Amazon scraper
+    POST /1/upload                                   imgbb
+    POST /openai/deployments/{name}/chat/completions Azure OpenAI
+    GET  /img/{name}                                 thumbnail / query image hosts
+
+Responses follow the shape of recorded responses from the real services,
+with the result count, padding and image size configurable. Every endpoint
+waits `latency` (+/- `jitter`) seconds and fails with a 500 at `error_rate`.
+Run it on its own with
+
+    python -m benchmarks.fake_upstreams --port 8791 --latency 0.2
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+from aiohttp import web
+
+
+@dataclass
+class FakeConfig:
+    latency: float = 0.2
+    jitter: float = 0.05
+    error_rate: float = 0.0
+    results: int = 20
+    # Extra characters per result, to model verbose real payloads
+    padding: int = 200
+    image_size: int = 400
+    products: int = 50
+    seed: int = 0
+
+
+def stable_hash(text: str) -> int:
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+
+
+def make_images(config: FakeConfig, count: int = 64) -> list[bytes]:
+    """Smooth colour fields encode like product photos; noise would not."""
+    rng = np.random.default_rng(config.seed)
+    images = []
+    for _ in range(count):
+        base = rng.integers(0, 255, size=(6, 6, 3), dtype=np.uint8)
+        image = cv2.resize(base, (config.image_size, config.image_size * 3 // 4),
+                           interpolation=cv2.INTER_CUBIC)
+        images.append(cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes())
+    return images
+
+
+def thumbnails(base_url: str, key: str, count: int) -> list[str]:
+    # Keyed by the query, so one product's thumbnails recur across searches
+    prefix = stable_hash(key)
+    return [f"{base_url}/img/{prefix}-{i}.jpg" for i in range(1, count + 1)]
+
+
+def serpapi_page(config: FakeConfig, base_url: str, params) -> dict:
+    engine = params.get('engine')
+    key = params.get('q') or params.get('image_url') or params.get('url') or ''
+    pad = "x" * config.padding
+    urls = thumbnails(base_url, f"{engine}:{key}", config.results)
+    metadata = {"search_metadata": {"status": "Success", "engine": engine},
+                "search_parameters": dict(params)}
+    if engine == 'google':
+        return {**metadata, "organic_results": [
+            {"position": i, "title": f"Result {i} for {key}", "link": f"https://shop.example.com/{i}",
+             "snippet": pad, "thumbnail": url} for i, url in enumerate(urls, 1)]}
+    if engine == 'google_reverse_image':
+        return {**metadata, "image_results": [
+            {"position": i, "title": f"Image result {i}", "link": f"https://img.example.com/{i}",
+             "snippet": pad, "thumbnail": url} for i, url in enumerate(urls, 1)]}
+    if engine == 'google_lens':
+        return {**metadata, "visual_matches": [
+            {"position": i, "title": f"Visual match {i}", "link": f"https://lens.example.com/{i}",
+             "source": "example.com", "thumbnail": url, "extra": pad}
+            for i, url in enumerate(urls, 1)]}
+    return {"error": f"Unsupported engine: {engine}"}
+
+
+def amazon_page(config: FakeConfig, base_url: str, query: str) -> dict:
+    urls = thumbnails(base_url, f"amz:{query}", config.results)
+    organic = [{"pos": i, "url": f"/dp/B{i:09d}", "asin": f"B{i:09d}", "title": f"{query} {i}",
+                "price": round(9.99 + i, 2), "currency": "USD", "rating": 4.5,
+                "url_image": url, "description": "x" * config.padding}
+               for i, url in enumerate(urls, 1)]
+    # The scraper nests the parsed page three levels deep
+    return {"results": [{"content": {"results": {"results": {
+        "organic": organic[:-2], "amazons_choices": organic[-2:]}}},
+        "status_code": 200, "url": "https://www.amazon.com/s"}]}
+
+
+def chat_completion(content: dict) -> dict:
+    return {
+        "id": f"chatcmpl-{random.getrandbits(48):x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "gpt-4o",
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": json.dumps(content)}}],
+        "usage": {"prompt_tokens": 1200, "completion_tokens": 60, "total_tokens": 1260},
+    }
+
+
+def completion_content(config: FakeConfig, body: dict) -> dict:
+    system, user = body["messages"][0]["content"], body["messages"][1]["content"]
+    if "galler" not in system:
+        # Product query: the same product for every image that hashes alike
+        image_url = next(part["image_url"]["url"] for part in user if part["type"] == "image_url")
+        product = stable_hash(image_url[:4096]) % config.products
+        return {"brands": ["Acme"], "description": f"Product {product}",
+                "query": f"Acme product {product}"}
+    names = [name for part in user if part["type"] == "text"
+             and part["text"].startswith(("Gallery: ", "Galleries: "))
+             for name in part["text"].split(": ", 1)[1].split(" (")[0].split(", ")]
+    # Galleries sent without names (OOP.py) come in amz, gs, gis, lens order
+    names = names or ['amz', 'gs', 'gis', 'lens'][:sum(part["type"] == "image_url" for part in user)]
+    return {name: 1 for name in names}
+
+
+def make_app(config: FakeConfig) -> web.Application:
+    images = make_images(config)
+    uploads = 0
+
+    async def delay():
+        await asyncio.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+        if random.random() < config.error_rate:
+            raise web.HTTPInternalServerError(text="injected failure")
+
+    def base_url(request) -> str:
+        return f"{request.scheme}://{request.host}"
+
+    async def serpapi(request):
+        await delay()
+        page = serpapi_page(config, base_url(request), request.query)
+        response = web.json_response(page)
+        response.enable_compression()
+        return response
+
+    async def scrape(request):
+        payload = await request.json()
+        await delay()
+        return web.json_response(amazon_page(config, base_url(request), payload["query"]))
+
+    async def upload(request):
+        nonlocal uploads
+        form = await request.post()
+        await delay()
+        uploads += 1
+        name = f"upload-{stable_hash(str(form.get('image', ''))[:4096])}-{uploads}"
+        return web.json_response({"data": {"url": f"{base_url(request)}/img/{name}.jpg"},
+                                  "success": True, "status": 200})
+
+    async def completions(request):
+        body = await request.json()
+        await delay()
+        return web.json_response(chat_completion(completion_content(config, body)))
+
+    async def image(request):
+        await delay()
+        return web.Response(body=images[stable_hash(request.match_info['name']) % len(images)],
+                            content_type='image/jpeg')
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_get('/search', serpapi)
+    app.router.add_get('/search.json', serpapi)
+    app.router.add_post('/v2/scrape', scrape)
+    app.router.add_post('/1/upload', upload)
+    app.router.add_post('/openai/deployments/{deployment}/chat/completions', completions)
+    app.router.add_get('/img/{name}', image)
+    return app
+
+
+def serve(port: int, config: FakeConfig, ready=None):
+    """Run the fake services until the process is stopped (for a child process)."""
+    random.seed(config.seed)
+    app = make_app(config)
+
+    async def started(app):
+        if ready is not None:
+            ready.set()
+
+    app.on_startup.append(started)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, backlog=4096, access_log=None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8791)
+    parser.add_argument('--latency', type=float, default=FakeConfig.latency)
+    parser.add_argument('--error-rate', type=float, default=FakeConfig.error_rate)
+    args = parser.parse_args()
+    serve(args.port, FakeConfig(latency=args.latency, error_rate=args.error_rate))
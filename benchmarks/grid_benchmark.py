@@ -0,0 +1,101 @@
+"""Per-grid CPU time of the old matplotlib contact sheet vs GridRenderer.
+
+Run from the repository root:
+
+    python -m benchmarks.grid_benchmark --tiles 26 --iterations 20
+"""
+import argparse
+import time
+from io import BytesIO
+
+import cv2
+import numpy as np
+
+from services.grid_renderer import GridRenderer, CELL_HEIGHT, TILE_SIZE
+
+
+def make_tiles(count: int, seed: int = 0) -> list[np.ndarray]:
+    rng = np.random.default_rng(seed)
+    tiles = []
+    for _ in range(count):
+        # Smooth gradients compress like real product shots; pure noise
+        # would make every encoder look equally bad
+        base = rng.integers(0, 255, size=(6, 6, 3), dtype=np.uint8)
+        tiles.append(cv2.resize(base, (TILE_SIZE, TILE_SIZE),
+                                interpolation=cv2.INTER_CUBIC))
+    return tiles
+
+
+def legacy_grid(tiles: list[np.ndarray], columns: int = 6) -> np.ndarray:
+    """The layout ImageService built before GridRenderer."""
+    cells = []
+    for index, tile in enumerate(tiles):
+        cell = cv2.copyMakeBorder(
+            tile, 0, 20, 0, 0, cv2.BORDER_CONSTANT, value=[255, 255, 255])
+        cv2.putText(cell, str(index), (75, 165),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1, cv2.LINE_AA)
+        cells.append(cell)
+
+    rows = (len(cells) + columns - 1) // columns
+    grid = np.zeros((rows * CELL_HEIGHT, columns * TILE_SIZE, 3), dtype=np.uint8)
+    for i, cell in enumerate(cells):
+        row = i // columns
+        col = i % columns
+        grid[row*170:row*170+170, col*150:col*150+150] = cell
+    return grid
+
+
+def legacy_encode(grid: np.ndarray) -> bytes:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    buffer = BytesIO()
+    plt.figure(figsize=(20, 20))
+    plt.imshow(cv2.cvtColor(grid, cv2.COLOR_BGR2RGB))
+    plt.axis('off')
+    plt.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0)
+    plt.close()
+    return buffer.getvalue()
+
+
+def cpu_time(fn, iterations: int) -> tuple[float, int]:
+    size = len(fn())  # warm-up, and keeps imports out of the timing
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    return (time.process_time() - start) / iterations, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tiles', type=int, default=26)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    tiles = make_tiles(args.tiles)
+    renderer = GridRenderer(max_tiles=max(args.tiles, 1))
+
+    if not np.array_equal(legacy_grid(tiles), renderer.render(tiles)):
+        raise SystemExit("GridRenderer layout differs from the legacy grid")
+    print(f"layout: identical ({args.tiles} tiles, 150x170 cells)")
+
+    results = []
+    try:
+        results.append(('matplotlib png (before)', *cpu_time(
+            lambda: legacy_encode(legacy_grid(tiles)), args.iterations)))
+    except ImportError:
+        print("matplotlib not installed, skipping the legacy path")
+
+    for fmt, quality in (('png', None), ('jpeg', 90), ('webp', 90)):
+        results.append((f'GridRenderer {fmt} (after)', *cpu_time(
+            lambda: renderer.encode(renderer.render(tiles), fmt, quality),
+            args.iterations)))
+
+    print(f"{'path':<28} {'cpu ms/grid':>12} {'bytes':>10}")
+    for name, seconds, size in results:
+        print(f"{name:<28} {seconds * 1000:>12.2f} {size:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+"""Vision tokens and match quality of fixed vs planned gallery sheets.
+
+Each fixture is one gallery: a query image, its true match and distractors.
+Fixtures are grouped four at a time into a request (one per engine) and
+drawn three ways: the fixed 6-column grid per gallery, a planned sheet per
+gallery, and planned sheets packed across galleries. For each, the
+estimated GPT-4o image tokens per request are reported, and the sheets are
+decoded, scaled as the model would scale them and cut back into tiles; the
+match is scored by whether the true match is still the closest tile to
+image 0 by perceptual distance, a proxy for what survived the smaller
+tiles and the encoding.
+
+    python -m benchmarks.layout_quality --fixtures 40 --candidates 12
+    python -m benchmarks.layout_quality --fixture-dir fixtures/ --detail high
+    python -m benchmarks.layout_quality --fixtures 20 --gpt
+
+`--fixture-dir` holds one directory per gallery with `query.*`, `match.*`
+and any number of other images as distractors; without it, synthetic
+product shots are generated. `--gpt` also sends every request's sheets
+(inline, as data: URLs) to the matching call and scores GPT's answers;
+it needs the Azure OpenAI credentials in .env and spends real tokens.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+
+import cv2
+import numpy as np
+
+from services.gallery_layout import (FIXED_COLUMNS, SheetLayout, fixed_tokens, plan_packing,
+                                     seen_unscaled)
+from services.grid_renderer import HEADER_HEIGHT, LABEL_HEIGHT, TILE_SIZE, to_data_url
+from services.image_ops import decode_tile, render_packed
+from services.phash import fingerprint
+
+ENGINES = ['amz', 'gs', 'gis', 'lens']
+LAYOUTS = ('fixed', 'planned', 'packed')
+
+
+class Fixture:
+    """One gallery: tiles in label order, tile 0 the query."""
+
+    def __init__(self, name: str, tiles: list[np.ndarray], match: int):
+        self.name = name
+        self.tiles = tiles
+        self.match = match
+
+
+def product_shot(rng: random.Random, shape: int, colour: tuple) -> np.ndarray:
+    # A flat backdrop and one coloured object, roughly what thumbnails look like
+    tile = np.full((TILE_SIZE, TILE_SIZE, 3), rng.randint(200, 250), dtype=np.uint8)
+    centre = (rng.randint(60, 90), rng.randint(60, 90))
+    size = rng.randint(30, 50)
+    if shape == 0:
+        cv2.circle(tile, centre, size, colour, -1, cv2.LINE_AA)
+    elif shape == 1:
+        cv2.rectangle(tile, (centre[0] - size, centre[1] - size // 2),
+                      (centre[0] + size, centre[1] + size // 2), colour, -1)
+    else:
+        points = np.array([(centre[0], centre[1] - size), (centre[0] - size, centre[1] + size),
+                           (centre[0] + size, centre[1] + size)], dtype=np.int32)
+        cv2.fillPoly(tile, [points], colour, cv2.LINE_AA)
+    # A label-like stripe across the object
+    cv2.line(tile, (centre[0] - size // 2, centre[1]), (centre[0] + size // 2, centre[1]),
+             (255 - colour[0], 255 - colour[1], 255 - colour[2]), rng.randint(2, 6))
+    return tile
+
+
+def perturbed(rng: random.Random, tile: np.ndarray) -> np.ndarray:
+    """The same product photographed again: shifted, rescaled, relit, recompressed."""
+    scale = rng.uniform(0.95, 1.05)
+    matrix = np.float32([[scale, 0, rng.uniform(-4, 4)], [0, scale, rng.uniform(-4, 4)]])
+    moved = cv2.warpAffine(tile, matrix, (TILE_SIZE, TILE_SIZE),
+                           borderMode=cv2.BORDER_REPLICATE)
+    moved = cv2.convertScaleAbs(moved, alpha=rng.uniform(0.85, 1.15), beta=rng.uniform(-15, 15))
+    ok, encoded = cv2.imencode('.jpg', moved, [cv2.IMWRITE_JPEG_QUALITY, rng.randint(40, 80)])
+    return cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+
+
+def synthetic_fixtures(count: int, candidates: int, seed: int) -> list[Fixture]:
+    rng = random.Random(seed)
+    fixtures = []
+    for n in range(count):
+        shape = rng.randrange(3)
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        query = product_shot(rng, shape, colour)
+        distractors = []
+        for _ in range(candidates - 1):
+            # Half are the same kind of object in another colour: the hard cases
+            other_shape = shape if rng.random() < 0.5 else rng.randrange(3)
+            other_colour = tuple(min(255, max(0, c + rng.randint(-90, 90))) for c in colour)
+            distractors.append(product_shot(rng, other_shape, other_colour))
+        match = rng.randint(1, candidates)
+        tiles = [query] + distractors
+        tiles.insert(match, perturbed(rng, query))
+        fixtures.append(Fixture(f"synthetic-{n}", tiles, match))
+    return fixtures
+
+
+def load_fixtures(directory: str) -> list[Fixture]:
+    fixtures = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isdir(path):
+            continue
+        files = sorted(os.listdir(path))
+        query = [f for f in files if os.path.splitext(f)[0] == 'query']
+        match = [f for f in files if os.path.splitext(f)[0] == 'match']
+        if not query or not match:
+            print(f"Skipping {path}: needs query.* and match.*")
+            continue
+        others = [f for f in files if f not in query + match]
+
+        def tile(filename):
+            with open(os.path.join(path, filename), 'rb') as f:
+                return decode_tile(f.read())
+
+        tiles = [tile(query[0])] + [tile(f) for f in others]
+        # The true match goes in the middle, not at a position the model could learn
+        index = 1 + len(others) // 2
+        tiles.insert(index, tile(match[0]))
+        fixtures.append(Fixture(name, tiles, index))
+    return fixtures
+
+
+def as_seen(sheet: np.ndarray, detail: str) -> np.ndarray:
+    """The sheet at the size GPT-4o looks at it."""
+    height, width = sheet.shape[:2]
+    if seen_unscaled(width, height, detail):
+        return sheet
+    if detail == "low":
+        scale = 512 / max(width, height)
+    else:
+        scale = min(1.0, 2048 / max(width, height))
+        scale *= min(1.0, 768 / (min(width, height) * scale))
+    return cv2.resize(sheet, (round(width * scale), round(height * scale)),
+                      interpolation=cv2.INTER_AREA)
+
+
+def cut_tiles(sheet: np.ndarray, layout: SheetLayout, detail: str) -> list[list[np.ndarray]]:
+    """Each gallery's tiles, cut out of the sheet as the model sees it."""
+    seen = as_seen(sheet, detail)
+    scale = seen.shape[1] / layout.width
+    cell = layout.tile_size + LABEL_HEIGHT
+    galleries = []
+    y = 0
+    for count in layout.counts:
+        if layout.headed:
+            y += HEADER_HEIGHT
+        tiles = []
+        for i in range(count):
+            top = y + (i // layout.columns) * cell
+            left = (i % layout.columns) * layout.tile_size
+            crop = seen[round(top * scale):round((top + layout.tile_size) * scale),
+                        round(left * scale):round((left + layout.tile_size) * scale)]
+            tiles.append(cv2.resize(crop, (TILE_SIZE, TILE_SIZE), interpolation=cv2.INTER_LINEAR))
+        galleries.append(tiles)
+        y += (count + layout.columns - 1) // layout.columns * cell
+    return galleries
+
+
+def closest(tiles: list[np.ndarray]) -> int:
+    query = fingerprint(tiles[0])
+    return min(range(1, len(tiles)), key=lambda i: fingerprint(tiles[i]).distance(query))
+
+
+def sheets_for(layout: str, request: dict[str, Fixture], min_tile: int,
+               detail: str) -> list[SheetLayout]:
+    counts = {engine: len(fixture.tiles) for engine, fixture in request.items()}
+    if layout == 'fixed':
+        return [SheetLayout([engine], [count], TILE_SIZE, FIXED_COLUMNS,
+                            fixed_tokens(count, detail))
+                for engine, count in counts.items()]
+    return plan_packing(counts, min_tile, detail, pack=layout == 'packed').sheets
+
+
+async def gpt_answers(matching_service, sheets: list[tuple[SheetLayout, bytes]],
+                      detail: str) -> dict[str, int]:
+    reply = await matching_service.get_matching_sheets(
+        [(layout.engines, to_data_url(encoded)) for layout, encoded in sheets], detail)
+    answers = {}
+    for engine, index in json.loads(reply).items():
+        try:
+            answers[engine] = int(index)
+        except (TypeError, ValueError):
+            pass
+    return answers
+
+
+async def run(fixtures: list[Fixture], min_tile: int, detail: str, gpt: bool):
+    matching_service = None
+    if gpt:
+        from services.matching_service import MatchingService
+        matching_service = MatchingService()
+
+    requests = [dict(zip(ENGINES, fixtures[i:i + len(ENGINES)]))
+                for i in range(0, len(fixtures), len(ENGINES))]
+    print(f"{len(fixtures)} galleries in {len(requests)} requests, "
+          f"{statistics.mean(len(f.tiles) for f in fixtures):.1f} tiles each, detail={detail}")
+    print(f"{'layout':<8} {'images/req':>10} {'tokens/req':>10} {'tile px':>7} "
+          f"{'proxy top-1':>11}" + (f" {'gpt top-1':>9}" if gpt else ""))
+    report = {}
+    for layout in LAYOUTS:
+        tokens, images, tile_sizes, hits, gpt_hits = [], [], [], 0, 0
+        for request in requests:
+            sheets = sheets_for(layout, request, min_tile, detail)
+            tokens.append(sum(sheet.tokens for sheet in sheets))
+            images.append(len(sheets))
+            drawn = []
+            for sheet in sheets:
+                blocks = [(request[engine].tiles, list(range(len(request[engine].tiles))))
+                          for engine in sheet.engines]
+                encoded = render_packed(blocks, sheet)
+                drawn.append((sheet, encoded))
+                decoded = cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_COLOR)
+                for engine, tiles in zip(sheet.engines, cut_tiles(decoded, sheet, detail)):
+                    tile_sizes.append(sheet.tile_size)
+                    hits += closest(tiles) == request[engine].match
+            if matching_service is not None:
+                answers = await gpt_answers(matching_service, drawn, detail)
+                gpt_hits += sum(answers.get(engine) == fixture.match
+                                for engine, fixture in request.items())
+        entry = {
+            "images_per_request": statistics.mean(images),
+            "tokens_per_request": statistics.mean(tokens),
+            "tile_px": statistics.mean(tile_sizes),
+            "proxy_top1": hits / len(fixtures),
+        }
+        if matching_service is not None:
+            entry["gpt_top1"] = gpt_hits / len(fixtures)
+        report[layout] = entry
+        print(f"{layout:<8} {entry['images_per_request']:>10.2f} "
+              f"{entry['tokens_per_request']:>10.0f} {entry['tile_px']:>7.0f} "
+              f"{entry['proxy_top1']:>11.1%}"
+              + (f" {entry['gpt_top1']:>9.1%}" if matching_service is not None else ""))
+    if matching_service is not None:
+        await matching_service.llm.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixtures', type=int, default=40, help="Synthetic galleries to generate")
+    parser.add_argument('--candidates', type=int, default=12,
+                        help="Synthetic candidates per gallery, as after pre-ranking")
+    parser.add_argument('--fixture-dir', help="Directory of real fixtures instead")
+    parser.add_argument('--min-tile', type=int, default=int(os.getenv('GALLERY_MIN_TILE', '96')))
+    parser.add_argument('--detail', default=os.getenv('VISION_DETAIL_MATCHING', 'auto'),
+                        choices=('auto', 'high', 'low'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gpt', action='store_true',
+                        help="Also score GPT's answers (needs Azure OpenAI credentials)")
+    parser.add_argument('--json', help="Write the report to this file")
+    args = parser.parse_args()
+
+    if args.fixture_dir:
+        fixtures = load_fixtures(args.fixture_dir)
+    else:
+        fixtures = synthetic_fixtures(args.fixtures, args.candidates, args.seed)
+    if not fixtures:
+        raise SystemExit("No fixtures")
+    report = asyncio.run(run(fixtures, args.min_tile, args.detail, args.gpt))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
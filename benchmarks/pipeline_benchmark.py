@@ -0,0 +1,272 @@
+"""End-to-end throughput, latency, CPU and memory against fake upstreams.
+
+Starts benchmarks.fake_upstreams in a child process and points every
+external call at it, then drives `main.py`'s /search (in process, over
+ASGI, `--concurrency` requests at a time) and `OOP.py`'s
+`ImageSearchPipeline.run`. Each target runs in its own process so CPU time
+and peak RSS are its alone. No credentials or API credits are used.
+
+    python -m benchmarks.pipeline_benchmark --requests 200 --concurrency 20 --latency 0.2
+    python -m benchmarks.pipeline_benchmark --json before.json
+    python -m benchmarks.pipeline_benchmark --compare before.json --tolerance 0.15
+
+`OOP.py` writes its galleries to fixed file names, so it runs one pipeline
+at a time (in a scratch directory). With `--compare`, the exit status is 1
+if p95 latency or CPU per request got worse than the baseline by more than
+the tolerance. Redis is used if REDIS_HOST points at one.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import asdict
+
+from benchmarks.fake_upstreams import FakeConfig, serve
+
+TARGETS = ('main', 'oop')
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Run:
+    """Latencies and outcomes of one measured run, with its wall and CPU time."""
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.failed = 0
+        self.degraded = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def start(self):
+        self.latencies.clear()
+        self.failed = self.degraded = 0
+        self._cpu_start = time.process_time()
+        self._wall_start = time.perf_counter()
+
+    def stop(self):
+        self.wall = time.perf_counter() - self._wall_start
+        self.cpu = time.process_time() - self._cpu_start
+
+
+def point_services_at(base_url: str):
+    os.environ.update({
+        'SERPAPI_BACKEND': base_url,
+        'SMARTPROXY_URL': f"{base_url}/v2/scrape",
+        'IMGBB_UPLOAD_URL': f"{base_url}/1/upload",
+        'AZURE_OPENAI_ENDPOINT': base_url,
+        'AZURE_KEY': 'benchmark',
+        'IMGBB_API_KEY': 'benchmark',
+        'GOOGLE_API_KEY': 'benchmark',
+    })
+
+
+async def drive_main(base_url: str, requests: int, concurrency: int) -> Run:
+    import httpx
+    import main
+
+    prefix = f"{base_url}/img/query-{uuid.uuid4().hex[:8]}"
+    run = Run()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(client, image_url: str):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post('/search', params={'image_url': image_url})
+            run.latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            run.failed += 1
+        elif response.json().get("errors"):
+            run.degraded += 1
+
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench',
+                                     timeout=None) as client:
+            # Warm up connection pools and lazy imports outside the measurement
+            await one(client, f"{prefix}-warmup.jpg")
+            run.start()
+            await asyncio.gather(*[one(client, f"{prefix}-{i}.jpg") for i in range(requests)])
+            run.stop()
+    return run
+
+
+class RedirectedRequests:
+    """`requests` as OOP.py uses it, with the real service hosts rewritten."""
+
+    HOSTS = ('https://scraper-api.smartproxy.com', 'https://api.imgbb.com')
+
+    def __init__(self, base_url: str):
+        import requests
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def _url(self, url: str) -> str:
+        for host in self.HOSTS:
+            if url.startswith(host):
+                return self.base_url + url[len(host):]
+        return url
+
+    def get(self, url, **kwargs):
+        return self.session.get(self._url(url), **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(self._url(url), **kwargs)
+
+
+def drive_oop(base_url: str, requests: int) -> Run:
+    from openai import AzureOpenAI
+    from serpapi import GoogleSearch
+    import OOP
+
+    GoogleSearch.BACKEND = base_url
+    OOP.requests = RedirectedRequests(base_url)
+    OOP.AzureOpenAI = lambda **kwargs: AzureOpenAI(**{**kwargs, 'azure_endpoint': base_url})
+
+    prefix = f"{base_url}/img/query-{uuid.uuid4().hex[:8]}"
+    run = Run()
+    os.chdir(tempfile.mkdtemp(prefix='oop-benchmark-'))
+
+    def one(image_url: str):
+        start = time.perf_counter()
+        try:
+            matches = OOP.ImageSearchPipeline(image_url).run()
+            run.degraded += len(matches) < 4
+        except Exception as e:
+            print(f"OOP pipeline failed: {str(e)}", file=sys.stderr)
+            run.failed += 1
+        run.latencies.append(time.perf_counter() - start)
+
+    one(f"{prefix}-warmup.jpg")
+    run.start()
+    for i in range(requests):
+        one(f"{prefix}-{i}.jpg")
+    run.stop()
+    return run
+
+
+def run_target(target: str, base_url: str, requests: int, concurrency: int, results):
+    """Child process entry point: run one target and report its numbers."""
+    point_services_at(base_url)
+    if target == 'main':
+        run = asyncio.run(drive_main(base_url, requests, concurrency))
+    else:
+        run = drive_oop(base_url, requests)
+
+    results.put({
+        "target": target,
+        "requests": requests,
+        "concurrency": concurrency if target == 'main' else 1,
+        "failed": run.failed,
+        "degraded": run.degraded,
+        "throughput": requests / run.wall,
+        "p50_s": statistics.median(run.latencies),
+        "p95_s": percentile(run.latencies, 0.95),
+        "p99_s": percentile(run.latencies, 0.99),
+        # Includes the image executor's threads
+        "cpu_ms_per_request": run.cpu / requests * 1000,
+        # ru_maxrss is KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def wait_for_result(worker, results) -> dict:
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not worker.is_alive():
+                raise SystemExit(f"Benchmark process exited with code {worker.exitcode}")
+
+
+def regressions(report: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    found = []
+    before = {entry["target"]: entry for entry in baseline}
+    for entry in report:
+        old = before.get(entry["target"])
+        if old is None:
+            continue
+        for metric in ("p95_s", "cpu_ms_per_request"):
+            if entry[metric] > old[metric] * (1 + tolerance):
+                found.append(f"{entry['target']} {metric}: {old[metric]:.4f} -> {entry[metric]:.4f}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=list(TARGETS))
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--oop-requests', type=int, default=10,
+                        help="OOP.py runs serially, so it gets fewer requests")
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=FakeConfig.latency,
+                        help="Mean latency of every fake upstream call in seconds")
+    parser.add_argument('--jitter', type=float, default=FakeConfig.jitter)
+    parser.add_argument('--error-rate', type=float, default=FakeConfig.error_rate)
+    parser.add_argument('--results', type=int, default=FakeConfig.results,
+                        help="Results per search page")
+    parser.add_argument('--padding', type=int, default=FakeConfig.padding,
+                        help="Extra characters per search result")
+    parser.add_argument('--image-size', type=int, default=FakeConfig.image_size,
+                        help="Width in pixels of every served image")
+    parser.add_argument('--port', type=int, default=8791)
+    parser.add_argument('--json', help="Write the report to this file")
+    parser.add_argument('--compare', help="Baseline report to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    config = FakeConfig(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        results=args.results, padding=args.padding, image_size=args.image_size)
+    base_url = f"http://127.0.0.1:{args.port}"
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    server = context.Process(target=serve, args=(args.port, config, ready), daemon=True)
+    server.start()
+    ready.wait()
+    time.sleep(0.5)
+
+    print(f"fake upstreams: {json.dumps(asdict(config))}")
+    print(f"{'target':<6} {'reqs':>5} {'conc':>4} {'fail':>4} {'degr':>4} {'req/s':>7} "
+          f"{'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'cpu ms/req':>10} {'peak MB':>8}")
+    report = []
+    try:
+        for target in args.targets:
+            results = context.Queue()
+            requests = args.requests if target == 'main' else args.oop_requests
+            worker = context.Process(target=run_target, args=(
+                target, base_url, requests, args.concurrency, results))
+            worker.start()
+            entry = wait_for_result(worker, results)
+            worker.join()
+            report.append(entry)
+            print(f"{target:<6} {entry['requests']:>5} {entry['concurrency']:>4} "
+                  f"{entry['failed']:>4} {entry['degraded']:>4} {entry['throughput']:>7.2f} "
+                  f"{entry['p50_s']:>7.3f} {entry['p95_s']:>7.3f} {entry['p99_s']:>7.3f} "
+                  f"{entry['cpu_ms_per_request']:>10.1f} {entry['peak_rss_mb']:>8.1f}")
+    finally:
+        server.terminate()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Throughput of SerpAPI calls: GoogleSearch.get_dict in to_thread vs SerpApiClient.
+
+Runs a fake SerpAPI backend in a child process (fixed latency, a result
+page of realistic size, gzip) and fires N concurrent searches at it through
+each client, for each concurrency level:
+
+    python -m benchmarks.serpapi_benchmark --concurrency 50 200 500 --latency 0.3
+
+The async client is bounded by the shared pool (HTTP_POOL_LIMIT /
+HTTP_POOL_LIMIT_PER_HOST); the thread client by the default executor.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import time
+
+from aiohttp import web
+
+
+def fake_page(results: int = 100) -> bytes:
+    return json.dumps({
+        "search_metadata": {"status": "Success"},
+        "visual_matches": [
+            {
+                "position": i,
+                "title": f"Product {i} " + "x" * 80,
+                "link": f"https://example.com/product/{i}",
+                "thumbnail": f"https://example.com/thumb/{i}.jpg",
+                "source": "example.com",
+            }
+            for i in range(1, results + 1)
+        ],
+    }).encode('utf-8')
+
+
+def serve(port: int, latency: float, ready):
+    page = fake_page()
+
+    async def search(request):
+        await asyncio.sleep(latency)
+        response = web.Response(body=page, content_type='application/json')
+        response.enable_compression()
+        return response
+
+    app = web.Application()
+    app.router.add_get('/search', search)
+    ready.set()
+    web.run_app(app, host='127.0.0.1', port=port, print=None, backlog=2048)
+
+
+PARAMS = {"api_key": "x", "engine": "google_lens", "google_domain": "google.com",
+          "url": "https://example.com/query.jpg"}
+
+
+async def timed(call) -> float:
+    start = time.perf_counter()
+    result = await call()
+    assert "visual_matches" in result
+    return time.perf_counter() - start
+
+
+async def run_level(call, concurrency: int) -> tuple[float, float, float]:
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*[timed(call) for _ in range(concurrency)])
+    wall = time.perf_counter() - start
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+    return concurrency / wall, statistics.median(latencies), p95
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--latency', type=float, default=0.3,
+                        help="Simulated SerpAPI response time in seconds")
+    parser.add_argument('--port', type=int, default=8790)
+    args = parser.parse_args()
+
+    backend = f"http://127.0.0.1:{args.port}"
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(args.port, args.latency, ready), daemon=True)
+    server.start()
+    ready.wait()
+    await asyncio.sleep(0.5)
+
+    os.environ['SERPAPI_BACKEND'] = backend
+    from serpapi import GoogleSearch
+    from services.http_client import HttpClient
+    from services.serpapi_client import SerpApiClient
+
+    GoogleSearch.BACKEND = backend
+    http_client = HttpClient()
+    await http_client.start()
+    serpapi = SerpApiClient(http_client)
+
+    clients = {
+        "to_thread": lambda: asyncio.to_thread(GoogleSearch(dict(PARAMS)).get_dict),
+        "aiohttp": lambda: serpapi.search(PARAMS),
+    }
+
+    print(f"pool: limit={http_client.limit} per_host={http_client.limit_per_host}, "
+          f"default executor: {min(32, (os.cpu_count() or 1) + 4)} threads, latency {args.latency}s")
+    print(f"{'client':<10} {'concurrent':>10} {'req/s':>8} {'p50 s':>7} {'p95 s':>7}")
+    try:
+        for concurrency in args.concurrency:
+            for name, call in clients.items():
+                throughput, p50, p95 = await run_level(call, concurrency)
+                print(f"{name:<10} {concurrency:>10} {throughput:>8.1f} {p50:>7.3f} {p95:>7.3f}")
+    finally:
+        await http_client.close()
+        server.terminate()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,78 @@
+"""End-to-end timing of hosted (imgbb) vs inline (data: URL) galleries.
+
+Searches run once; then each transport builds the four galleries and runs
+the GPT matching call. Needs the same credentials as the API (.env).
+
+    python -m benchmarks.transport_benchmark --image-url https://... --runs 3
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from services.http_client import HttpClient
+from services.image_executor import ImageExecutor
+from services.image_service import ImageService
+from services.matching_service import MatchingService
+from services.search_service import SearchService
+from services.thumbnail_cache import ThumbnailCache
+
+ENGINES = ['amz', 'gs', 'gis', 'lens']
+
+
+async def run_transport(image_service, matching_service, results, image_url, inline):
+    start = time.perf_counter()
+    bundle = await asyncio.gather(*[
+        image_service.concatenate_thumbnails(engine, result, image_url, inline=inline)
+        for engine, result in zip(ENGINES, results)
+    ])
+    galleries_done = time.perf_counter()
+    await matching_service.get_matching_images(dict(zip(ENGINES, bundle)))
+    end = time.perf_counter()
+    payload = sum(len(url) for url in bundle)
+    return galleries_done - start, end - galleries_done, end - start, payload
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--image-url', required=True)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    http_client = HttpClient()
+    await http_client.start()
+    image_executor = ImageExecutor()
+    image_executor.start()
+    image_service = ImageService(http_client, image_executor, ThumbnailCache())
+    search_service = SearchService(http_client)
+    matching_service = MatchingService()
+
+    try:
+        query = json.loads(await image_service.get_product_query(args.image_url))['query']
+        results = await asyncio.gather(
+            search_service.amazon_search(query),
+            search_service.google_search(query),
+            search_service.google_image_search(args.image_url),
+            search_service.google_lens_search(args.image_url),
+        )
+
+        # Warm the thumbnail cache for every engine so both transports see the same fetch cost
+        await asyncio.gather(*[image_service.render_thumbnails(engine, result, args.image_url)
+                               for engine, result in zip(ENGINES, results)])
+
+        print(f"{'transport':<10} {'galleries s':>12} {'matching s':>11} {'total s':>9} {'url bytes':>10}")
+        for name, inline in (('upload', False), ('inline', True)):
+            samples = [await run_transport(image_service, matching_service,
+                                           results, args.image_url, inline)
+                       for _ in range(args.runs)]
+            galleries, matching, total, payload = (
+                statistics.median(column) for column in zip(*samples))
+            print(f"{name:<10} {galleries:>12.3f} {matching:>11.3f} {total:>9.3f} {int(payload):>10}")
+    finally:
+        await http_client.close()
+        image_executor.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
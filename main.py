@@ -1,37 +1,161 @@
-from typing import Optional
-import redis
+from typing import Any, Optional
+import base64
 import hashlib
 import json
+import os
 import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Depends
 from fastapi.param_functions import Query
-from models.search_models import SearchRequest, SearchResult
+from fastapi.responses import Response, StreamingResponse
+from models.search_models import SearchRequest, SearchResult, MatchDecision
 from services.image_service import ImageService
 from services.search_service import SearchService
-from services.matching_service import MatchingService
+from services.matching_service import MatchingService, RESULT_KEYS, UnusableMatchError
+from services.http_client import HttpClient
+from services.image_executor import ImageExecutor, LoopLagMonitor
+from services.thumbnail_cache import ThumbnailCache
+from services.query_index import QueryIndex
+from services.cache import RedisCache
+from services.stage_cache import StageCache
+from services.single_flight import SingleFlight
+from services.stage_graph import StageGraph, StageTimings
+from services.resilience import Deadline, Upstreams, within
+from services.rate_limit import RateLimiter
+from services.llm_router import LLMRouter
+from services.metrics import Metrics, RequestMetrics, service_metrics
+from services.job_queue import JobQueue
+from redis.exceptions import RedisError
+from services.image_service import Gallery
+from services.candidates import Candidates, NoCandidatesError, parse_candidates
+from services.gallery_layout import vision_tokens
 
-app = FastAPI()
+# Shared non-blocking Redis pools (REDIS_HOST / REDIS_PORT); fails soft when down
+redis_cache = RedisCache()
 
-redis_client = redis.StrictRedis(
-    host='0.0.0.0', port=6379, db=0, decode_responses=True)
+# How long an upload's content hash keeps pointing at its hosted copy
+HOSTED_IMAGE_TTL = int(os.getenv('HOSTED_IMAGE_TTL', str(30 * 86400)))
+# Whole search results, and the query index entries pointing at them
+RESULT_TTL = int(os.getenv('RESULT_TTL', '3600'))
+upload_stats = {"uploaded": 0, "deduplicated": 0, "bytes_received": 0, "bytes_uploaded": 0,
+                "vision_tokens_saved": 0}
+result_stats = {"hit": 0, "miss": 0}
+# Estimated GPT image tokens sent for matching, and what the fixed 6-column grids would have cost
+matching_stats = {"calls": 0, "images": 0, "tokens": 0, "fixed_tokens": 0}
+
+# Latency budget for one search, and the cap for any single engine within it
+SEARCH_BUDGET_SECONDS = float(os.getenv('SEARCH_BUDGET_SECONDS', '25'))
+ENGINE_DEADLINE_SECONDS = float(os.getenv('ENGINE_DEADLINE_SECONDS', '15'))
+
+# GALLERY_PACKING=1 (with GALLERY_LAYOUT=planned) has /search pack its galleries onto
+# as few sheets as the token planner finds cheapest. Off by default until a
+# `benchmarks.layout_quality --gpt` run shows GPT matches as well on packed sheets
+GALLERY_PACKING = os.getenv('GALLERY_PACKING', '0') == '1'
+
+# Items of one /search/batch running at once, and the most a batch may hold
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '1000'))
+# Total bytes of a batch's uploads, which are held in memory until their items run
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', str(256 * 1024 * 1024)))
 
 
 # Initialize services
-image_service = ImageService()
-search_service = SearchService()
-matching_service = MatchingService()
+metrics = Metrics()
+http_client = HttpClient()
+image_executor = ImageExecutor()
+loop_monitor = LoopLagMonitor()
+# THUMBNAIL_CACHE_REDIS=1 shares decoded tiles across workers through Redis
+thumbnail_cache = ThumbnailCache(
+    redis_cache if os.getenv('THUMBNAIL_CACHE_REDIS') == '1' else None)
+rate_limiter = RateLimiter(redis_cache)
+# Azure OpenAI deployments (AZURE_OPENAI_DEPLOYMENTS), shared by both GPT callers
+llm_router = LLMRouter(rate_limiter, metrics)
+upstreams = Upstreams(rate_limiter, metrics)
+image_service = ImageService(http_client, image_executor, thumbnail_cache, metrics, llm_router,
+                             upstreams)
+search_service = SearchService(http_client)
+matching_service = MatchingService(llm_router)
+query_index = QueryIndex(redis_cache, RESULT_TTL)
+stage_cache = StageCache(redis_cache)
+single_flight = SingleFlight(redis_cache)
+stage_timings = StageTimings()
+job_queue = JobQueue(redis_cache)
+metrics.watch(lambda: service_metrics(
+    http_client, upstreams, stage_cache, thumbnail_cache, image_service,
+    loop_monitor, single_flight, llm_router, result_stats, upload_stats, matching_stats))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled session for every outbound call, opened once per worker
+    await http_client.start()
+    # CPU-bound decode/resize/encode runs here instead of on the event loop
+    image_executor.start()
+    loop_monitor.start()
+    await query_index.load()
+    yield
+    await loop_monitor.close()
+    image_executor.close()
+    await http_client.close()
+    await llm_router.close()
+    await redis_cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestMetrics, metrics=metrics)
 
 # Dependency to get services
 
 
 def get_services():
     return {
+        "http_client": http_client,
+        "image_executor": image_executor,
         "image_service": image_service,
         "search_service": search_service,
-        "matching_service": matching_service
+        "matching_service": matching_service,
+        "query_index": query_index,
+        "stage_cache": stage_cache,
+        "single_flight": single_flight,
+        "upstreams": upstreams,
+        "job_queue": job_queue
+    }
+
+
+@app.get("/stats")
+async def stats(services: dict = Depends(get_services)):
+    return {
+        "http": services["http_client"].stats(),
+        "image_executor": services["image_executor"].stats(),
+        "event_loop": loop_monitor.stats(),
+        "thumbnail_cache": thumbnail_cache.stats(),
+        "query_index": services["query_index"].stats(),
+        "uploads": upload_stats,
+        "matching": matching_stats,
+        "stages": services["stage_cache"].stats(),
+        "redis": redis_cache.stats(),
+        "single_flight": services["single_flight"].stats(),
+        "pipeline": stage_timings.stats(),
+        "upstreams": services["upstreams"].stats(),
+        "rate_limits": services["upstreams"].limiter.stats(),
+        "llm": llm_router.stats(),
+        "jobs": await job_stats(services["job_queue"]),
     }
 
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+async def job_stats(queue: JobQueue) -> dict:
+    try:
+        return await queue.stats()
+    except (RedisError, OSError) as e:
+        return {"error": str(e)}
+
+
 def normalize_and_hash_query(query: str) -> str:
     # Normalize the query: lowercase, remove extra whitespace
     normalized_query = ' '.join(query.lower().split())
@@ -39,67 +163,426 @@ def normalize_and_hash_query(query: str) -> str:
     return hashlib.md5(normalized_query.encode('utf-8')).hexdigest()
 
 
-async def extract_matching_objects(self, matching_indices, search_results):
-    extracted_objects = {}
-    engines = ['amz', 'gs', 'gis', 'lens']
-
-    for index, engine in zip(matching_indices, engines):
-        print(f"Processing engine: {engine}, index: {index}")
-        if engine == 'amz':
-            results = self.cached_results.get(engine, {})
-            if results:
-                results = json.loads(results)
-                results = results['results'][0]['content']['results']
-                organic = results['results']['organic']
-                amazon_choice = results['results']['amazons_choices']
-                all_objects = organic + amazon_choice
-                for item in all_objects:
-                    if item.get('url_image') and item.get('pos') == index:
-                        full_url = f"https://www.amazon.com{item.get('url')}"
-                        extracted_objects['amazon'] = {
-                            'title': item.get('title'),
-                            'price': item.get('price'),
-                            'link': full_url,
-                            'image': item.get('url_image')
-                        }
-                        break
-            else:
-                print(f"No results found for engine {engine}")
-        elif engine == 'gs':
-            results = self.cached_results.get(engine, {})
-            if 'organic_results' in results:
-                for item in results['organic_results']:
-                    if 'thumbnail' in item and item.get('position') == index:
-                        extracted_objects['google_search'] = {
-                            'title': item.get('title'),
-                            'link': item.get('link'),
-                            'image': item.get('thumbnail')
-                        }
-                        break
-        elif engine == 'gis':
-            results = self.cached_results.get(engine, {})
-            if 'image_results' in results:
-                for item in results['image_results']:
-                    if 'thumbnail' in item and item.get('position') == index:
-                        extracted_objects['google_image_search'] = {
-                            'title': item.get('title'),
-                            'link': item.get('link'),
-                            'image': item.get('thumbnail')
-                        }
-                        break
-        elif engine == 'lens':
-            results = self.cached_results.get(engine, {})
-            if 'visual_matches' in results:
-                for item in results['visual_matches']:
-                    if 'thumbnail' in item and item.get('position') == index:
-                        extracted_objects['google_lens'] = {
-                            'title': item.get('title'),
-                            'link': item.get('link'),
-                            'image': item.get('thumbnail')
-                        }
-                        break
-
-    return extracted_objects
+async def matching_indices_from_gpt(services: dict, pending: dict[str, Gallery],
+                                    spent: list[int]) -> dict:
+    urls = {engine: gallery.url for engine, gallery in pending.items()}
+    matching_indices_json = await services["upstreams"].call(
+        "azure_openai", lambda: services["matching_service"].get_matching_images(urls))
+    record_matching(spent, len(urls), sum(gallery.tokens or 0 for gallery in pending.values()),
+                    sum(gallery.fixed_tokens or 0 for gallery in pending.values()))
+    return usable_reply(json.loads(matching_indices_json), list(pending.values()))
+
+
+async def match_packed(services: dict, galleries: list[Gallery], spent: list[int]) -> dict:
+    """GPT matching for unpublished galleries, packed onto planned sheets.
+
+    Cached by the sheets' content, so a repeat skips the upload as well.
+    """
+    image_service = services["image_service"]
+    plan, sheets = await image_service.pack_galleries(galleries)
+    key = matching_key({",".join(sheet.engines): hashlib.sha256(encoded).hexdigest()
+                        for sheet, encoded in zip(plan.sheets, sheets)})
+
+    async def compute():
+        urls = await asyncio.gather(*[image_service.publish(encoded) for encoded in sheets])
+        reply = await services["upstreams"].call(
+            "azure_openai", lambda: services["matching_service"].get_matching_sheets(
+                [(sheet.engines, url) for sheet, url in zip(plan.sheets, urls)]))
+        record_matching(spent, len(sheets), plan.tokens, plan.fixed_tokens)
+        return usable_reply(json.loads(reply), galleries)
+
+    return await services["stage_cache"].get_or_compute("matching", key, compute)
+
+
+def record_matching(spent: list[int], images: int, tokens: int, fixed: int):
+    """Count one GPT matching call's estimated image tokens."""
+    spent.append(tokens)
+    matching_stats["calls"] += 1
+    matching_stats["images"] += images
+    matching_stats["tokens"] += tokens
+    matching_stats["fixed_tokens"] += fixed
+
+
+async def build_cached_gallery(services: dict, engine: str, search_result,
+                               image_url: str, key: str, publish: bool = True) -> Gallery:
+    image_service = services["image_service"]
+    stage_cache = services["stage_cache"]
+    # Inline galleries are data: URLs; rebuilding them from the thumbnail
+    # cache is cheaper than storing megabytes per entry in Redis. Unpublished
+    # ones are only tiles, packed into sheets at the matching stage
+    if image_service.inline_galleries or not publish:
+        return await image_service.build_gallery(engine, search_result, image_url,
+                                                 publish=publish)
+
+    cached = await stage_cache.get("gallery", key)
+    if cached is not None:
+        return Gallery.from_dict(cached)
+    gallery = await image_service.build_gallery(engine, search_result, image_url)
+    await stage_cache.set("gallery", key, gallery.to_dict())
+    return gallery
+
+
+def matching_key(pending: dict[str, str]) -> str:
+    return hashlib.sha256(json.dumps(pending, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+async def match_gallery(services: dict, gallery: Gallery, spent: list[int]) -> Optional[int]:
+    """GPT matching for one engine's gallery, cached like the combined call.
+
+    Raises UnusableMatchError, and caches nothing, if GPT gives no index
+    drawn on the gallery.
+    """
+    pending = {gallery.engine: gallery.url}
+
+    async def compute():
+        index = await services["upstreams"].call(
+            "azure_openai",
+            lambda: services["matching_service"].get_matching_image(gallery.engine, gallery.url))
+        record_matching(spent, 1, gallery.tokens or 0, gallery.fixed_tokens or 0)
+        return usable_reply({gallery.engine: index}, [gallery])
+
+    indices = await services["stage_cache"].get_or_compute("matching", matching_key(pending), compute)
+    return match_index(indices, gallery.engine, gallery.labels)
+
+
+def decide(gallery: Gallery) -> Optional[MatchDecision]:
+    # Near-exact perceptual matches are decided locally; the rest need GPT.
+    # None when the engine returned nothing to match against
+    candidates = gallery.ranking.candidates if gallery.ranking else []
+    if gallery.decided_index is not None:
+        return MatchDecision(method="phash", index=gallery.decided_index,
+                             distance=gallery.ranking.exact_bits, candidates=candidates)
+    if gallery.url is not None or gallery.tiles:
+        return MatchDecision(method="llm", candidates=candidates)
+    return None
+
+
+def search_stages(services: dict, image_url: str) -> list[tuple]:
+    """(engine, search stage, needs the product query, upstream, search call) per engine.
+
+    Query-based engines are cached by the normalised query and must wait for
+    it; image-based engines are cached by the image and can start at once.
+    """
+    search_service = services["search_service"]
+    return [
+        ("amz", "amazon_search", True, "smartproxy",
+         lambda query: search_service.amazon_search(query)),
+        ("gs", "google_search", True, "serpapi_google",
+         lambda query: search_service.google_search(query)),
+        ("gis", "google_image_search", False, "serpapi_google_images",
+         lambda query: search_service.google_image_search(image_url)),
+        ("lens", "google_lens_search", False, "serpapi_google_lens",
+         lambda query: search_service.google_lens_search(image_url)),
+    ]
+
+
+def failure_reason(e: Exception) -> str:
+    if isinstance(e, asyncio.TimeoutError):
+        return "deadline exceeded"
+    return str(e) or type(e).__name__
+
+
+async def guarded(coro, timeout: float, failures: dict[str, str], name: str):
+    """Await `coro` within `timeout`; on any failure record why under `name`
+    and return None, so one engine cannot sink the whole search."""
+    try:
+        return await within(coro, timeout)
+    except Exception as e:
+        failures[name] = failure_reason(e)
+        print(f"{name} failed, continuing without it: {failures[name]}")
+        return None
+
+
+async def search_candidates(services: dict, engine: str, stage: str, key: str, upstream: str,
+                            search, deadline: Deadline) -> Candidates:
+    """One engine's search, parsed into candidates as soon as it returns.
+
+    The stage cache holds the parsed form, so the raw payload is dropped
+    here and never reaches Redis. An empty result raises NoCandidatesError
+    rather than being cached, outside the upstream call so it does not
+    count against the breaker.
+    """
+    async def compute():
+        payload = await services["upstreams"].call(upstream, search, deadline.engine_remaining())
+        candidates = parse_candidates(engine, payload)
+        if not candidates:
+            raise NoCandidatesError(engine)
+        return candidates.to_dict()
+
+    return Candidates.from_dict(await services["stage_cache"].get_or_compute(
+        stage, f"candidates:{key}", compute))
+
+
+def add_search_stages(graph: StageGraph, services: dict, image_url: str, image_key: str,
+                      product_query_task: Optional[asyncio.Task], deadline: Deadline,
+                      failures: dict[str, str], publish: bool = True) -> list[str]:
+    """Adds the product query, the four searches and their galleries to `graph`.
+
+    Stages are `product_query`, `<engine>_search` and `<engine>_gallery`;
+    returns the engine names. A stage that fails or misses its deadline
+    yields None and its reason goes into `failures`. Without `publish`,
+    galleries are left as tiles for `match_packed`.
+    """
+    graph.add("product_query", lambda: guarded(
+        product_query_stage(services, image_key, image_url, product_query_task),
+        deadline.remaining(), failures, "product_query"))
+
+    engines = []
+    for engine, stage, needs_query, upstream, search in search_stages(services, image_url):
+        if needs_query:
+            async def run_search_stage(product_query_data, engine=engine, stage=stage,
+                                       upstream=upstream, search=search):
+                if product_query_data is None:
+                    failures[engine] = "no product query"
+                    return None
+                query = product_query_data['query']
+                # Different photos of one product often produce the same query text
+                return await guarded(search_candidates(
+                    services, engine, stage, normalize_and_hash_query(query), upstream,
+                    lambda: search(query), deadline),
+                    deadline.engine_remaining(), failures, engine)
+
+            async def run_gallery_stage(search_result, product_query_data, engine=engine):
+                if search_result is None:
+                    return None
+                query_key = normalize_and_hash_query(product_query_data['query'])
+                return await guarded(build_cached_gallery(
+                    services, engine, search_result, image_url, f"{engine}:{query_key}:{image_key}",
+                    publish), deadline.engine_remaining(), failures, engine)
+
+            graph.add(f"{engine}_search", run_search_stage, "product_query")
+            graph.add(f"{engine}_gallery", run_gallery_stage, f"{engine}_search", "product_query")
+        else:
+            async def run_search_stage(engine=engine, stage=stage, upstream=upstream, search=search):
+                return await guarded(search_candidates(
+                    services, engine, stage, image_key, upstream, lambda: search(None), deadline),
+                    deadline.engine_remaining(), failures, engine)
+
+            async def run_gallery_stage(search_result, engine=engine):
+                if search_result is None:
+                    return None
+                return await guarded(build_cached_gallery(
+                    services, engine, search_result, image_url, f"{engine}:{image_key}", publish),
+                    deadline.engine_remaining(), failures, engine)
+
+            graph.add(f"{engine}_search", run_search_stage)
+            graph.add(f"{engine}_gallery", run_gallery_stage, f"{engine}_search")
+        engines.append(engine)
+    return engines
+
+
+async def ingest_upload(services: dict, contents: bytes) -> bytes:
+    """Downscale and re-encode an upload before it is hosted or shown to GPT."""
+    image_service = services["image_service"]
+    ingested = await image_service.ingest(contents)
+    if ingested is None:
+        return contents
+    resized = (ingested.width, ingested.height) != (ingested.original_width,
+                                                    ingested.original_height)
+    if not resized and len(ingested.data) >= len(contents):
+        # Already small; a re-encode would only lose quality
+        return contents
+
+    detail = image_service.product_query_detail
+    tokens_before = vision_tokens(ingested.original_width, ingested.original_height, detail)
+    tokens_after = vision_tokens(ingested.width, ingested.height, detail)
+    upload_stats["bytes_received"] += len(contents)
+    upload_stats["bytes_uploaded"] += len(ingested.data)
+    upload_stats["vision_tokens_saved"] += tokens_before - tokens_after
+    print(f"Ingested upload: {ingested.original_width}x{ingested.original_height} "
+          f"{len(contents)} B -> {ingested.width}x{ingested.height} {len(ingested.data)} B, "
+          f"~{tokens_before} -> ~{tokens_after} GPT image tokens")
+    return ingested.data
+
+
+async def host_upload(services: dict, contents: bytes, prefetch_query: bool = True):
+    """Returns (image_url, contents, content_hash, product_query_task) for uploaded bytes.
+
+    `contents` is the downscaled copy that was hosted, or the bytes as sent
+    if the same upload was hosted before.
+    """
+    product_query_task = None
+    # Identical bytes uploaded before: reuse the hosted copy. Its URL also
+    # keys the cached result, so a repeat upload returns below without
+    # uploading, calling GPT or searching
+    content_hash = hashlib.sha256(contents).hexdigest()
+    image_url = await redis_cache.get(f"hosted:{content_hash}")
+    if image_url is not None:
+        upload_stats["deduplicated"] += 1
+        return image_url, contents, content_hash, None
+
+    upload_stats["uploaded"] += 1
+    contents = await ingest_upload(services, contents)
+    # Convert uploaded image to URL using the image service
+    upload_task = asyncio.create_task(services["upstreams"].call(
+        "imgbb", lambda: services["image_service"].upload_image(
+            base64.b64encode(contents).decode('utf-8'))))
+    if prefetch_query and services["image_service"].inline_galleries:
+        # GPT reads the upload inline, so it does not wait for imgbb;
+        # the reverse-image engines still need the hosted URL
+        inline_url = await services["image_service"].inline_image(contents)
+        product_query_task = asyncio.create_task(services["upstreams"].call(
+            "azure_openai",
+            lambda: services["image_service"].get_product_query(inline_url)))
+    try:
+        image_url = await upload_task
+    except Exception:
+        if product_query_task is not None:
+            product_query_task.cancel()
+        raise
+    await redis_cache.setex(f"hosted:{content_hash}", HOSTED_IMAGE_TTL, image_url)
+    return image_url, contents, content_hash, product_query_task
+
+
+async def resolve_image_url(services: dict, image_url: Optional[str],
+                            image: Optional[UploadFile]):
+    """Returns (image_url, contents, content_hash, product_query_task)."""
+    product_query_task = None
+    contents = None
+    content_hash = None
+    if image:
+        image_url, contents, content_hash, product_query_task = await host_upload(
+            services, await image.read())
+
+    if image_url is None:
+        raise HTTPException(
+            status_code=500, detail="Failed to obtain image URL")
+    return image_url, contents, content_hash, product_query_task
+
+
+def result_cache_key(image_url: str) -> str:
+    return f"search:{hashlib.md5(image_url.encode()).hexdigest()}"
+
+
+async def find_similar_result(services: dict, image_url: str,
+                              contents: Optional[bytes]) -> tuple[Optional[int], Optional[dict]]:
+    """Returns (query pHash, cached result of a visually identical earlier query)."""
+    # A re-upload, resize or recompression of an earlier query image can
+    # reuse its cached result
+    query_phash = await services["image_service"].query_phash(image_url, contents)
+    if query_phash is not None:
+        query_index = services["query_index"]
+        match = await query_index.lookup(query_phash)
+        if match is not None:
+            _, indexed, cache_key = match
+            cached_result = await redis_cache.get(cache_key)
+            if cached_result:
+                query_index.hit()
+                return query_phash, json.loads(cached_result)
+            if not redis_cache.down:
+                # Evicted before its TTL; a miss while Redis is down says nothing
+                await query_index.discard(indexed)
+    return query_phash, None
+
+
+async def product_query_stage(services: dict, image_key: str, image_url: str,
+                              product_query_task: Optional[asyncio.Task]) -> dict:
+    stage_cache = services["stage_cache"]
+    product_query_data = await stage_cache.get("product_query", image_key)
+    if product_query_data is not None:
+        if product_query_task is not None:
+            product_query_task.cancel()
+        return product_query_data
+    if product_query_task is not None:
+        product_query_json = await product_query_task
+    else:
+        product_query_json = await services["upstreams"].call(
+            "azure_openai", lambda: services["image_service"].get_product_query(image_url))
+    product_query_data = json.loads(product_query_json)
+    await stage_cache.set("product_query", image_key, product_query_data)
+    return product_query_data
+
+
+def image_stage_key(image_url: str, content_hash: Optional[str]) -> str:
+    # Image-derived stages are keyed by the upload's bytes when we have them
+    return content_hash if content_hash is not None else hashlib.sha256(
+        image_url.encode('utf-8')).hexdigest()
+
+
+async def store_result(services: dict, cache_key: str, final_result: dict,
+                       query_phash: Optional[int]):
+    # Tokens were spent by this request only; a replay spends none
+    cached = {key: value for key, value in final_result.items() if key != "matching_tokens"}
+    await redis_cache.setex(cache_key, RESULT_TTL, json.dumps(cached))
+    if query_phash is not None:
+        await services["query_index"].add(query_phash, cache_key)
+
+
+async def match_galleries(services: dict, galleries, deadline: Deadline,
+                          failures: dict[str, str], spent: list[int]) -> tuple[dict, dict]:
+    """Returns (matching indices, decisions) by engine for the galleries that
+    were built; engines left undecided by a failed GPT call have no index."""
+    # Near-exact perceptual matches are decided locally; only the rest go to GPT
+    matching_indices = {}
+    decisions = {}
+    pending = {}
+    unpublished = []
+    for gallery in galleries:
+        if gallery is None:
+            continue
+        decision = decide(gallery)
+        if decision is None:
+            continue
+        decisions[gallery.engine] = decision
+        if decision.index is not None:
+            matching_indices[gallery.engine] = decision.index
+        elif gallery.url is not None:
+            pending[gallery.engine] = gallery
+        else:
+            unpublished.append(gallery)
+
+    # Get matching images
+    by_engine = {gallery.engine: gallery for gallery in galleries if gallery is not None}
+    replies = []
+    if pending:
+        replies.append((pending, await guarded(services["stage_cache"].get_or_compute(
+            "matching", matching_key({engine: gallery.url for engine, gallery in pending.items()}),
+            lambda: matching_indices_from_gpt(services, pending, spent)),
+            deadline.remaining(), failures, "matching")))
+    if unpublished:
+        replies.append(([gallery.engine for gallery in unpublished], await guarded(
+            match_packed(services, unpublished, spent),
+            deadline.remaining(), failures, "matching")))
+    for engines, reply in replies:
+        if reply is None:
+            # The call failed; already recorded under "matching"
+            continue
+        for engine in engines:
+            index = match_index(reply, engine, by_engine[engine].labels)
+            if index is None:
+                failures[engine] = f"no usable match index from GPT: {reply_value(reply, engine)!r}"
+                continue
+            matching_indices[engine] = index
+            decisions[engine].index = index
+    return matching_indices, decisions
+
+
+def reply_value(reply, engine: str):
+    return reply.get(engine) if isinstance(reply, dict) else reply
+
+
+def match_index(reply, engine: str, labels: Optional[list[int]] = None) -> Optional[int]:
+    """The gallery index GPT picked for `engine`; None if the reply has none,
+    it is not an integer (null, "none", a list...) or it is not one of the
+    candidate `labels` drawn on the gallery (the query image, 0, never is)."""
+    value = reply_value(reply, engine)
+    if isinstance(value, bool):
+        return None
+    try:
+        index = int(value)
+    except (TypeError, ValueError):
+        return None
+    if index < 1 or (labels is not None and index not in labels[1:]):
+        return None
+    return index
+
+
+def usable_reply(reply, galleries: list[Gallery]):
+    """`reply`, unless no gallery got a usable index from it: then raise, so
+    the stage cache does not replay it on every retry of these galleries."""
+    if all(match_index(reply, gallery.engine, gallery.labels) is None for gallery in galleries):
+        raise UnusableMatchError(reply)
+    return reply
 
 
 @app.post("/search", response_model=SearchResult)
@@ -116,76 +599,395 @@ async def reverse_search(
         raise HTTPException(
             status_code=400, detail="Either image_url or image file must be provided")
 
-    if image:
-        # Convert uploaded image to URL using the image service
-        image_url = await services["image_service"].upload_image(image)
+    image_url, contents, content_hash, product_query_task = await resolve_image_url(
+        services, image_url, image)
+    return SearchResult(**await search_image(
+        services, image_url, contents, content_hash, product_query_task))
 
-    if image_url is None:
-        raise HTTPException(
-            status_code=500, detail="Failed to obtain image URL")
 
+async def search_image(services: dict, image_url: str, contents: Optional[bytes],
+                       content_hash: Optional[str],
+                       product_query_task: Optional[asyncio.Task]) -> dict:
+    """Cached result for the image, or one coalesced run of the pipeline."""
     # Generate cache key
-    cache_key = f"search:{hashlib.md5(image_url.encode()).hexdigest()}"
+    cache_key = result_cache_key(image_url)
 
     # Check if results are cached
-    cached_result = redis_client.get(cache_key)
+    cached_result = await redis_cache.get(cache_key)
     if cached_result:
-        return SearchResult(**json.loads(cached_result))
+        result_stats["hit"] += 1
+        if product_query_task is not None:
+            product_query_task.cancel()
+        return json.loads(cached_result)
+    result_stats["miss"] += 1
 
+    # Concurrent requests for the same image share one pipeline run
     try:
-        # Get product query
-        product_query_json = await services["image_service"].get_product_query(image_url)
-        product_query_data = json.loads(product_query_json)
-        query = product_query_data['query']
-
-        # Perform searches
-        amazon_result, google_result, gis_result, lens_result = await asyncio.gather(
-            services["search_service"].amazon_search(query),
-            services["search_service"].google_search(query),
-            services["search_service"].google_image_search(image_url),
-            services["search_service"].google_lens_search(image_url)
-        )
+        return await services["single_flight"].do(
+            cache_key,
+            lambda: run_search(services, image_url, cache_key, contents,
+                               content_hash, product_query_task),
+            result_key=cache_key)
+    finally:
+        # A follower's own early product-query call is no longer needed
+        if product_query_task is not None and not product_query_task.done():
+            product_query_task.cancel()
 
-        # Concatenate thumbnails
-        image_bundle = await asyncio.gather(
-            services["image_service"].concatenate_thumbnails(
-                "amz", amazon_result, image_url),
-            services["image_service"].concatenate_thumbnails(
-                "gs", google_result, image_url),
-            services["image_service"].concatenate_thumbnails(
-                "gis", gis_result, image_url),
-            services["image_service"].concatenate_thumbnails(
-                "lens", lens_result, image_url)
-        )
 
-        # Get matching images
-        matching_indices_json = await services["matching_service"].get_matching_images(image_bundle)
-        matching_indices = json.loads(matching_indices_json)
+async def run_search(services: dict, image_url: str, cache_key: str,
+                     contents: Optional[bytes], content_hash: Optional[str],
+                     product_query_task: Optional[asyncio.Task]) -> dict:
+    query_phash, similar_result = await find_similar_result(services, image_url, contents)
+    if similar_result is not None:
+        if product_query_task is not None:
+            product_query_task.cancel()
+        return similar_result
+
+    image_key = image_stage_key(image_url, content_hash)
+
+    # Each stage starts as soon as its inputs are ready: the image-based
+    # searches run alongside the product query, and each gallery is built
+    # as soon as its own engine's search returns
+    graph = StageGraph()
+    # Engines that fail or miss their deadline are left out of the result
+    # instead of failing the request
+    deadline = Deadline(SEARCH_BUDGET_SECONDS, ENGINE_DEADLINE_SECONDS)
+    failures: dict[str, str] = {}
+    spent: list[int] = []
+    engines = add_search_stages(graph, services, image_url, image_key, product_query_task,
+                                deadline, failures,
+                                publish=not (GALLERY_PACKING and services["image_service"].planned_layout))
+    graph.add("matching",
+              lambda *galleries: match_galleries(services, galleries, deadline, failures, spent),
+              *[f"{engine}_gallery" for engine in engines])
+
+    try:
+        results = await graph.run()
+        product_query_data = results["product_query"]
+        query = product_query_data['query'] if product_query_data is not None else ""
+        search_results = {engine: results[f"{engine}_search"] for engine in engines
+                          if results[f"{engine}_search"] is not None}
+        matching_indices, decisions = results["matching"]
 
         # Extract matching objects
-        search_results = {
-            "amz": amazon_result,
-            "gs": google_result,
-            "gis": gis_result,
-            "lens": lens_result
-        }
         matching_objects = await services["matching_service"].extract_matching_objects(
-            list(matching_indices.values()), search_results
+            matching_indices, search_results
         )
 
         # Prepare final result
         final_result = {
             "query": query,
             "original_image": image_url,
-            "matches": matching_objects
+            "matches": matching_objects,
+            "decisions": {engine: decision.model_dump()
+                          for engine, decision in decisions.items()},
+            "errors": dict(failures),
+            "matching_tokens": sum(spent),
         }
 
-        # Cache the results
-        redis_client.setex(cache_key, 3600, json.dumps(
-            final_result))  # Cache for 1 hour
-
-        return SearchResult(**final_result)
+        # Cache the results; partial ones are not, but their completed
+        # stages are, so a retry only redoes what failed
+        if not failures:
+            await store_result(services, cache_key, final_result, query_phash)
 
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Failed to process search: {str(e)}")
+    finally:
+        stage_timings.record(graph)
+        metrics.record_graph(graph)
+
+    if all(engine in failures for engine in engines):
+        raise HTTPException(
+            status_code=502, detail=f"Failed to process search: every engine failed: {failures}")
+    return final_result
+
+
+def ndjson(event: dict) -> bytes:
+    return (json.dumps(event) + "\n").encode('utf-8')
+
+
+@app.post("/search/stream")
+async def reverse_search_stream(
+    image_url: Optional[str] = Query(
+        None, description="URL of the image to search"),
+    description: Optional[str] = Query(
+        None, description="Optional description of the image"),
+    image: Optional[UploadFile] = File(
+        None, description="Image file to upload"),
+    services: dict = Depends(get_services)
+):
+    """Same search as /search, streamed as NDJSON events.
+
+    Emits `query` once the product query is known, then one `match` per
+    engine as soon as that engine is searched, rendered and matched (each
+    engine gets its own GPT call), then `done` with the full SearchResult.
+    A failing engine yields an `error` event and the others carry on.
+    """
+    if image_url is None and image is None:
+        raise HTTPException(
+            status_code=400, detail="Either image_url or image file must be provided")
+
+    image_url, contents, content_hash, product_query_task = await resolve_image_url(
+        services, image_url, image)
+    return StreamingResponse(
+        stream_search(services, image_url, contents, content_hash, product_query_task),
+        media_type="application/x-ndjson")
+
+
+async def match_engine(services: dict, engine: str, search_result, gallery: Optional[Gallery],
+                       deadline: Deadline, failures: dict[str, str], spent: list[int]):
+    if gallery is None:
+        # The search or gallery already failed; `failures` says why
+        return {}, None
+    decision = decide(gallery)
+    if decision is not None and decision.index is None:
+        decision.index = await guarded(match_gallery(services, gallery, spent),
+                                       deadline.remaining(), failures, engine)
+        if decision.index is None and engine not in failures:
+            # Like match_galleries: an engine GPT could not match is a failure,
+            # so the result is reported partial and not cached as complete
+            failures[engine] = "no usable match index from GPT"
+    matches = {}
+    if decision is not None and decision.index is not None:
+        matches = await services["matching_service"].extract_matching_objects(
+            {engine: decision.index}, {engine: search_result})
+    return matches, decision
+
+
+async def stream_search(services: dict, image_url: str, contents: Optional[bytes],
+                        content_hash: Optional[str],
+                        product_query_task: Optional[asyncio.Task]):
+    cache_key = result_cache_key(image_url)
+    graph = StageGraph()
+    try:
+        cached_result = await redis_cache.get(cache_key)
+        query_phash = None
+        if cached_result:
+            final_result = json.loads(cached_result)
+        else:
+            query_phash, final_result = await find_similar_result(services, image_url, contents)
+        if final_result is not None:
+            # Replay a cached result in the same event shape
+            yield ndjson({"event": "query", "query": final_result["query"],
+                          "original_image": final_result["original_image"]})
+            for engine, decision in final_result.get("decisions", {}).items():
+                result_key = RESULT_KEYS.get(engine)
+                matches = {result_key: final_result["matches"][result_key]} \
+                    if result_key in final_result["matches"] else {}
+                yield ndjson({"event": "match", "engine": engine,
+                              "matches": matches, "decision": decision})
+            yield ndjson({"event": "done", "result": final_result})
+            return
+
+        image_key = image_stage_key(image_url, content_hash)
+        deadline = Deadline(SEARCH_BUDGET_SECONDS, ENGINE_DEADLINE_SECONDS)
+        failures: dict[str, str] = {}
+        spent: list[int] = []
+        engines = add_search_stages(graph, services, image_url, image_key, product_query_task,
+                                    deadline, failures)
+        for engine in engines:
+            graph.add(f"{engine}_match",
+                      lambda search_result, gallery, engine=engine: match_engine(
+                          services, engine, search_result, gallery, deadline, failures, spent),
+                      f"{engine}_search", f"{engine}_gallery")
+        graph.start()
+
+        product_query_data = await graph.task("product_query")
+        if product_query_data is None:
+            # The image-based engines still run without it
+            yield ndjson({"event": "error", "stage": "product_query",
+                          "detail": f"Failed to get product query: {failures['product_query']}"})
+            query = ""
+        else:
+            query = product_query_data['query']
+            yield ndjson({"event": "query", "query": query, "original_image": image_url})
+
+        matches = {}
+        decisions = {}
+        tasks = {graph.task(f"{engine}_match"): engine for engine in engines}
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                engine = tasks[task]
+                try:
+                    engine_matches, decision = task.result()
+                except Exception as e:
+                    failures[engine] = failure_reason(e)
+                if engine in failures:
+                    yield ndjson({"event": "error", "engine": engine,
+                                  "detail": f"Failed to process {engine}: {failures[engine]}"})
+                    continue
+                matches.update(engine_matches)
+                if decision is not None:
+                    decisions[engine] = decision.model_dump()
+                yield ndjson({"event": "match", "engine": engine, "matches": engine_matches,
+                              "decision": decisions.get(engine)})
+
+        final_result = {
+            "query": query,
+            "original_image": image_url,
+            "matches": matches,
+            "decisions": decisions,
+            "errors": dict(failures),
+            "matching_tokens": sum(spent),
+        }
+        # Only complete results are cached
+        if not failures:
+            await store_result(services, cache_key, final_result, query_phash)
+        yield ndjson({"event": "done", "result": SearchResult(**final_result).model_dump()})
+    finally:
+        # The client went away or we are done: stop any stage still running
+        graph.cancel()
+        stage_timings.record(graph)
+        metrics.record_graph(graph)
+        if product_query_task is not None and not product_query_task.done():
+            product_query_task.cancel()
+
+
+@app.post("/search/batch")
+async def reverse_search_batch(
+    image_urls: Optional[list[str]] = Form(
+        None, description="URLs of the images to search"),
+    images: Optional[list[UploadFile]] = File(
+        None, description="Image files to upload"),
+    services: dict = Depends(get_services)
+):
+    """Searches many images in one request, streamed back as NDJSON.
+
+    Items are numbered URLs first, then uploads. Exact repeats (same URL or
+    same bytes) run once; items whose product queries normalise to the same
+    text share the Amazon/Google searches through the stage cache. At most
+    BATCH_CONCURRENCY items run at a time. Emits an `item` event per input
+    as soon as it is done (`duplicate_of` marks repeats), then `done`.
+    Uploads may total at most BATCH_MAX_BYTES.
+    """
+    urls = image_urls or []
+    uploads = images or []
+    if not urls and not uploads:
+        raise HTTPException(
+            status_code=400, detail="Either image_urls or image files must be provided")
+    if len(urls) + len(uploads) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413, detail=f"A batch holds at most {BATCH_MAX_ITEMS} images")
+
+    too_large = HTTPException(
+        status_code=413, detail=f"A batch's uploads total at most {BATCH_MAX_BYTES} bytes")
+    if sum(upload.size or 0 for upload in uploads) > BATCH_MAX_BYTES:
+        raise too_large
+
+    # Uploads are read now; the request body is gone once streaming starts.
+    # Repeats are kept once, by hash, and each is released when its item starts
+    sources = [("url", url) for url in urls]
+    contents: dict[str, bytes] = {}
+    total = 0
+    for upload in uploads:
+        data = await upload.read()
+        total += len(data)
+        if total > BATCH_MAX_BYTES:
+            raise too_large
+        content_hash = hashlib.sha256(data).hexdigest()
+        contents.setdefault(content_hash, data)
+        sources.append(("upload", content_hash))
+    return StreamingResponse(stream_batch(services, sources, contents),
+                             media_type="application/x-ndjson")
+
+
+async def search_batch_item(services: dict, kind: str, value) -> tuple[int, Any]:
+    """Returns (status code, SearchResult dict or error detail)."""
+    try:
+        if kind == "upload":
+            image_url, contents, content_hash, product_query_task = await host_upload(
+                services, value)
+            result = await search_image(services, image_url, contents, content_hash,
+                                        product_query_task)
+        else:
+            result = await search_image(services, value, None, None, None)
+        return 200, SearchResult(**result).model_dump()
+    except HTTPException as e:
+        return e.status_code, e.detail
+    except Exception as e:
+        return 500, f"Failed to process search: {str(e)}"
+
+
+async def stream_batch(services: dict, sources: list[tuple[str, str]],
+                       contents: dict[str, bytes]):
+    """`sources` are ("url", url) or ("upload", sha256 of the bytes in `contents`)."""
+    groups: dict[str, list[int]] = {}
+    for index, (kind, value) in enumerate(sources):
+        key = f"url:{value}" if kind == "url" else f"sha256:{value}"
+        groups.setdefault(key, []).append(index)
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run_group(indices: list[int]):
+        async with semaphore:
+            kind, value = sources[indices[0]]
+            if kind == "upload":
+                value = contents.pop(value)
+            return indices, *await search_batch_item(services, kind, value)
+
+    tasks = [asyncio.create_task(run_group(indices)) for indices in groups.values()]
+    queries = set()
+    failed = 0
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            indices, status, payload = await next_done
+            if status == 200:
+                queries.add(normalize_and_hash_query(payload["query"]))
+            else:
+                failed += len(indices)
+            for index in indices:
+                event = {"event": "item", "index": index, "status": status}
+                if index != indices[0]:
+                    event["duplicate_of"] = indices[0]
+                event["result" if status == 200 else "detail"] = payload
+                yield ndjson(event)
+        yield ndjson({"event": "done", "items": len(sources), "unique_items": len(groups),
+                      "distinct_queries": len(queries), "failed": failed})
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    image_url: Optional[str] = Query(
+        None, description="URL of the image to search"),
+    description: Optional[str] = Query(
+        None, description="Optional description of the image"),
+    image: Optional[UploadFile] = File(
+        None, description="Image file to upload"),
+    services: dict = Depends(get_services)
+):
+    """Queues a search for the worker processes (worker.py) and returns its id."""
+    if image_url is None and image is None:
+        raise HTTPException(
+            status_code=400, detail="Either image_url or image file must be provided")
+
+    content_hash = None
+    if image:
+        # Host the upload here so the job only carries a URL
+        image_url, _, content_hash, _ = await host_upload(
+            services, await image.read(), prefetch_query=False)
+
+    try:
+        job_id = await services["job_queue"].enqueue(
+            {"image_url": image_url, "content_hash": content_hash})
+    except (RedisError, OSError) as e:
+        raise HTTPException(
+            status_code=503, detail=f"Job queue unavailable: {str(e)}")
+    return {"id": job_id, "status": "queued"}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, services: dict = Depends(get_services)):
+    try:
+        job = await services["job_queue"].get(job_id)
+    except (RedisError, OSError) as e:
+        raise HTTPException(
+            status_code=503, detail=f"Job queue unavailable: {str(e)}")
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
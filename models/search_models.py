@@ -1,11 +1,31 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, Union
 
 class SearchRequest(BaseModel):
     image_url: str
     description: Optional[str] = None
 
+class MatchedProduct(BaseModel):
+    title: Optional[str] = None
+    link: Optional[str] = None
+    image: Optional[str] = None
+    price: Optional[Union[float, str]] = None
+
+class MatchDecision(BaseModel):
+    # 'phash' when a near-exact perceptual match skipped GPT, 'llm' otherwise
+    method: str
+    index: Optional[int] = None
+    # Hamming distance of the pHash match, for 'phash' decisions
+    distance: Optional[int] = None
+    # Gallery indices sent to GPT, closest first, with their perceptual distance
+    candidates: list[tuple[int, float]] = []
+
 class SearchResult(BaseModel):
-    title: str
-    link: str
-    image: str
+    query: str
+    original_image: str
+    matches: dict[str, MatchedProduct]
+    decisions: dict[str, MatchDecision] = {}
+    # Stage or engine -> why it is missing (deadline, open circuit, error)
+    errors: dict[str, str] = {}
+    # Estimated GPT image tokens of the matching calls this request made; 0 when cached or decided by pHash
+    matching_tokens: int = 0
@@ -0,0 +1,182 @@
+import os
+import time
+from typing import Any, Optional
+from dotenv import load_dotenv
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+
+load_dotenv()
+
+
+class RedisCache:
+    """Non-blocking Redis access shared by every cache in the app.
+
+    Wraps two `redis.asyncio` clients on shared connection pools: `text`
+    (decoded str values, used for JSON) and `binary` (raw bytes, used for
+    thumbnail tiles). The helpers fail soft: if Redis is unreachable they
+    return misses and swallow writes, and stop trying for
+    REDIS_RETRY_SECONDS so a dead Redis does not add a timeout to every call.
+    """
+
+    RELEASE_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end"
+    )
+
+    def __init__(self):
+        self.host = os.getenv('REDIS_HOST', '0.0.0.0')
+        self.port = int(os.getenv('REDIS_PORT', '6379'))
+        self.db = int(os.getenv('REDIS_DB', '0'))
+        self.retry_seconds = float(os.getenv('REDIS_RETRY_SECONDS', '5'))
+        pool_kwargs = dict(
+            host=self.host,
+            port=self.port,
+            db=self.db,
+            password=os.getenv('REDIS_PASSWORD') or None,
+            max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', '50')),
+            socket_timeout=float(os.getenv('REDIS_SOCKET_TIMEOUT', '0.5')),
+            socket_connect_timeout=float(os.getenv('REDIS_CONNECT_TIMEOUT', '0.5')),
+        )
+        self.text = aioredis.Redis(connection_pool=aioredis.ConnectionPool(
+            decode_responses=True, **pool_kwargs))
+        self.binary = aioredis.Redis(connection_pool=aioredis.ConnectionPool(
+            decode_responses=False, **pool_kwargs))
+
+        self._down_until = 0.0
+        self.errors = 0
+        self.skipped = 0
+
+    async def close(self):
+        await self.text.aclose()
+        await self.binary.aclose()
+
+    @property
+    def available(self) -> bool:
+        if time.monotonic() < self._down_until:
+            self.skipped += 1
+            return False
+        return True
+
+    @property
+    def down(self) -> bool:
+        """Whether a recent error has the helpers skipping Redis."""
+        return time.monotonic() < self._down_until
+
+    def _failed(self, operation: str, error: Exception):
+        self.errors += 1
+        self._down_until = time.monotonic() + self.retry_seconds
+        print(f"Redis {operation} failed, continuing uncached: {str(error)}")
+
+    async def get(self, key: str) -> Optional[str]:
+        if not self.available:
+            return None
+        try:
+            return await self.text.get(key)
+        except (RedisError, OSError) as e:
+            self._failed("get", e)
+            return None
+
+    async def get_bytes(self, key: str) -> Optional[bytes]:
+        """`get` on the binary client, for raw payloads like thumbnail tiles."""
+        if not self.available:
+            return None
+        try:
+            return await self.binary.get(key)
+        except (RedisError, OSError) as e:
+            self._failed("get", e)
+            return None
+
+    async def setex_bytes(self, key: str, ttl: int, value: bytes):
+        if not self.available:
+            return
+        try:
+            await self.binary.setex(key, ttl, value)
+        except (RedisError, OSError) as e:
+            self._failed("setex", e)
+
+    async def mget_bytes(self, keys: list[str]) -> list[Optional[bytes]]:
+        """`get_bytes` for several keys in one MGET round trip."""
+        if not keys or not self.available:
+            return [None] * len(keys)
+        try:
+            return await self.binary.mget(keys)
+        except (RedisError, OSError) as e:
+            self._failed("mget", e)
+            return [None] * len(keys)
+
+    async def setex_many_bytes(self, items: list[tuple[str, int, bytes]]):
+        """SETEX several (key, ttl, value) entries in one pipelined round trip."""
+        if not items or not self.available:
+            return
+        try:
+            async with self.binary.pipeline(transaction=False) as pipe:
+                for key, ttl, value in items:
+                    pipe.setex(key, ttl, value)
+                await pipe.execute()
+        except (RedisError, OSError) as e:
+            self._failed("pipeline", e)
+
+    async def setex(self, key: str, ttl: int, value: str):
+        if not self.available:
+            return
+        try:
+            await self.text.setex(key, ttl, value)
+        except (RedisError, OSError) as e:
+            self._failed("setex", e)
+
+    async def hgetall(self, key: str) -> dict[str, Any]:
+        if not self.available:
+            return {}
+        try:
+            return await self.text.hgetall(key)
+        except (RedisError, OSError) as e:
+            self._failed("hgetall", e)
+            return {}
+
+    async def hset(self, key: str, field: str, value: str):
+        if not self.available:
+            return
+        try:
+            await self.text.hset(key, field, value)
+        except (RedisError, OSError) as e:
+            self._failed("hset", e)
+
+    async def eval(self, script: str, keys: list[str], args: list[Any]) -> Optional[Any]:
+        """Run a Lua script; None when Redis is unavailable."""
+        if not self.available:
+            return None
+        try:
+            return await self.text.eval(script, len(keys), *keys, *args)
+        except (RedisError, OSError) as e:
+            self._failed("eval", e)
+            return None
+
+    async def acquire_lock(self, key: str, token: str, ttl: int) -> bool:
+        """SET NX with a TTL. Returns True when Redis is down: with no way
+        to coordinate, every caller goes ahead on its own."""
+        if not self.available:
+            return True
+        try:
+            return bool(await self.text.set(key, token, nx=True, ex=ttl))
+        except (RedisError, OSError) as e:
+            self._failed("lock", e)
+            return True
+
+    async def release_lock(self, key: str, token: str):
+        """Delete the lock only if we still hold it (it may have expired
+        and been taken by another worker)."""
+        if not self.available:
+            return
+        try:
+            await self.text.eval(self.RELEASE_SCRIPT, 1, key, token)
+        except (RedisError, OSError) as e:
+            self._failed("unlock", e)
+
+    def stats(self) -> dict:
+        return {
+            "host": f"{self.host}:{self.port}/{self.db}",
+            "errors": self.errors,
+            "skipped_while_down": self.skipped,
+            "down": self.down,
+        }
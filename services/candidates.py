@@ -0,0 +1,111 @@
+"""Search results parsed once into compact records, indexed by gallery slot.
+
+Each engine's payload (Amazon's raw scrape text, SerpAPI's result dicts) is
+parsed as soon as it arrives into a `Candidates` list holding only the
+fields the pipeline uses. Gallery slot 0 is the query image and slot `i`
+is the `i`-th result with a thumbnail, so the grid is drawn from the same
+list the match is later read from, in O(1), and the raw payload can be
+dropped straight away.
+"""
+import json
+from typing import Any, Optional, Union
+
+# Slots in one gallery: the query image plus 25 candidates
+GALLERY_SLOTS = 26
+
+
+class NoCandidatesError(Exception):
+    """An engine's search came back without any result we can draw."""
+
+    def __init__(self, engine: str):
+        super().__init__(f"{engine} returned no results")
+        self.engine = engine
+
+
+class Candidate:
+    __slots__ = ('engine', 'position', 'title', 'link', 'price', 'thumbnail')
+
+    def __init__(self, engine: str, position: Optional[int], title: Optional[str],
+                 link: Optional[str], price: Optional[Union[float, str]], thumbnail: str):
+        self.engine = engine
+        self.position = position
+        self.title = title
+        self.link = link
+        self.price = price
+        self.thumbnail = thumbnail
+
+    def to_match(self) -> dict[str, Any]:
+        """The MatchedProduct fields for this candidate."""
+        return {'title': self.title, 'price': self.price, 'link': self.link,
+                'image': self.thumbnail}
+
+    def __repr__(self) -> str:
+        return f"Candidate({self.engine!r}, position={self.position!r}, title={self.title!r})"
+
+
+class Candidates:
+    """One engine's results; `slot(i)` is the candidate drawn with label i."""
+
+    __slots__ = ('engine', 'items')
+
+    def __init__(self, engine: str, items: list[Candidate]):
+        self.engine = engine
+        self.items = items[:GALLERY_SLOTS - 1]
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def slot(self, index: int) -> Optional[Candidate]:
+        if 1 <= index <= len(self.items):
+            return self.items[index - 1]
+        return None
+
+    def thumbnails(self, image_url: str) -> list[str]:
+        return [image_url] + [item.thumbnail for item in self.items]
+
+    def to_dict(self) -> dict[str, Any]:
+        # Positional rows keep the cached form small
+        return {"engine": self.engine,
+                "items": [[item.position, item.title, item.link, item.price, item.thumbnail]
+                          for item in self.items]}
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "Candidates":
+        engine = data["engine"]
+        return cls(engine, [Candidate(engine, *row) for row in data["items"]])
+
+
+def _serp_price(price) -> Optional[Union[float, str]]:
+    # Lens reports {"value": "$19.99", "extracted_value": 19.99, ...}
+    if isinstance(price, dict):
+        return price.get('value') or price.get('extracted_value')
+    return price
+
+
+def _serp_candidates(engine: str, results: list[dict]) -> list[Candidate]:
+    return [Candidate(engine, item.get('position'), item.get('title'), item.get('link'),
+                      _serp_price(item.get('price')), item['thumbnail'])
+            for item in results if item.get('thumbnail')]
+
+
+def parse_candidates(engine: str, payload) -> Candidates:
+    """Parse an engine's raw search response; `payload` is not kept."""
+    if engine == 'amz':
+        data = json.loads(payload) if isinstance(payload, (str, bytes)) else payload
+        results = data['results'][0]['content']['results']['results']
+        items = [
+            Candidate(engine, item.get('pos'), item.get('title'),
+                      f"https://www.amazon.com{item.get('url')}", item.get('price'),
+                      item['url_image'])
+            for item in results['organic'] + results['amazons_choices']
+            if item.get('url_image')
+        ]
+    elif engine == 'gs':
+        items = _serp_candidates(engine, payload.get('organic_results', []))
+    elif engine == 'gis':
+        items = _serp_candidates(engine, payload.get('image_results', []))
+    elif engine == 'lens':
+        items = _serp_candidates(engine, payload.get('visual_matches', []))
+    else:
+        raise ValueError(f"Unknown engine: {engine}")
+    return Candidates(engine, items)
@@ -0,0 +1,165 @@
+"""Gallery sheet layouts sized to how GPT-4o bills images.
+
+GPT-4o charges a flat 85 tokens per image plus 170 per 512px tile of the
+image as it sees it (after fitting it in 2048x2048 and scaling its short
+side down to 768). A fixed 6-column grid of 150px cells pays for whole
+tiles it barely uses, and four galleries sent as four images pay the flat
+fee four times. The planner picks the tile size, the number of columns and
+which galleries share a sheet so the total is smallest. Labels stay
+readable because a sheet is never larger than the model would leave it,
+so it is never scaled down, and tiles never go below a minimum size.
+
+Both are off by default: GALLERY_LAYOUT=planned draws planned sheets,
+and GALLERY_PACKING=1 also packs /search's galleries together. The only
+check so far is benchmarks.layout_quality's offline proxy; turn them on
+once its `--gpt` run on the fixture set shows no loss in match accuracy.
+"""
+import math
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Iterator, Optional
+
+from services.grid_renderer import HEADER_HEIGHT, LABEL_HEIGHT, TILE_SIZE
+
+# Tile edges tried, largest first
+TILE_SIZES = (150, 136, 128, 120, 112, 104, 96, 88, 80)
+
+# The layout galleries used before planning: 6 columns of 150px cells
+FIXED_COLUMNS = 6
+
+
+def vision_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """Estimated GPT-4o image input tokens for an image of this size.
+
+    `low` is a flat 85. Otherwise the image is fitted in 2048x2048, its
+    short side scaled to 768, and each 512px tile costs 170 on top of 85
+    ('auto' is counted as 'high').
+    """
+    if detail == "low" or not width or not height:
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def seen_unscaled(width: int, height: int, detail: str = "auto") -> bool:
+    """Whether the model sees the image at the size it was drawn."""
+    if detail == "low":
+        return max(width, height) <= 512
+    return max(width, height) <= 2048 and min(width, height) <= 768
+
+
+@dataclass
+class SheetLayout:
+    """One image sent to GPT: galleries stacked top to bottom on a shared grid."""
+    engines: list[str]
+    counts: list[int]
+    tile_size: int
+    columns: int
+    tokens: int = 0
+
+    @property
+    def headed(self) -> bool:
+        # A lone gallery is drawn bare, as it always was
+        return len(self.engines) > 1
+
+    @property
+    def width(self) -> int:
+        return self.columns * self.tile_size
+
+    @property
+    def height(self) -> int:
+        cell = self.tile_size + LABEL_HEIGHT
+        header = HEADER_HEIGHT if self.headed else 0
+        return sum(header + math.ceil(count / self.columns) * cell for count in self.counts)
+
+    def to_dict(self) -> dict:
+        return {"engines": self.engines, "tile_size": self.tile_size, "columns": self.columns,
+                "width": self.width, "height": self.height, "tokens": self.tokens}
+
+
+@dataclass
+class PackingPlan:
+    sheets: list[SheetLayout]
+    # What the same galleries cost as separate fixed 6-column grids
+    fixed_tokens: int
+
+    @property
+    def tokens(self) -> int:
+        return sum(sheet.tokens for sheet in self.sheets)
+
+
+def fixed_tokens(count: int, detail: str = "auto") -> int:
+    # GridRenderer's fixed grid was always the full six columns wide
+    rows = math.ceil(count / FIXED_COLUMNS)
+    return vision_tokens(FIXED_COLUMNS * TILE_SIZE, rows * (TILE_SIZE + LABEL_HEIGHT), detail)
+
+
+def plan_sheet(engines: list[str], counts: list[int], min_tile: int = 96,
+               detail: str = "auto") -> Optional[SheetLayout]:
+    """The cheapest readable layout putting these galleries on one sheet,
+    or None if they do not fit on one."""
+    best = None
+    for tile_size in TILE_SIZES:
+        if tile_size < min_tile:
+            break
+        for columns in range(1, max(counts) + 1):
+            sheet = SheetLayout(engines, counts, tile_size, columns)
+            if not seen_unscaled(sheet.width, sheet.height, detail):
+                continue
+            sheet.tokens = vision_tokens(sheet.width, sheet.height, detail)
+            # Fewest tokens, then the biggest tiles, then the smallest canvas
+            key = (sheet.tokens, -tile_size, sheet.width * sheet.height)
+            if best is None or key < best[0]:
+                best = (key, sheet)
+    return best[1] if best is not None else None
+
+
+def partitions(items: list[str]) -> Iterator[list[list[str]]]:
+    """Every way to split `items` into groups (15 for four engines)."""
+    if not items:
+        yield []
+        return
+    first, rest = items[0], items[1:]
+    for partition in partitions(rest):
+        yield [[first]] + partition
+        for i in range(len(partition)):
+            yield partition[:i] + [[first] + partition[i]] + partition[i + 1:]
+
+
+def plan_packing(counts: dict[str, int], min_tile: int = 96, detail: str = "auto",
+                 pack: bool = True) -> PackingPlan:
+    """Split galleries (engine -> tile count, query tile included) into the
+    sheets that cost the fewest tokens; with `pack` off, one sheet each."""
+    # A few milliseconds of search, and the same handful of counts recur
+    return _plan_packing(tuple(counts.items()), min_tile, detail, pack)
+
+
+@lru_cache(maxsize=1024)
+def _plan_packing(items: tuple[tuple[str, int], ...], min_tile: int, detail: str,
+                  pack: bool) -> PackingPlan:
+    counts = dict(items)
+    engines = [engine for engine, count in counts.items() if count > 0]
+    fixed = sum(fixed_tokens(counts[engine], detail) for engine in engines)
+    groupings = partitions(engines) if pack else [[[engine] for engine in engines]]
+    best = None
+    for grouping in groupings:
+        sheets = []
+        for group in grouping:
+            sheet = plan_sheet(group, [counts[engine] for engine in group], min_tile, detail)
+            if sheet is None:
+                break
+            sheets.append(sheet)
+        else:
+            # Fewer images break ties: fewer uploads
+            key = (sum(sheet.tokens for sheet in sheets), len(sheets))
+            if best is None or key < best[0]:
+                best = (key, sheets)
+    if best is None:
+        # Too many tiles to fit readably; fall back to the fixed grid per gallery
+        sheets = [SheetLayout([engine], [counts[engine]], TILE_SIZE, FIXED_COLUMNS,
+                              fixed_tokens(counts[engine], detail)) for engine in engines]
+        return PackingPlan(sheets, fixed)
+    return PackingPlan(best[1], fixed)
@@ -0,0 +1,207 @@
+import base64
+from collections import OrderedDict
+import cv2
+import numpy as np
+import os
+from typing import Optional
+
+
+TILE_SIZE = 150
+LABEL_HEIGHT = 20
+CELL_HEIGHT = TILE_SIZE + LABEL_HEIGHT
+# Gallery name strip above each gallery on a shared sheet
+HEADER_HEIGHT = 24
+# Rendered label strips kept per renderer, by (index, width)
+MAX_LABELS = 512
+
+MIME_TYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+
+def image_mime_type(data: bytes) -> str:
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'application/octet-stream'
+
+
+def to_data_url(data: bytes) -> str:
+    encoded = base64.b64encode(data).decode('utf-8')
+    return f"data:{image_mime_type(data)};base64,{encoded}"
+
+
+def shrink_to_fit(img: np.ndarray, max_bytes: int) -> bytes:
+    """JPEG-encode `img`, lowering quality and then resolution until it fits."""
+    encoded = b''
+    for quality in (85, 70, 55, 40):
+        ok, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        encoded = buf.tobytes()
+        if len(encoded) <= max_bytes:
+            return encoded
+    while min(img.shape[:2]) > 64:
+        img = cv2.resize(img, None, fx=0.75, fy=0.75,
+                         interpolation=cv2.INTER_AREA)
+        ok, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 40])
+        encoded = buf.tobytes()
+        if len(encoded) <= max_bytes:
+            return encoded
+    return encoded
+
+
+class GridRenderer:
+    """Lays 150x150 tiles out in labelled 150x170 cells and encodes the sheet.
+
+    The grid is written into a buffer allocated once per renderer, and the
+    index labels are rendered once and copied in, so a gallery costs a few
+    slice assignments plus a single `cv2.imencode`.
+    """
+
+    def __init__(self, columns: int = 6, max_tiles: int = 26,
+                 fmt: Optional[str] = None, quality: Optional[int] = None):
+        self.columns = columns
+        self.max_tiles = max_tiles
+        self.fmt = (fmt or os.getenv('GRID_FORMAT', 'png')).lower()
+        if self.fmt == 'jpg':
+            self.fmt = 'jpeg'
+        if self.fmt not in MIME_TYPES:
+            raise ValueError(f"Unsupported grid format: {self.fmt}")
+        env_quality = os.getenv('GRID_QUALITY')
+        self.quality = quality if quality is not None else (
+            int(env_quality) if env_quality else None)
+
+        max_rows = (max_tiles + columns - 1) // columns
+        self._buffer = np.zeros(
+            (max_rows * CELL_HEIGHT, columns * TILE_SIZE, 3), dtype=np.uint8)
+        # Planned and packed sheets are views into one flat buffer, grown to
+        # the largest sheet drawn so far, however many layouts come through
+        self._sheet_buffer = np.zeros(0, dtype=np.uint8)
+        self._labels: "OrderedDict[tuple[int, int], np.ndarray]" = OrderedDict()
+
+    @property
+    def mime_type(self) -> str:
+        return MIME_TYPES[self.fmt]
+
+    def label(self, index: int, width: int = TILE_SIZE) -> np.ndarray:
+        strip = self._labels.get((index, width))
+        if strip is not None:
+            self._labels.move_to_end((index, width))
+            return strip
+        # Same text placement as drawing at (75, 165) on a bordered tile
+        strip = np.full((LABEL_HEIGHT, width, 3), 255, dtype=np.uint8)
+        cv2.putText(strip, str(index), (width // 2, 165 - TILE_SIZE),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1, cv2.LINE_AA)
+        self._labels[(index, width)] = strip
+        if len(self._labels) > MAX_LABELS:
+            self._labels.popitem(last=False)
+        return strip
+
+    def render(self, tiles: list[np.ndarray],
+               labels: Optional[list[int]] = None) -> np.ndarray:
+        """Return a view of the internal buffer holding the labelled grid.
+
+        Cells are labelled 0..n unless `labels` gives each tile's index.
+        The view is only valid until the next call to `render`.
+        """
+        if len(tiles) > self.max_tiles:
+            raise ValueError(
+                f"Got {len(tiles)} tiles, renderer holds at most {self.max_tiles}")
+
+        columns = self.columns
+        rows = (len(tiles) + columns - 1) // columns
+        grid = self._buffer[:rows * CELL_HEIGHT]
+        self._draw(grid, tiles, labels, columns, TILE_SIZE)
+        return grid
+
+    def render_sheet(self, blocks: list[tuple[Optional[str], list[np.ndarray], list[int]]],
+                     columns: int, tile_size: int) -> np.ndarray:
+        """Lay galleries out top to bottom on one `columns` x `tile_size` grid.
+
+        Each block is (header text or None, tiles, labels); tiles are scaled
+        to `tile_size`. Returns a view of the internal sheet buffer, only
+        valid until the next call to `render_sheet`.
+        """
+        cell_height = tile_size + LABEL_HEIGHT
+        heights = [(HEADER_HEIGHT if header else 0)
+                   + (len(tiles) + columns - 1) // columns * cell_height
+                   for header, tiles, _ in blocks]
+        shape = (sum(heights), columns * tile_size, 3)
+        length = shape[0] * shape[1] * shape[2]
+        if length > self._sheet_buffer.size:
+            self._sheet_buffer = np.zeros(length, dtype=np.uint8)
+        # Every pixel is drawn below, so what an earlier sheet left is overwritten
+        sheet = self._sheet_buffer[:length].reshape(shape)
+
+        y = 0
+        for (header, tiles, labels), height in zip(blocks, heights):
+            block = sheet[y:y + height]
+            if header:
+                block[:HEADER_HEIGHT] = 255
+                cv2.putText(block[:HEADER_HEIGHT], header, (6, 17),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.55, (0, 0, 0), 1, cv2.LINE_AA)
+                block = block[HEADER_HEIGHT:]
+            self._draw(block, tiles, labels, columns, tile_size)
+            y += height
+        return sheet
+
+    def _draw(self, grid: np.ndarray, tiles: list[np.ndarray], labels: Optional[list[int]],
+              columns: int, tile_size: int):
+        cell_height = tile_size + LABEL_HEIGHT
+        rows = (len(tiles) + columns - 1) // columns
+        for i, tile in enumerate(tiles):
+            if tile.shape[0] != tile_size:
+                tile = cv2.resize(tile, (tile_size, tile_size), interpolation=cv2.INTER_AREA)
+            y = (i // columns) * cell_height
+            x = (i % columns) * tile_size
+            grid[y:y + tile_size, x:x + tile_size] = tile
+            grid[y + tile_size:y + cell_height, x:x + tile_size] = self.label(
+                i if labels is None else labels[i], tile_size)
+
+        # Empty cells in the last row stay black, as in the original layout
+        filled = len(tiles) - (rows - 1) * columns
+        if rows and filled < columns:
+            grid[(rows - 1) * cell_height:, filled * tile_size:] = 0
+
+    def encode(self, grid: np.ndarray, fmt: Optional[str] = None,
+               quality: Optional[int] = None) -> bytes:
+        fmt = (fmt or self.fmt).lower()
+        if fmt == 'jpg':
+            fmt = 'jpeg'
+        quality = quality if quality is not None else self.quality
+
+        if fmt == 'png':
+            # PNG "quality" is the zlib level; 3 is much faster than the
+            # default 6 for a few percent more bytes
+            params = [cv2.IMWRITE_PNG_COMPRESSION,
+                      3 if quality is None else quality]
+        elif fmt == 'jpeg':
+            params = [cv2.IMWRITE_JPEG_QUALITY,
+                      90 if quality is None else quality]
+        elif fmt == 'webp':
+            params = [cv2.IMWRITE_WEBP_QUALITY,
+                      90 if quality is None else quality]
+        else:
+            raise ValueError(f"Unsupported grid format: {fmt}")
+
+        ok, encoded = cv2.imencode('.' + fmt, grid, params)
+        if not ok:
+            raise RuntimeError(f"Failed to encode grid as {fmt}")
+        return encoded.tobytes()
+
+    def encode_within(self, grid: np.ndarray, max_bytes: int,
+                      fmt: Optional[str] = None, quality: Optional[int] = None) -> bytes:
+        """Encode as configured, falling back to smaller JPEGs over `max_bytes`."""
+        encoded = self.encode(grid, fmt, quality)
+        if len(encoded) <= max_bytes:
+            return encoded
+        return shrink_to_fit(grid, max_bytes)
+
+    def render_and_encode(self, tiles: list[np.ndarray]) -> bytes:
+        return self.encode(self.render(tiles))
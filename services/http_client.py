@@ -0,0 +1,123 @@
+import aiohttp
+import os
+from collections import Counter
+from typing import Optional
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+
+class HttpClient:
+    """Pooled aiohttp session shared by every outbound call.
+
+    The FastAPI lifespan starts it once and closes it on shutdown, so imgbb
+    uploads, scraper calls and thumbnail fetches reuse warm keep-alive
+    connections and cached DNS lookups instead of handshaking per call.
+    """
+
+    def __init__(self):
+        self.limit = int(os.getenv('HTTP_POOL_LIMIT', '100'))
+        self.limit_per_host = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', '20'))
+        self.keepalive_timeout = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', '30'))
+        self.dns_cache_ttl = int(os.getenv('HTTP_DNS_CACHE_TTL', '300'))
+        self.timeout = aiohttp.ClientTimeout(
+            total=float(os.getenv('HTTP_TIMEOUT_TOTAL', '60')),
+            connect=float(os.getenv('HTTP_TIMEOUT_CONNECT', '10')),
+            sock_read=float(os.getenv('HTTP_TIMEOUT_READ', '30')),
+        )
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._connector: Optional[aiohttp.TCPConnector] = None
+
+        self.requests_by_host: Counter = Counter()
+        self.errors_by_host: Counter = Counter()
+        self.bytes_by_host: Counter = Counter()
+        self.in_flight = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+        self._connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=self._connector,
+            timeout=self.timeout,
+            trace_configs=[self._trace_config()],
+        )
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._connector = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError(
+                "HttpClient is not started; call `await http_client.start()` first")
+        return self._session
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self.in_flight += 1
+            self.requests_by_host[params.url.host] += 1
+
+        async def on_request_end(session, ctx, params):
+            self.in_flight -= 1
+
+        async def on_request_exception(session, ctx, params):
+            self.in_flight -= 1
+            self.errors_by_host[params.url.host] += 1
+
+        async def on_response_chunk_received(session, ctx, params):
+            self.bytes_by_host[params.url.host] += len(params.chunk)
+
+        async def on_connection_create_end(session, ctx, params):
+            self.connections_created += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self.connections_reused += 1
+
+        async def on_dns_cache_hit(session, ctx, params):
+            self.dns_cache_hits += 1
+
+        async def on_dns_cache_miss(session, ctx, params):
+            self.dns_cache_misses += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_response_chunk_received.append(on_response_chunk_received)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
+
+    def stats(self) -> dict:
+        acquired = self.connections_created + self.connections_reused
+        return {
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "in_flight": self.in_flight,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "reuse_ratio": self.connections_reused / acquired if acquired else 0.0,
+            "dns_cache_hits": self.dns_cache_hits,
+            "dns_cache_misses": self.dns_cache_misses,
+            "requests_by_host": dict(self.requests_by_host),
+            "errors_by_host": dict(self.errors_by_host),
+            "bytes_by_host": dict(self.bytes_by_host),
+        }
@@ -0,0 +1,138 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+
+def _timed_call(fn: Callable, args: tuple) -> tuple[Any, float]:
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class ImageExecutor:
+    """Runs CPU-bound image work (decode, resize, grid encode) off the event loop.
+
+    IMAGE_EXECUTOR selects `thread` (default; OpenCV releases the GIL, and
+    bytes are shared without copying) or `process` (one pickled copy of the
+    inputs per task, but immune to GIL-bound Python code).
+    IMAGE_EXECUTOR_WORKERS defaults to the number of cores.
+    """
+
+    def __init__(self):
+        self.kind = os.getenv('IMAGE_EXECUTOR', 'thread').lower()
+        if self.kind not in ('thread', 'process'):
+            raise ValueError(f"Unknown IMAGE_EXECUTOR: {self.kind}")
+        self.max_workers = int(os.getenv(
+            'IMAGE_EXECUTOR_WORKERS', str(os.cpu_count() or 1)))
+        self._pool: Optional[Executor] = None
+
+        self.tasks = 0
+        self.in_flight = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def start(self):
+        if self._pool is not None:
+            return
+        if self.kind == 'process':
+            # spawn, not fork: the parent already runs an event loop and threads
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix='image')
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    async def run(self, fn: Callable, *args):
+        if self._pool is None:
+            raise RuntimeError(
+                "ImageExecutor is not started; call `image_executor.start()` first")
+
+        loop = asyncio.get_running_loop()
+        self.tasks += 1
+        self.in_flight += 1
+        submitted = time.perf_counter()
+        try:
+            result, elapsed = await loop.run_in_executor(
+                self._pool, _timed_call, fn, args)
+        finally:
+            self.in_flight -= 1
+        self.busy_seconds += elapsed
+        self.wait_seconds += max(time.perf_counter() - submitted - elapsed, 0.0)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "tasks": self.tasks,
+            "in_flight": self.in_flight,
+            "busy_seconds": round(self.busy_seconds, 4),
+            "queue_wait_seconds": round(self.wait_seconds, 4),
+        }
+
+
+class LoopLagMonitor:
+    """Measures how long the event loop was blocked.
+
+    A background task sleeps for `interval` seconds; any extra delay before it
+    wakes up is time the loop spent running something synchronous.
+    """
+
+    def __init__(self, interval: float = 0.05, threshold: float = 0.01):
+        self.interval = interval
+        self.threshold = threshold
+        self._task: Optional[asyncio.Task] = None
+
+        self.samples = 0
+        self.stalls = 0
+        self.blocked_seconds = 0.0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - expected, 0.0)
+            self.samples += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self.stalls += 1
+                self.blocked_seconds += lag
+
+    def stats(self) -> dict:
+        return {
+            "samples": self.samples,
+            "stalls": self.stalls,
+            "blocked_seconds": round(self.blocked_seconds, 4),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "last_lag_ms": round(self.last_lag * 1000, 2),
+        }
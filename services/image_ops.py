@@ -0,0 +1,284 @@
+"""Synchronous image work that runs inside the ImageExecutor pool.
+
+Everything here is a module-level function taking and returning plain
+bytes / arrays, so it can be shipped to a thread or a worker process.
+"""
+import threading
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Optional, Union
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from services.gallery_layout import FIXED_COLUMNS, SheetLayout, fixed_tokens, plan_sheet
+from services.grid_renderer import GridRenderer, TILE_SIZE, shrink_to_fit
+from services.phash import Ranking, fingerprint, phash, rank_candidates
+
+
+_local = threading.local()
+
+
+def _renderer() -> GridRenderer:
+    # GridRenderer reuses one buffer, so each worker thread/process gets its own
+    renderer = getattr(_local, 'renderer', None)
+    if renderer is None:
+        renderer = _local.renderer = GridRenderer()
+    return renderer
+
+
+# Refuse to decode anything larger (decompression bombs, mis-served originals)
+MAX_DECODE_PIXELS = 50_000_000
+
+# cv2 can decode JPEGs at 1/2, 1/4 or 1/8 scale for a fraction of the work
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                  (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def image_size(img_data: bytes) -> Optional[tuple[int, int]]:
+    """(width, height) from the image header alone, or None if the bytes are
+    not an image PIL recognises or claim an implausible size."""
+    try:
+        width, height = Image.open(BytesIO(img_data)).size
+    except Exception:
+        return None
+    if not width or not height or width * height > MAX_DECODE_PIXELS:
+        return None
+    return width, height
+
+
+def reduced_flag(edge: int, target: int) -> int:
+    """The coarsest imdecode mode that keeps `edge` pixels at or above `target`."""
+    for factor, flag in _REDUCED_FLAGS:
+        if edge // factor >= target:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+def decode_frame(img_data: bytes) -> Optional[np.ndarray]:
+    """Decode at the smallest scale that still covers a tile; None for bytes
+    that are not an image, without attempting a decode where the header
+    already says so."""
+    if not img_data:
+        return None
+    size = image_size(img_data)
+    if size is None:
+        return None
+    # Tiles are squashed to TILE_SIZE square, so the short side sets the scale
+    flag = reduced_flag(min(size), TILE_SIZE)
+    # frombuffer is a view over the bytes object, no copy before imdecode
+    return cv2.imdecode(np.frombuffer(img_data, np.uint8), flag)
+
+
+def decode_image(img_data: bytes) -> Optional[np.ndarray]:
+    """Decode and resize to a 150x150 tile, or None if the bytes are not an image."""
+    img = decode_frame(img_data)
+    if img is None:
+        return None
+    return cv2.resize(img, (TILE_SIZE, TILE_SIZE), interpolation=cv2.INTER_AREA)
+
+
+def fetch_error_tile() -> np.ndarray:
+    # Placeholder shown when the thumbnail could not be downloaded
+    img = np.full((TILE_SIZE, TILE_SIZE, 3), 200, dtype=np.uint8)
+    cv2.putText(img, "Error", (30, 75),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2)
+    return img
+
+
+def decode_error_tile() -> np.ndarray:
+    # Placeholder shown when the downloaded bytes are not a decodable image
+    img = np.full((TILE_SIZE, TILE_SIZE, 3), 220, dtype=np.uint8)
+    cv2.putText(img, "Decode Error", (10, 75),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
+    return img
+
+
+def decode_tile(img_data: Optional[bytes]) -> np.ndarray:
+    if img_data is None:
+        return fetch_error_tile()
+    img = decode_image(img_data)
+    return decode_error_tile() if img is None else img
+
+
+def decode_batch(blobs: list[Optional[bytes]]) -> list[np.ndarray]:
+    return [decode_tile(blob) for blob in blobs]
+
+
+def fit_image(img_data: bytes, max_bytes: int) -> bytes:
+    """Return the image unchanged if it fits, else a smaller JPEG re-encode."""
+    if len(img_data) <= max_bytes:
+        return img_data
+    img = cv2.imdecode(np.frombuffer(img_data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return img_data
+    return shrink_to_fit(img, max_bytes)
+
+
+@dataclass
+class IngestedImage:
+    data: bytes
+    width: int
+    height: int
+    original_bytes: int
+    original_width: int
+    original_height: int
+
+
+def ingest_image(img_data: bytes, max_edge: int, quality: int) -> Optional[IngestedImage]:
+    """Decode a query image once, shrink it to `max_edge` and re-encode it as
+    a metadata-free JPEG. None if the bytes are not an image."""
+    flag = cv2.IMREAD_COLOR
+    # Only the header is read here
+    size = image_size(img_data)
+    if size is not None:
+        width, height = size
+        flag = reduced_flag(max(size), max_edge)
+    else:
+        width = height = 0
+    img = cv2.imdecode(np.frombuffer(img_data, np.uint8), flag)
+    if img is None:
+        return None
+    if not width:
+        height, width = img.shape[:2]
+
+    scale = max_edge / max(img.shape[:2])
+    if scale < 1:
+        size = (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale)))
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    # Re-encoding drops EXIF (GPS, camera data); imdecode already applied the orientation
+    ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        return None
+    return IngestedImage(encoded.tobytes(), img.shape[1], img.shape[0],
+                         len(img_data), width, height)
+
+
+GalleryItem = Union[bytes, np.ndarray, None]
+
+
+def image_phash(item: GalleryItem) -> Optional[int]:
+    """pHash of a query image given as raw bytes or an already decoded tile."""
+    if item is None:
+        return None
+    tile = item if isinstance(item, np.ndarray) else decode_image(item)
+    return None if tile is None else phash(tile)
+
+
+@dataclass
+class GalleryRender:
+    # Encoded sheet, or None when a near-exact match made it unnecessary
+    encoded: Optional[bytes]
+    # Tiles decoded in this task, by gallery index, for the thumbnail cache
+    decoded: dict[int, np.ndarray]
+    # Pre-ranking of candidates against tile 0, when requested
+    ranking: Optional[Ranking] = None
+    # Downloaded bytes decoded here, the time spent decoding them, and an
+    # estimate of the task's peak memory: the downloads it holds, the
+    # largest decoded frame and the tiles
+    downloaded_bytes: int = 0
+    decode_seconds: float = 0.0
+    peak_bytes: int = 0
+    # The sheet's layout and estimated tokens, when one was drawn
+    layout: Optional[SheetLayout] = None
+    # Labels of the tiles drawn (or, without `draw`, to pack into a shared
+    # sheet later along with the tiles), query image first
+    tiles: Optional[list[np.ndarray]] = None
+    labels: Optional[list[int]] = None
+
+
+def render_gallery(items: list[GalleryItem], fmt: Optional[str] = None,
+                   quality: Optional[int] = None,
+                   max_bytes: Optional[int] = None,
+                   top_k: Optional[int] = None,
+                   exact_bits: int = -1,
+                   min_tile: Optional[int] = None,
+                   detail: str = "auto",
+                   draw: bool = True) -> GalleryRender:
+    """Decode, resize, rank, lay out and encode a whole gallery in one pool task.
+
+    Items are raw downloads, tiles already decoded (e.g. from the thumbnail
+    cache) or None for failed fetches; item 0 is the query image. With
+    `top_k` set, candidates are ranked by perceptual distance to the query
+    and only the closest `top_k` are drawn, keeping their original labels;
+    a candidate within `exact_bits` of the query skips the sheet entirely.
+    The sheet is kept under `max_bytes` if given. With `min_tile` set, the
+    sheet is laid out by the token planner (tiles no smaller than
+    `min_tile`) instead of the fixed 6-column grid; without `draw`, no sheet
+    is drawn and the chosen tiles are returned for `render_packed`. Only
+    byte strings and tiles cross the process boundary.
+    """
+    tiles = []
+    decoded = {}
+    usable = set()
+    downloaded = largest_frame = 0
+    started = time.perf_counter()
+    for index, item in enumerate(items):
+        if isinstance(item, np.ndarray):
+            tiles.append(item)
+            usable.add(index)
+            continue
+        if item is None:
+            tiles.append(fetch_error_tile())
+            continue
+        downloaded += len(item)
+        frame = decode_frame(item)
+        if frame is None:
+            tile = decode_error_tile()
+        else:
+            largest_frame = max(largest_frame, frame.nbytes)
+            tile = cv2.resize(frame, (TILE_SIZE, TILE_SIZE), interpolation=cv2.INTER_AREA)
+            decoded[index] = tile
+            usable.add(index)
+        tiles.append(tile)
+    decode_seconds = time.perf_counter() - started
+    peak_bytes = downloaded + largest_frame + sum(tile.nbytes for tile in tiles)
+
+    labels = list(range(len(tiles)))
+    ranking = None
+    if top_k is not None and 0 in usable:
+        query = fingerprint(tiles[0])
+        candidates = {index: fingerprint(tiles[index])
+                      for index in sorted(usable) if index != 0}
+        ranking = rank_candidates(query, candidates, top_k, exact_bits)
+        if ranking.exact_index is not None:
+            return GalleryRender(None, decoded, ranking, downloaded, decode_seconds, peak_bytes)
+        if top_k > 0:
+            labels = [0] + [index for index, _ in ranking.candidates]
+
+    chosen = [tiles[index] for index in labels]
+    if not draw:
+        return GalleryRender(None, decoded, ranking, downloaded, decode_seconds, peak_bytes,
+                             tiles=chosen, labels=labels)
+    layout = plan_sheet(["gallery"], [len(chosen)], min_tile, detail) if min_tile else None
+    renderer = _renderer()
+    if layout is not None:
+        grid = renderer.render_sheet([(None, chosen, labels)], layout.columns, layout.tile_size)
+    else:
+        grid = renderer.render(chosen, labels)
+        layout = SheetLayout(["gallery"], [len(chosen)], TILE_SIZE, FIXED_COLUMNS,
+                             fixed_tokens(len(chosen), detail))
+    return GalleryRender(_encode(renderer, grid, fmt, quality, max_bytes), decoded, ranking,
+                         downloaded, decode_seconds, peak_bytes, layout, labels=labels)
+
+
+def _encode(renderer: GridRenderer, grid: np.ndarray, fmt: Optional[str],
+            quality: Optional[int], max_bytes: Optional[int]) -> bytes:
+    if max_bytes is not None:
+        return renderer.encode_within(grid, max_bytes, fmt, quality)
+    return renderer.encode(grid, fmt, quality)
+
+
+def render_packed(blocks: list[tuple[list[np.ndarray], list[int]]], sheet: SheetLayout,
+                  fmt: Optional[str] = None, quality: Optional[int] = None,
+                  max_bytes: Optional[int] = None) -> bytes:
+    """Draw and encode one planned sheet; `blocks` are the tiles and labels
+    of `sheet.engines`, in order, each under its gallery name."""
+    renderer = _renderer()
+    grid = renderer.render_sheet(
+        [(f"Gallery: {engine}" if sheet.headed else None, tiles, labels)
+         for engine, (tiles, labels) in zip(sheet.engines, blocks)],
+        sheet.columns, sheet.tile_size)
+    return _encode(renderer, grid, fmt, quality, max_bytes)
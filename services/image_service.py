@@ -1,33 +1,125 @@
-import aiohttp
 import base64
 from fastapi import HTTPException, File, UploadFile
-from openai import AsyncAzureOpenAI
-from io import BytesIO
-from typing import Union
-from search_service import SearchService
-import cv2
+from typing import Any, Optional, Union
+from dataclasses import asdict, dataclass, field
+from services.search_service import SearchService
+from services.http_client import HttpClient
 import numpy as np
-import json
 import time
+from collections import Counter
 from dotenv import load_dotenv
 import asyncio
 import os
-import matplotlib.pyplot as plt
+from services.image_executor import ImageExecutor
+from services.image_ops import (GalleryRender, IngestedImage, decode_image, decode_tile,
+                                fit_image, image_phash, ingest_image, render_gallery,
+                                render_packed)
+from services.gallery_layout import PackingPlan, fixed_tokens, plan_packing
+from services.phash import Ranking
+from services.rate_limit import RateLimitedError, parse_retry_after
+from services.resilience import Upstreams
+from services.metrics import Metrics
+from services.llm_router import LLMRouter
+from services.candidates import Candidates, parse_candidates
+from services.grid_renderer import image_mime_type, to_data_url
+from services.thumbnail_cache import CachedTile, ThumbnailCache
 
 
 load_dotenv()
 
 
+@dataclass
+class Gallery:
+    engine: str
+    # imgbb or data: URL of the sheet; None when pre-ranking already decided
+    url: Optional[str] = None
+    ranking: Optional[Ranking] = None
+    # Estimated GPT image tokens for the published sheet, and for the fixed 6-column grid
+    tokens: Optional[int] = None
+    fixed_tokens: Optional[int] = None
+    # Unpublished galleries keep their tiles in memory, to be packed into a shared sheet
+    tiles: Optional[list[np.ndarray]] = field(default=None, repr=False)
+    # Labels on the sheet, query image first: the indices GPT may answer with
+    labels: Optional[list[int]] = None
+
+    @property
+    def decided_index(self) -> Optional[int]:
+        return self.ranking.exact_index if self.ranking else None
+
+    def to_dict(self) -> dict:
+        return {"engine": self.engine, "url": self.url, "tokens": self.tokens,
+                "fixed_tokens": self.fixed_tokens, "labels": self.labels,
+                "ranking": asdict(self.ranking) if self.ranking is not None else None}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Gallery":
+        ranking = data.get("ranking")
+        if ranking is not None:
+            ranking = Ranking(
+                candidates=[tuple(candidate) for candidate in ranking["candidates"]],
+                exact_index=ranking.get("exact_index"),
+                exact_bits=ranking.get("exact_bits"))
+        return cls(engine=data["engine"], url=data.get("url"), ranking=ranking,
+                   tokens=data.get("tokens"), fixed_tokens=data.get("fixed_tokens"),
+                   labels=data.get("labels"))
+
+
 class ImageService:
-    def __init__(self):
+    def __init__(self, http_client: HttpClient, executor: ImageExecutor,
+                 thumbnail_cache: ThumbnailCache, metrics: Optional[Metrics] = None,
+                 llm: Optional[LLMRouter] = None, upstreams: Optional[Upstreams] = None):
         # TODO
         # s3 client
-        self.azure_client = AsyncAzureOpenAI(
-            api_key=os.getenv('AZURE_KEY'),
-            api_version="2024-02-15-preview",
-            azure_endpoint="https://buysmartusnc.openai.azure.com/"
-        )
+        # Shared with MatchingService in the app, so both use one connection pool
+        self.llm = llm or LLMRouter()
         self.IMGBB_API_KEY = os.getenv('IMGBB_API_KEY')
+        self.imgbb_url = os.getenv('IMGBB_UPLOAD_URL', 'https://api.imgbb.com/1/upload')
+        self.http_client = http_client
+        self.executor = executor
+        self.thumbnail_cache = thumbnail_cache
+        self.metrics = metrics
+        # Gallery uploads share imgbb's breaker and rate limit with the query upload
+        self.upstreams = upstreams
+        self.fetch_failures: Counter = Counter()
+        # 'upload' hosts galleries on imgbb; 'inline' hands them to GPT as data: URLs
+        self.gallery_transport = os.getenv('GALLERY_TRANSPORT', 'upload').lower()
+        self.inline_max_bytes = int(os.getenv('INLINE_IMAGE_MAX_BYTES', '2500000'))
+        # Perceptual pre-ranking; a negative PRERANK_TOP_K turns it off
+        top_k = int(os.getenv('PRERANK_TOP_K', '12'))
+        self.prerank_top_k: Optional[int] = top_k if top_k >= 0 else None
+        self.prerank_exact_bits = int(os.getenv('PRERANK_EXACT_BITS', '4'))
+        # Uploaded query images are shrunk to this longest edge and re-encoded; 0 keeps them as sent
+        self.ingest_max_edge = int(os.getenv('INGEST_MAX_EDGE', '1024'))
+        self.ingest_quality = int(os.getenv('INGEST_QUALITY', '85'))
+        # GPT vision detail for the product query: 'low', 'high' or 'auto'
+        self.product_query_detail = os.getenv('VISION_DETAIL_PRODUCT_QUERY', 'auto')
+        # 'fixed' (the default) draws the 6-column grid of 150px cells; 'planned' sizes
+        # sheets for GPT's image billing (see gallery_layout), with tiles no smaller than
+        # GALLERY_MIN_TILE, for the detail MatchingService sends. Only switch once
+        # `benchmarks.layout_quality --gpt` shows no loss in match accuracy
+        self.gallery_layout = os.getenv('GALLERY_LAYOUT', 'fixed').lower()
+        self.gallery_min_tile = int(os.getenv('GALLERY_MIN_TILE', '96'))
+        self.gallery_detail = os.getenv('VISION_DETAIL_MATCHING', 'auto')
+        # Thumbnail downloads are abandoned past this size; some "thumbnails" are originals
+        self.thumbnail_max_bytes = int(os.getenv('THUMBNAIL_MAX_BYTES', str(3 * 1024 * 1024)))
+
+    @property
+    def inline_galleries(self) -> bool:
+        return self.gallery_transport == 'inline'
+
+    async def ingest(self, contents: bytes) -> Optional[IngestedImage]:
+        """Downscaled, metadata-free JPEG of an uploaded query image, or None
+        if ingest is off or the bytes do not decode."""
+        if self.ingest_max_edge <= 0:
+            return None
+        return await self.executor.run(
+            ingest_image, contents, self.ingest_max_edge, self.ingest_quality)
+
+    async def inline_image(self, contents: bytes) -> str:
+        """Return `contents` as a data: URL, re-encoded smaller if over the inline budget."""
+        if len(contents) > self.inline_max_bytes:
+            contents = await self.executor.run(fit_image, contents, self.inline_max_bytes)
+        return to_data_url(contents)
 
     async def upload_image(self, file: Union[UploadFile, str]):
         if isinstance(file, UploadFile):
@@ -42,16 +134,24 @@ class ImageService:
             'image': file_content
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post('https://api.imgbb.com/1/upload', data=data) as response:
-                result = await response.json()
-                if 'data' in result and 'url' in result['data']:
-                    return result['data']['url']
-                else:
-                    raise HTTPException(
-                        status_code=500, detail="Failed to upload image")
+        started = time.perf_counter()
+        session = self.http_client.session
+        async with session.post(self.imgbb_url, data=data) as response:
+            if response.status == 429:
+                raise RateLimitedError("imgbb", parse_retry_after(response.headers))
+            result = await response.json()
+            self._observe("upload", started)
+            if 'data' in result and 'url' in result['data']:
+                return result['data']['url']
+            else:
+                raise HTTPException(
+                    status_code=500, detail="Failed to upload image")
+
+    def _observe(self, stage: str, started: float):
+        if self.metrics is not None:
+            self.metrics.observe_stage(stage, started)
 
-    async def get_product_query(self, image_url: str) -> str:
+    async def get_product_query(self, image_url: str, detail: Optional[str] = None) -> str:
         message_text = (
             "What is the product in the image? Specifically describe the product's apperance "
             "and identify its conspicuous features that makes it distinctive. According to its features, "
@@ -59,12 +159,12 @@ class ImageService:
             "preferrably with a product name to use on Amazon and Google and make sure you have the brands in your query as well. "
             "Return in JSON with potential brands, description, and query."
         )
-        completion = await self.azure_client.chat.completions.create(
-            model="gpt-4o",
+        completion = await self.llm.chat(
             messages=[
                 {"role": "system", "content": message_text},
                 {"role": "user", "content": [
-                    {"type": "image_url", "image_url": {"url": image_url}}]},
+                    {"type": "image_url", "image_url": {
+                        "url": image_url, "detail": detail or self.product_query_detail}}]},
             ],
             max_tokens=2000,
             temperature=0,
@@ -73,122 +173,221 @@ class ImageService:
         return completion.choices[0].message.content  # type: ignore
 
     async def fetch_image(self, session, url):
+        """Return (item, validators) for one gallery slot.
+
+        `item` is a cached tile, freshly downloaded bytes, or None on failure.
+        `validators` is the (ETag, Last-Modified) pair to store alongside the
+        tile once the downloaded bytes are decoded, or None if nothing to store.
+        """
+        return await self.fetch_or_revalidate(session, url, await self.thumbnail_cache.get(url))
+
+    async def fetch_or_revalidate(self, session, url, cached: Optional[CachedTile]):
+        """`fetch_image` given the cache lookup's result, which is served as
+        is if fresh and revalidated (or served stale) otherwise."""
+        cache = self.thumbnail_cache
+        if cached is not None and cache.is_fresh(cached):
+            cache.hits += 1
+            return cached.array(), None
+
         try:
-            async with session.get(url, timeout=10) as response:
+            async with session.get(url, timeout=10,
+                                   headers=cache.conditional_headers(cached)) as response:
+                if response.status == 304 and cached is not None:
+                    await cache.touch(url, cached)
+                    return cached.array(), None
                 if response.status == 200:
-                    return await response.read()
+                    body = await self.read_thumbnail(response, url)
+                    if body is not None:
+                        cache.misses += 1
+                        validators = (response.headers.get('ETag'),
+                                      response.headers.get('Last-Modified'))
+                        return body, validators
                 else:
-                    print(f"Failed to fetch image from {
-                          url}: HTTP {response.status}")
-                    return None
+                    self.fetch_failures[f"http_{response.status}"] += 1
+                    print(
+                        f"Failed to fetch image from {url}: HTTP {response.status}")
         except Exception as e:
+            self.fetch_failures["timeout" if isinstance(e, asyncio.TimeoutError) else "error"] += 1
             print(f"Error fetching image from {url}: {str(e)}")
-            return None
-
-    async def process_image(self, img_data, index):
-        if img_data is None:
-            # Return a placeholder image if fetch failed
-            img = np.full((150, 150, 3), 200, dtype=np.uint8)
-            cv2.putText(img, "Error", (30, 75),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2)
-        else:
-            nparr = np.frombuffer(img_data, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            if img is None:
-                # Another placeholder for decoding errors
-                img = np.full((150, 150, 3), 220, dtype=np.uint8)
-                cv2.putText(img, "Decode Error", (10, 75),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
-            else:
-                img = cv2.resize(img, (150, 150), interpolation=cv2.INTER_AREA)
-
-        # Add white space for label
-        img = cv2.copyMakeBorder(
-            img, 0, 20, 0, 0, cv2.BORDER_CONSTANT, value=[255, 255, 255])
-
-        # Add label
-        cv2.putText(img, str(index), (75, 165),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1, cv2.LINE_AA)
-
-        return img
-
-    async def concatenate_thumbnails(self, engine: str, search_results, image_url, columns=6):
-        if engine == 'gs':
-            thumbnails = [image_url] + [
-                result['thumbnail']
-                for result in search_results['organic_results']
-                if 'thumbnail' in result
-            ]
-
-        elif engine == 'amz':
-            data = json.loads(search_results)
-            results = data['results'][0]['content']['results']
-            organic = results['results']['organic']
-            amazon_choice = results['results']['amazons_choices']
-            o_imgs = [item['url_image']
-                      for item in organic if 'url_image' in item]
-            ac_imgs = [item['url_image']
-                       for item in amazon_choice if 'url_image' in item]
-            thumbnails = [image_url] + o_imgs + ac_imgs
-
-        elif engine == 'gis':
-            thumbnails = [image_url] + [
-                result['thumbnail']
-                for result in search_results['image_results']
-                if 'thumbnail' in result
-            ]
-
-        elif engine == 'lens':
-            thumbnails = [image_url] + [
-                result['thumbnail']
-                for result in search_results['visual_matches']
-                if 'thumbnail' in result
-            ]
-
-        else:
-            raise ValueError(f"Unknown engine: {engine}")
-
-        thumbnails = thumbnails[:26]  # Limit to 25 images
-
-        async with aiohttp.ClientSession() as session:
-            tasks = [self.fetch_image(session, url) for url in thumbnails]
-            img_data_list = await asyncio.gather(*tasks)
-
-        process_tasks = [self.process_image(
-            img_data, i) for i, img_data in enumerate(img_data_list)]
-        images = await asyncio.gather(*process_tasks)
-
-        rows = (len(images) + columns - 1) // columns
-        grid = np.zeros((rows * 170, columns * 150, 3), dtype=np.uint8)
-
-        for i, img in enumerate(images):
-            row = i // columns
-            col = i % columns
-            grid[row*170:row*170+170, col*150:col*150+150] = img
-
-        # Save the image to a BytesIO object instead of a file
-        buffer = BytesIO()
-        plt.figure(figsize=(20, 20))
-        plt.imshow(cv2.cvtColor(grid, cv2.COLOR_BGR2RGB))
-        plt.axis('off')
-        plt.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0)
-        plt.close()
-
-        # Convert BytesIO to base64
-        buffer.seek(0)
-        img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
 
+        if cached is not None:
+            # Upstream is failing; a stale tile beats an error placeholder
+            cache.stale_served += 1
+            return cached.array(), None
+        cache.misses += 1
+        return None, None
+
+    async def read_thumbnail(self, response, url: str) -> Optional[bytes]:
+        """Stream a thumbnail body, or None (connection dropped) if it is not
+        an image or runs past THUMBNAIL_MAX_BYTES."""
+        # Servers that don't know what they have send octet-stream; check the bytes instead
+        typed = response.content_type.startswith('image/')
+        if not typed and response.content_type not in ('application/octet-stream',
+                                                       'binary/octet-stream'):
+            return self._reject(response, url, "not_image", response.content_type)
+        if (response.content_length or 0) > self.thumbnail_max_bytes:
+            return self._reject(response, url, "too_large", f"{response.content_length} bytes")
+
+        chunks = []
+        size = 0
+        sniffed = typed
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > self.thumbnail_max_bytes:
+                return self._reject(response, url, "too_large", f"over {size} bytes")
+            if not sniffed and size >= 12:
+                sniffed = True
+                if image_mime_type(b''.join(chunks)[:12]) == 'application/octet-stream':
+                    return self._reject(response, url, "not_image", "unrecognised signature")
+        return b''.join(chunks)
+
+    def _reject(self, response, url: str, reason: str, detail: str) -> None:
+        # Closing drops the connection rather than draining the rest of the body
+        response.close()
+        self.fetch_failures[reason] += 1
+        print(f"Rejected image from {url}: {reason} ({detail})")
+        return None
+
+    async def query_phash(self, image_url: str,
+                          contents: Optional[bytes] = None) -> Optional[int]:
+        """Perceptual hash of the query image, from upload bytes or its URL.
+
+        Fetching by URL goes through the thumbnail cache, so the galleries
+        built later reuse the tile.
+        """
+        if contents is not None:
+            return await self.executor.run(image_phash, contents)
+        item, validators = await self.fetch_image(self.http_client.session, image_url)
+        if validators is not None and item is not None:
+            tile = await self.executor.run(decode_image, item)
+            if tile is None:
+                return None
+            await self.thumbnail_cache.put(image_url, tile, *validators)
+            item = tile
+        return await self.executor.run(image_phash, item)
+
+    async def process_image(self, img_data):
+        # Decode and resize in the executor; the label is added by the grid renderer
+        return await self.executor.run(decode_tile, img_data)
+
+    async def concatenate_thumbnails(self, engine: str, search_results, image_url,
+                                     inline: Optional[bool] = None):
+        """Build an engine's full gallery and return a URL GPT can read.
+
+        The URL is an imgbb link, or a data: URL when `inline` (default from
+        GALLERY_TRANSPORT) is set.
+        """
+        gallery = await self.build_gallery(
+            engine, search_results, image_url, inline=inline, prerank=False)
+        return gallery.url
+
+    @property
+    def planned_layout(self) -> bool:
+        return self.gallery_layout == 'planned'
+
+    async def build_gallery(self, engine: str, search_results, image_url,
+                            inline: Optional[bool] = None,
+                            prerank: bool = True, publish: bool = True) -> Gallery:
+        """Build an engine's gallery, pre-ranked against the query image.
+
+        Only the PRERANK_TOP_K closest candidates are drawn. If one is within
+        PRERANK_EXACT_BITS of the query, no sheet is published and the
+        gallery carries that index as its decision instead. Without
+        `publish`, the gallery keeps its tiles for `pack_galleries`.
+        """
+        inline = self.inline_galleries if inline is None else inline
+        top_k = self.prerank_top_k if prerank else None
+        rendered = await self.render_thumbnails(
+            engine, search_results, image_url,
+            max_bytes=self.inline_max_bytes if inline else None,
+            top_k=top_k, exact_bits=self.prerank_exact_bits, draw=publish)
+
+        gallery = Gallery(engine=engine, ranking=rendered.ranking, labels=rendered.labels)
+        if not publish:
+            gallery.tiles = rendered.tiles
+            return gallery
+        if rendered.encoded is None:
+            return gallery
+        gallery.url = await self.publish(rendered.encoded, inline)
+        gallery.tokens = rendered.layout.tokens
+        gallery.fixed_tokens = fixed_tokens(sum(rendered.layout.counts), self.gallery_detail)
+        return gallery
+
+    async def publish(self, encoded: bytes, inline: Optional[bool] = None) -> str:
+        """A URL GPT can read for an encoded sheet: imgbb, or a data: URL when inline."""
+        inline = self.inline_galleries if inline is None else inline
+        if inline:
+            return to_data_url(encoded)
         # Upload the image
-        url = await self.upload_image(img_base64)
-        return url
+        file_content = base64.b64encode(encoded).decode('utf-8')
+        if self.upstreams is None:
+            return await self.upload_image(file_content)
+        return await self.upstreams.call("imgbb", lambda: self.upload_image(file_content))
+
+    async def pack_galleries(self, galleries: list[Gallery],
+                             inline: Optional[bool] = None) -> tuple[PackingPlan, list[bytes]]:
+        """Plan and draw the sheets for unpublished galleries, packing several
+        galleries onto one sheet where that costs fewer image tokens."""
+        inline = self.inline_galleries if inline is None else inline
+        by_engine = {gallery.engine: gallery for gallery in galleries}
+        plan = plan_packing({gallery.engine: len(gallery.tiles) for gallery in galleries},
+                            self.gallery_min_tile, self.gallery_detail)
+        started = time.perf_counter()
+        encoded = await asyncio.gather(*[
+            self.executor.run(
+                render_packed,
+                [(by_engine[engine].tiles, by_engine[engine].labels) for engine in sheet.engines],
+                sheet, None, None, self.inline_max_bytes if inline else None)
+            for sheet in plan.sheets])
+        self._observe("grid_render", started)
+        return plan, list(encoded)
+
+    async def render_thumbnails(self, engine: str, search_results: Union[Candidates, Any],
+                                image_url,
+                                max_bytes: Optional[int] = None,
+                                top_k: Optional[int] = None,
+                                exact_bits: int = -1,
+                                draw: bool = True) -> GalleryRender:
+        if not isinstance(search_results, Candidates):
+            search_results = parse_candidates(engine, search_results)
+        # Slot i of the gallery is search_results.slot(i)
+        thumbnails = search_results.thumbnails(image_url)
+
+        started = time.perf_counter()
+        session = self.http_client.session
+        cached = await self.thumbnail_cache.get_many(thumbnails)
+        tasks = [self.fetch_or_revalidate(session, url, entry)
+                 for url, entry in zip(thumbnails, cached)]
+        fetched = await asyncio.gather(*tasks)
+        self._observe("thumbnail_fetch", started)
+
+        # Decode, resize, lay out and encode the gallery as one executor task;
+        # cached tiles skip the decode
+        started = time.perf_counter()
+        rendered = await self.executor.run(
+            render_gallery, [item for item, _ in fetched], None, None,
+            max_bytes, top_k, exact_bits,
+            self.gallery_min_tile if self.planned_layout else None, self.gallery_detail, draw)
+        self._observe("grid_render", started)
+        if self.metrics is not None:
+            self.metrics.record_gallery(rendered)
+        await self.thumbnail_cache.put_many([
+            (thumbnails[index], tile, *fetched[index][1])
+            for index, tile in rendered.decoded.items()])
+        return rendered
 
 
 # Example usage
 async def main():
     start = time.time()
 
-    image_service = ImageService()
-    search_service = SearchService()
+    http_client = HttpClient()
+    await http_client.start()
+    image_executor = ImageExecutor()
+    image_executor.start()
+    image_service = ImageService(http_client, image_executor, ThumbnailCache())
+    search_service = SearchService(http_client)
 
     google_img_search = await search_service.google_search("owala")
     result = await image_service.concatenate_thumbnails("gs", google_img_search, "https://m.media-amazon.com/images/I/41H1NQVybjL.jpg")
@@ -196,6 +395,11 @@ async def main():
     end = time.time()
     print(result)
     print(end - start)
+    print(http_client.stats())
+    print(image_executor.stats())
+    print(image_service.thumbnail_cache.stats())
+    await http_client.close()
+    image_executor.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+import json
+import os
+import time
+import uuid
+from typing import Any, Optional
+from dotenv import load_dotenv
+
+from services.cache import RedisCache
+
+
+load_dotenv()
+
+
+class JobQueue:
+    """Redis-backed work queue for search jobs.
+
+    `jobs:queue` is a list of job ids waiting to run. Claiming a job moves it
+    atomically into the `jobs:processing` sorted set, scored by its
+    visibility deadline; a worker keeps extending that deadline while it
+    runs the job. If the worker dies, the deadline lapses and
+    `requeue_expired` puts the job back. Failed jobs are retried up to
+    JOB_MAX_ATTEMPTS times. Each job's state lives in a `job:<id>` hash.
+
+    Unlike the caches, queue operations do not fail soft: Redis errors
+    propagate so callers can report them.
+    """
+
+    QUEUE_KEY = "jobs:queue"
+    PROCESSING_KEY = "jobs:processing"
+    METRICS_KEY = "jobs:metrics"
+
+    # Pop the oldest queued id and mark it in flight until ARGV[1]
+    CLAIM_SCRIPT = (
+        "local id = redis.call('rpop', KEYS[1]) "
+        "if id then redis.call('zadd', KEYS[2], ARGV[1], id) end "
+        "return id"
+    )
+
+    def __init__(self, cache: RedisCache):
+        self.cache = cache
+        self.visibility_seconds = float(os.getenv('JOB_VISIBILITY_SECONDS', '120'))
+        self.max_attempts = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+        self.ttl = int(os.getenv('JOB_TTL', str(86400)))
+
+    @property
+    def redis(self):
+        return self.cache.text
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"job:{job_id}"
+
+    async def enqueue(self, payload: dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._key(job_id), mapping={
+                "status": "queued",
+                "payload": json.dumps(payload),
+                "attempts": 0,
+                "created_at": time.time(),
+            })
+            pipe.expire(self._key(job_id), self.ttl)
+            pipe.lpush(self.QUEUE_KEY, job_id)
+            pipe.hincrby(self.METRICS_KEY, "enqueued", 1)
+            await pipe.execute()
+        return job_id
+
+    async def claim(self) -> Optional[tuple[str, dict[str, Any]]]:
+        """Returns (job id, payload) of the oldest queued job, or None."""
+        job_id = await self.redis.eval(
+            self.CLAIM_SCRIPT, 2, self.QUEUE_KEY, self.PROCESSING_KEY,
+            time.time() + self.visibility_seconds)
+        if job_id is None:
+            return None
+
+        payload, created_at = await self.redis.hmget(self._key(job_id), "payload", "created_at")
+        if payload is None:
+            # Expired while queued
+            await self.redis.zrem(self.PROCESSING_KEY, job_id)
+            return None
+
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hincrby(self._key(job_id), "attempts", 1)
+            pipe.hset(self._key(job_id), mapping={"status": "running", "started_at": now})
+            pipe.hincrby(self.METRICS_KEY, "claimed", 1)
+            pipe.hincrbyfloat(self.METRICS_KEY, "wait_seconds", now - float(created_at))
+            await pipe.execute()
+        return job_id, json.loads(payload)
+
+    async def heartbeat(self, job_id: str):
+        """Push the job's visibility deadline out while it is still running."""
+        await self.redis.zadd(self.PROCESSING_KEY,
+                              {job_id: time.time() + self.visibility_seconds}, xx=True)
+
+    async def complete(self, job_id: str, result: dict[str, Any]):
+        now = time.time()
+        started_at = await self.redis.hget(self._key(job_id), "started_at")
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._key(job_id), mapping={
+                "status": "done",
+                "result": json.dumps(result),
+                "finished_at": now,
+            })
+            pipe.zrem(self.PROCESSING_KEY, job_id)
+            pipe.hincrby(self.METRICS_KEY, "completed", 1)
+            if started_at is not None:
+                pipe.hincrbyfloat(self.METRICS_KEY, "run_seconds", now - float(started_at))
+            await pipe.execute()
+
+    async def fail(self, job_id: str, error: str):
+        """Requeue the job, or mark it failed once it is out of attempts."""
+        if await self.redis.zrem(self.PROCESSING_KEY, job_id):
+            await self._retry_or_fail(job_id, error)
+
+    async def _retry_or_fail(self, job_id: str, error: str):
+        attempts = int(await self.redis.hget(self._key(job_id), "attempts") or 0)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if attempts < self.max_attempts:
+                pipe.hset(self._key(job_id), mapping={"status": "queued", "error": error})
+                pipe.lpush(self.QUEUE_KEY, job_id)
+                pipe.hincrby(self.METRICS_KEY, "retried", 1)
+            else:
+                pipe.hset(self._key(job_id), mapping={
+                    "status": "failed", "error": error, "finished_at": time.time()})
+                pipe.hincrby(self.METRICS_KEY, "failed", 1)
+            await pipe.execute()
+
+    async def requeue_expired(self) -> int:
+        """Put jobs whose worker stopped heartbeating back on the queue."""
+        requeued = 0
+        for job_id in await self.redis.zrangebyscore(self.PROCESSING_KEY, "-inf", time.time()):
+            # Only the worker that removes it requeues it
+            if await self.redis.zrem(self.PROCESSING_KEY, job_id):
+                await self.redis.hincrby(self.METRICS_KEY, "expired", 1)
+                await self._retry_or_fail(job_id, "visibility timeout expired")
+                requeued += 1
+        return requeued
+
+    async def get(self, job_id: str) -> Optional[dict[str, Any]]:
+        job = await self.redis.hgetall(self._key(job_id))
+        if not job:
+            return None
+        return {
+            "id": job_id,
+            "status": job["status"],
+            "attempts": int(job.get("attempts", 0)),
+            "created_at": float(job["created_at"]),
+            "started_at": float(job["started_at"]) if "started_at" in job else None,
+            "finished_at": float(job["finished_at"]) if "finished_at" in job else None,
+            "result": json.loads(job["result"]) if "result" in job else None,
+            "error": job.get("error"),
+        }
+
+    async def stats(self) -> dict:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.llen(self.QUEUE_KEY)
+            pipe.zcard(self.PROCESSING_KEY)
+            pipe.lindex(self.QUEUE_KEY, -1)
+            pipe.hgetall(self.METRICS_KEY)
+            depth, processing, oldest_id, metrics = await pipe.execute()
+
+        oldest_age = None
+        if oldest_id is not None:
+            created_at = await self.redis.hget(self._key(oldest_id), "created_at")
+            if created_at is not None:
+                oldest_age = round(time.time() - float(created_at), 3)
+
+        claimed = int(metrics.get("claimed", 0))
+        completed = int(metrics.get("completed", 0))
+        return {
+            "depth": depth,
+            "processing": processing,
+            "oldest_queued_seconds": oldest_age,
+            "enqueued": int(metrics.get("enqueued", 0)),
+            "completed": completed,
+            "failed": int(metrics.get("failed", 0)),
+            "retried": int(metrics.get("retried", 0)),
+            "expired": int(metrics.get("expired", 0)),
+            "avg_wait_seconds": round(float(metrics.get("wait_seconds", 0)) / claimed, 3)
+            if claimed else 0.0,
+            "avg_run_seconds": round(float(metrics.get("run_seconds", 0)) / completed, 3)
+            if completed else 0.0,
+        }
@@ -0,0 +1,277 @@
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Any, Optional
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+from openai import (APIConnectionError, APIStatusError, AsyncAzureOpenAI,
+                    DefaultAsyncHttpxClient)
+
+from services.metrics import Metrics
+from services.rate_limit import RateLimitedError, RateLimiter, parse_retry_after
+
+
+load_dotenv()
+
+
+DEFAULT_ENDPOINT = "https://buysmartusnc.openai.azure.com/"
+DEFAULT_API_VERSION = "2024-02-15-preview"
+
+
+class Deployment:
+    """One Azure OpenAI endpoint/deployment pair and what we have seen of it."""
+
+    def __init__(self, name: str, endpoint: str, deployment: str, client: AsyncAzureOpenAI):
+        self.name = name
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.client = client
+        # Smoothed latency of successful calls; None until the first one
+        self.latency: Optional[float] = None
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        # From the x-ratelimit-remaining-* headers of the last response
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.quota_seen_at = 0.0
+
+        self.calls = 0
+        self.failures = 0
+        self.throttled = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def bucket(self) -> str:
+        return f"azure_openai:{self.name}"
+
+    def cooling_down(self, now: float) -> bool:
+        return now < self.cooldown_until
+
+
+def _header_int(headers, name: str) -> Optional[int]:
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMRouter:
+    """Chat completions spread over several Azure OpenAI deployments.
+
+    Deployments come from AZURE_OPENAI_DEPLOYMENTS, a JSON list of
+    {"name", "endpoint", "deployment", "api_key" or "api_key_env",
+    "api_version"} objects; without it there is one deployment built from
+    AZURE_OPENAI_ENDPOINT / AZURE_OPENAI_DEPLOYMENT / AZURE_KEY. Every
+    client shares one httpx connection pool, and ImageService and
+    MatchingService share the router.
+
+    Each call goes to the deployment with the lowest smoothed latency times
+    its calls in flight, skipping those cooling down after a failure, those
+    whose last response reported almost no quota left, and those whose
+    `azure_openai:<name>` rate limit bucket is empty. A 429, 5xx or
+    connection error cools that deployment down (for Retry-After on a 429)
+    and the call moves on to the next one; only when every deployment has
+    failed does the error reach the caller (a RateLimitedError if they were
+    all throttled, so Upstreams backs off and retries).
+    """
+
+    def __init__(self, limiter: Optional[RateLimiter] = None, metrics: Optional[Metrics] = None):
+        self.limiter = limiter
+        self.metrics = metrics
+        self.latency_alpha = float(os.getenv('LLM_LATENCY_ALPHA', '0.2'))
+        # Share of calls sent to a random healthy deployment, so a slow one's latency gets re-measured
+        self.explore = float(os.getenv('LLM_EXPLORE_RATE', '0.05'))
+        # Below this many tokens left in the minute window, a deployment is used last
+        self.min_remaining_tokens = int(os.getenv('LLM_MIN_REMAINING_TOKENS', '4000'))
+        self.cooldown_base = float(os.getenv('LLM_FAILOVER_COOLDOWN_SECONDS', '2'))
+        self.cooldown_max = float(os.getenv('LLM_FAILOVER_COOLDOWN_MAX_SECONDS', '30'))
+        self.timeout = float(os.getenv('LLM_TIMEOUT_SECONDS', '60'))
+        # One keep-alive pool behind every deployment's client
+        self.http = DefaultAsyncHttpxClient()
+        self.deployments = [self._deployment(config) for config in self._configs()]
+        self.failovers = 0
+
+    @staticmethod
+    def _configs() -> list[dict[str, Any]]:
+        configured = os.getenv('AZURE_OPENAI_DEPLOYMENTS')
+        if configured:
+            deployments = json.loads(configured)
+            if isinstance(deployments, list) and deployments:
+                return deployments
+            print("AZURE_OPENAI_DEPLOYMENTS lists no deployments, using AZURE_OPENAI_ENDPOINT")
+        return [{
+            "endpoint": os.getenv('AZURE_OPENAI_ENDPOINT', DEFAULT_ENDPOINT),
+            "deployment": os.getenv('AZURE_OPENAI_DEPLOYMENT', 'gpt-4o'),
+        }]
+
+    def _deployment(self, config: dict[str, Any]) -> Deployment:
+        endpoint = config.get("endpoint", DEFAULT_ENDPOINT)
+        deployment = config.get("deployment", 'gpt-4o')
+        api_key = config.get("api_key") or os.getenv(config.get("api_key_env", 'AZURE_KEY'))
+        client = AsyncAzureOpenAI(
+            api_key=api_key,
+            api_version=config.get("api_version", DEFAULT_API_VERSION),
+            azure_endpoint=endpoint,
+            http_client=self.http,
+            timeout=self.timeout,
+            # Failover replaces the SDK's own retries
+            max_retries=0,
+        )
+        # A lone deployment keeps the bare name, so RATE_LIMIT_AZURE_OPENAI_GPT_4O still applies
+        name = config.get("name") or deployment
+        return Deployment(name, endpoint, deployment, client)
+
+    async def close(self):
+        await self.http.aclose()
+
+    def _quota_low(self, deployment: Deployment, now: float) -> bool:
+        # The headers describe a one-minute window
+        if now - deployment.quota_seen_at > 60:
+            return False
+        return (deployment.remaining_requests == 0
+                or (deployment.remaining_tokens is not None
+                    and deployment.remaining_tokens < self.min_remaining_tokens))
+
+    def ranked(self) -> list[Deployment]:
+        """Deployments in the order to try them."""
+        now = time.monotonic()
+        healthy = [d for d in self.deployments if not d.cooling_down(now)]
+        if len(healthy) > 1 and random.random() < self.explore:
+            first = random.choice(healthy)
+            healthy = [first] + [d for d in healthy if d is not first]
+        else:
+            # Untried deployments go first, so each is measured early on
+            healthy.sort(key=lambda d: (self._quota_low(d, now), d.latency is not None,
+                                        (d.latency or 0.0) * (d.in_flight + 1), d.in_flight))
+        cooling = sorted((d for d in self.deployments if d.cooling_down(now)),
+                         key=lambda d: d.cooldown_until)
+        return healthy + cooling
+
+    async def _has_capacity(self, deployment: Deployment) -> bool:
+        return self.limiter is None or await self.limiter.try_acquire(deployment.bucket)
+
+    async def chat(self, **kwargs) -> Any:
+        """`chat.completions.create(**kwargs)` on the best deployment; `model` is filled in."""
+        ranked = self.ranked()
+        error: Optional[Exception] = None
+        throttled: list[float] = []
+        tried = 0
+        for deployment in ranked:
+            if tried and deployment.cooling_down(time.monotonic()):
+                # Cooling down (perhaps since ranking): only ever a first, last-resort pick
+                continue
+            if not await self._has_capacity(deployment):
+                continue
+            if tried:
+                self.failovers += 1
+                print(f"LLM failing over to {deployment.name} after: {str(error)}")
+            tried += 1
+            try:
+                return await self._call(deployment, kwargs)
+            except APIStatusError as e:
+                if e.status_code != 429 and e.status_code < 500:
+                    # Our request's fault (bad input, content filter); another deployment won't help
+                    raise
+                error = e
+                if e.status_code == 429:
+                    throttled.append(await self._throttle(
+                        deployment, parse_retry_after(e.response.headers)))
+                else:
+                    self._fail(deployment)
+            except APIConnectionError as e:
+                # Timeouts included
+                error = e
+                self._fail(deployment)
+
+        if not tried and self.limiter is not None:
+            # Every bucket is empty: queue on the best-placed deployment
+            best = ranked[0]
+            await self.limiter.acquire(best.bucket)
+            return await self._call(best, kwargs)
+        if len(throttled) == tried:
+            raise RateLimitedError("azure_openai", min(throttled))
+        raise error
+
+    async def _call(self, deployment: Deployment, kwargs: dict[str, Any]) -> Any:
+        deployment.calls += 1
+        deployment.in_flight += 1
+        start = time.perf_counter()
+        try:
+            raw = await deployment.client.chat.completions.with_raw_response.create(
+                model=deployment.deployment, **kwargs)
+            completion = raw.parse()
+        except asyncio.CancelledError:
+            # Abandoned by the caller's deadline: at least this slow
+            self._observe_latency(deployment, time.perf_counter() - start)
+            raise
+        finally:
+            deployment.in_flight -= 1
+
+        elapsed = time.perf_counter() - start
+        self._observe_latency(deployment, elapsed)
+        if self.metrics is not None:
+            self.metrics.llm_seconds.labels(deployment.name).observe(elapsed)
+        deployment.consecutive_failures = 0
+        deployment.cooldown_until = 0.0
+
+        remaining_requests = _header_int(raw.headers, 'x-ratelimit-remaining-requests')
+        remaining_tokens = _header_int(raw.headers, 'x-ratelimit-remaining-tokens')
+        if remaining_requests is not None or remaining_tokens is not None:
+            deployment.remaining_requests = remaining_requests
+            deployment.remaining_tokens = remaining_tokens
+            deployment.quota_seen_at = time.monotonic()
+        if completion.usage is not None:
+            deployment.prompt_tokens += completion.usage.prompt_tokens
+            deployment.completion_tokens += completion.usage.completion_tokens
+        return completion
+
+    def _observe_latency(self, deployment: Deployment, seconds: float):
+        if deployment.latency is None:
+            deployment.latency = seconds
+        else:
+            deployment.latency += self.latency_alpha * (seconds - deployment.latency)
+
+    def _fail(self, deployment: Deployment):
+        deployment.failures += 1
+        deployment.consecutive_failures += 1
+        cooldown = min(self.cooldown_max,
+                       self.cooldown_base * 2 ** (deployment.consecutive_failures - 1))
+        deployment.cooldown_until = time.monotonic() + cooldown
+
+    async def _throttle(self, deployment: Deployment, retry_after: Optional[float]) -> float:
+        deployment.throttled += 1
+        wait = retry_after if retry_after is not None else self.cooldown_base
+        deployment.cooldown_until = max(deployment.cooldown_until, time.monotonic() + wait)
+        deployment.remaining_requests = 0
+        deployment.quota_seen_at = time.monotonic()
+        if self.limiter is not None:
+            # Other workers skip it too
+            await self.limiter.block(deployment.bucket, wait)
+        return wait
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "failovers": self.failovers,
+            "deployments": {
+                d.name: {
+                    "endpoint": urlparse(d.endpoint).netloc or d.endpoint,
+                    "deployment": d.deployment,
+                    "calls": d.calls,
+                    "failures": d.failures,
+                    "throttled": d.throttled,
+                    "in_flight": d.in_flight,
+                    "latency_ms": round(d.latency * 1000, 1) if d.latency is not None else None,
+                    "cooling_down_seconds": round(max(0.0, d.cooldown_until - now), 1),
+                    "remaining_requests": d.remaining_requests,
+                    "remaining_tokens": d.remaining_tokens,
+                    "prompt_tokens": d.prompt_tokens,
+                    "completion_tokens": d.completion_tokens,
+                }
+                for d in self.deployments
+            },
+        }
@@ -1,59 +1,71 @@
-from openai import AsyncAzureOpenAI
 import json
 from dotenv import load_dotenv
 import os
+from typing import Optional
+
+from services.candidates import Candidates
+from services.llm_router import LLMRouter
+
+class UnusableMatchError(Exception):
+    """GPT's matching reply has no index that was drawn on any of its galleries."""
+
+    def __init__(self, reply):
+        super().__init__(f"no usable match index from GPT: {reply!r}")
+        self.reply = reply
+
+
+# Engine name -> key of its match in SearchResult.matches
+RESULT_KEYS = {
+    'amz': 'amazon',
+    'gs': 'google_search',
+    'gis': 'google_image_search',
+    'lens': 'google_lens',
+}
 
 
 class MatchingService:
-    def __init__(self):
-        self.azure_client = AsyncAzureOpenAI(
-            api_key=os.getenv('AZURE_KEY'),
-            api_version="2024-02-15-preview",
-            azure_endpoint="https://buysmartusnc.openai.azure.com/"
-        )
+    def __init__(self, llm: Optional[LLMRouter] = None):
+        self.llm = llm or LLMRouter()
+        # GPT vision detail for gallery sheets; 'low' cannot read the labels
+        self.detail = os.getenv('VISION_DETAIL_MATCHING', 'auto')
+
+    async def get_matching_images(self, galleries: dict[str, str], detail: Optional[str] = None):
+        """Ask GPT for the closest match to image 0 in each gallery.
 
-    async def get_matching_images(self, image_urls: list[str]):
+        `galleries` maps engine name to gallery image URL; the JSON reply maps
+        the same engine names to the chosen image label.
+        """
+        return await self.get_matching_sheets(
+            [([engine], url) for engine, url in galleries.items()], detail)
+
+    async def get_matching_sheets(self, sheets: list[tuple[list[str], str]],
+                                  detail: Optional[str] = None):
+        """get_matching_images for sheets that may hold several galleries.
+
+        Each sheet is (engine names top to bottom, image URL); a sheet with
+        more than one gallery has each under a "Gallery: <name>" header.
+        """
         message_text = (
-            "You will be given four image galleries with each image labeled from 0 to n. "
+            "You will be given image galleries, each introduced by its name, with each image labeled by its index. "
+            "An image may hold several galleries one under another, each under a header with its name, "
+            "and every gallery has its own image 0. "
             "Combine with the description and compare all other images to image 0 and return in JSON "
-            "with the image index that is visually matching closest with image 0 for each image gallery")
-        completion = await self.azure_client.chat.completions.create(
-            model="gpt-4o",
+            "with the image index that is visually matching closest with image 0 for each image gallery, "
+            "keyed by gallery name")
+        content = []
+        for engines, url in sheets:
+            if len(engines) == 1:
+                content.append({"type": "text", "text": f"Gallery: {engines[0]}"})
+            else:
+                content.append({"type": "text",
+                                "text": f"Galleries: {', '.join(engines)} (top to bottom)"})
+            content.append({"type": "image_url",
+                            "image_url": {"url": url, "detail": detail or self.detail}})
+
+        completion = await self.llm.chat(
             messages=[
                 {"role": "system", "content": message_text},
-                {
-                    "role": "user",
-                    "content": [
-                        # {
-                        # "type": "text",
-                        # # "text": "User description: " + self.description,
-                        # },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_urls[0],
-                            },
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_urls[1],
-                            },
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_urls[2],
-                            },
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_urls[3],
-                            },
-                        },
-                    ],
-                }
+                {"role": "user", "content": content},
             ],
             max_tokens=2000,
             temperature=0,
@@ -61,3 +73,34 @@ class MatchingService:
         )
 
         return completion.choices[0].message.content
+
+    async def get_matching_image(self, engine: str, url: str,
+                                 detail: Optional[str] = None) -> Optional[int]:
+        """Single-gallery get_matching_images, so each engine can be matched
+        as soon as its own gallery is ready."""
+        reply = json.loads(await self.get_matching_images({engine: url}, detail))
+        index = reply.get(engine)
+        if index is None and len(reply) == 1:
+            # With one gallery the model sometimes picks its own key name
+            index = next(iter(reply.values()))
+        try:
+            return int(index)
+        except (TypeError, ValueError):
+            return None
+
+    async def extract_matching_objects(self, matching_indices: dict[str, int],
+                                       candidates: dict[str, Candidates]):
+        """Look up each engine's chosen gallery slot in its parsed candidates."""
+        extracted_objects = {}
+
+        for engine, index in matching_indices.items():
+            print(f"Processing engine: {engine}, index: {index}")
+            engine_candidates = candidates.get(engine)
+            if engine_candidates is None:
+                print(f"No results found for engine {engine}")
+                continue
+            candidate = engine_candidates.slot(index)
+            if candidate is not None:
+                extracted_objects[RESULT_KEYS[engine]] = candidate.to_match()
+
+        return extracted_objects
@@ -0,0 +1,244 @@
+import time
+from typing import Callable, Iterable, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, Metric
+
+from services.stage_graph import StageGraph
+
+
+# Seconds; covers cache hits (ms) up to a search that runs out its budget
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 25, 60)
+
+# Bytes; a gallery of small thumbnails up to one of multi-megapixel originals
+BYTE_BUCKETS = (64e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6, 32e6, 64e6)
+
+# Outbound hosts reported under their own name; everything else is a thumbnail CDN
+PROVIDER_HOSTS = {
+    "serpapi.com": "serpapi",
+    "scraper-api.smartproxy.com": "smartproxy",
+    "api.imgbb.com": "imgbb",
+}
+
+
+class Metrics:
+    """Prometheus metrics served on /metrics.
+
+    Only latencies are observed on the request path (a histogram observe is
+    about a microsecond). Counters the services already keep for /stats
+    (upstream calls, HTTP bytes, cache hits, loop lag) are read when
+    Prometheus scrapes, through `StatsCollector`, so they cost nothing per
+    request. Metrics are per process: with several uvicorn workers, scrape
+    each one (or run one worker per container).
+    """
+
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        self.stage_seconds = Histogram(
+            'pipeline_stage_seconds', "Duration of one pipeline stage",
+            ['stage'], buckets=LATENCY_BUCKETS, registry=self.registry)
+        self.upstream_seconds = Histogram(
+            'upstream_request_seconds', "Latency of successful upstream calls",
+            ['upstream'], buckets=LATENCY_BUCKETS, registry=self.registry)
+        self.llm_seconds = Histogram(
+            'llm_request_seconds', "Latency of successful chat completions per Azure deployment",
+            ['deployment'], buckets=LATENCY_BUCKETS, registry=self.registry)
+        self.request_seconds = Histogram(
+            'http_request_seconds', "Latency of API requests, streamed bodies included",
+            ['route', 'status'], buckets=LATENCY_BUCKETS, registry=self.registry)
+        self.gallery_download_bytes = Histogram(
+            'gallery_download_bytes', "Thumbnail bytes downloaded and decoded for one gallery",
+            buckets=BYTE_BUCKETS, registry=self.registry)
+        self.gallery_decode_seconds = Histogram(
+            'gallery_decode_seconds', "Time decoding one gallery's downloaded thumbnails",
+            buckets=LATENCY_BUCKETS, registry=self.registry)
+        self.gallery_peak_bytes = Histogram(
+            'gallery_peak_bytes', "Estimated peak memory of one gallery's render task",
+            buckets=BYTE_BUCKETS, registry=self.registry)
+        self.in_flight = Gauge(
+            'http_requests_in_flight', "API requests being served", registry=self.registry)
+        # Labelled children, looked up once; `labels()` costs as much as the observe
+        self._stages: dict[str, Histogram] = {}
+
+    def observe_stage(self, stage: str, started: float):
+        """Record a stage that began at `started` (time.perf_counter())."""
+        self.stage(stage).observe(time.perf_counter() - started)
+
+    def stage(self, stage: str) -> Histogram:
+        if stage not in self._stages:
+            self._stages[stage] = self.stage_seconds.labels(stage)
+        return self._stages[stage]
+
+    def record_graph(self, graph: StageGraph):
+        for name, finished in graph.finished.items():
+            self.stage(stage_kind(name)).observe(finished - graph.started[name])
+
+    def record_gallery(self, rendered):
+        """Record a `GalleryRender`'s download size, decode time and peak memory."""
+        self.gallery_download_bytes.observe(rendered.downloaded_bytes)
+        self.gallery_decode_seconds.observe(rendered.decode_seconds)
+        self.gallery_peak_bytes.observe(rendered.peak_bytes)
+
+    def watch(self, collect: Callable[[], Iterable[Metric]]):
+        """Register a callable that builds metric families at scrape time."""
+        self.registry.register(StatsCollector(collect))
+
+    def render(self) -> tuple[bytes, str]:
+        return generate_latest(self.registry), CONTENT_TYPE_LATEST
+
+
+def stage_kind(name: str) -> str:
+    # amz_search -> search:amz, so each kind of stage can be aggregated across engines
+    engine, _, kind = name.partition('_')
+    if kind in ("search", "gallery", "match"):
+        return f"{kind}:{engine}"
+    return name
+
+
+def provider_of(host: Optional[str]) -> str:
+    return PROVIDER_HOSTS.get(host or "", "thumbnails")
+
+
+class StatsCollector:
+    """Adapts a callable returning metric families to a registry collector."""
+
+    def __init__(self, collect: Callable[[], Iterable[Metric]]):
+        self._collect = collect
+
+    def collect(self):
+        return self._collect()
+
+    def describe(self):
+        # Scrape-time values; nothing to check up front
+        return []
+
+
+def counter(name: str, documentation: str, labels: list[str],
+            values: dict[tuple, float]) -> CounterMetricFamily:
+    family = CounterMetricFamily(name, documentation, labels=labels)
+    for label_values, value in values.items():
+        family.add_metric(list(label_values), value)
+    return family
+
+
+def gauge(name: str, documentation: str, value: float) -> GaugeMetricFamily:
+    return GaugeMetricFamily(name, documentation, value=value)
+
+
+def by_provider(by_host: dict[str, float]) -> dict[tuple, float]:
+    totals: dict[tuple, float] = {}
+    for host, value in by_host.items():
+        key = (provider_of(host),)
+        totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def service_metrics(http_client, upstreams, stage_cache, thumbnail_cache, image_service,
+                    loop_monitor, single_flight, llm_router, result_stats: dict,
+                    upload_stats: dict, matching_stats: dict) -> list[Metric]:
+    """The services' own /stats counters as Prometheus families."""
+    upstream_stats = upstreams.stats()
+    deployments = llm_router.deployments
+    return [
+        counter('upstream_calls_total', "Upstream calls, retries included", ['upstream'],
+                {(name, ): stats["calls"] for name, stats in upstream_stats.items()}),
+        counter('upstream_errors_total', "Failed upstream calls by kind", ['upstream', 'kind'],
+                {(name, kind): stats[field]
+                 for name, stats in upstream_stats.items()
+                 for kind, field in (("error", "failures"), ("timeout", "timeouts"),
+                                     ("circuit_open", "rejected"),
+                                     ("rate_limited", "rate_limited"))}),
+        counter('upstream_retries_429_total', "Upstream calls retried after a 429",
+                ['upstream'],
+                {(name, ): stats["retries_429"] for name, stats in upstream_stats.items()}),
+        counter('llm_calls_total', "Chat completions sent to each Azure deployment",
+                ['deployment', 'outcome'],
+                {(d.name, outcome): n for d in deployments
+                 for outcome, n in (("sent", d.calls), ("error", d.failures),
+                                    ("throttled", d.throttled))}),
+        counter('llm_tokens_total', "Tokens billed by each Azure deployment", ['deployment', 'kind'],
+                {(d.name, kind): n for d in deployments
+                 for kind, n in (("prompt", d.prompt_tokens), ("completion", d.completion_tokens))}),
+        counter('llm_failovers_total', "Chat completions retried on another deployment",
+                [], {(): llm_router.failovers}),
+        counter('outbound_requests_total', "Outbound HTTP requests by provider", ['provider'],
+                by_provider(http_client.requests_by_host)),
+        counter('outbound_errors_total', "Outbound HTTP requests that raised", ['provider'],
+                by_provider(http_client.errors_by_host)),
+        counter('outbound_response_bytes_total', "Response body bytes received by provider",
+                ['provider'], by_provider(http_client.bytes_by_host)),
+        gauge('outbound_requests_in_flight', "Outbound HTTP requests in flight",
+              http_client.in_flight),
+        counter('stage_cache_lookups_total', "Stage cache lookups", ['stage', 'result'],
+                {(stage, result): stage_cache.hits[stage] if result == "hit"
+                 else stage_cache.misses[stage]
+                 for stage in set(stage_cache.hits) | set(stage_cache.misses)
+                 for result in ("hit", "miss")}),
+        counter('result_cache_lookups_total', "Whole-result cache lookups", ['result'],
+                {(result, ): value for result, value in result_stats.items()}),
+        counter('upload_bytes_total', "Uploaded query image bytes, as received and as hosted",
+                ['stage'], {("received", ): upload_stats["bytes_received"],
+                            ("hosted", ): upload_stats["bytes_uploaded"]}),
+        counter('upload_vision_tokens_saved_total',
+                "Estimated GPT image tokens saved by downscaling uploads",
+                [], {(): upload_stats["vision_tokens_saved"]}),
+        counter('matching_vision_tokens_total',
+                "Estimated GPT image tokens sent for matching, and what fixed grids would have cost",
+                ['layout'], {("sent", ): matching_stats["tokens"],
+                             ("fixed", ): matching_stats["fixed_tokens"]}),
+        counter('matching_images_total', "Gallery sheets sent to GPT for matching",
+                [], {(): matching_stats["images"]}),
+        counter('single_flight_total', "Searches run (leader) or coalesced onto another",
+                ['role'], {("leader", ): single_flight.leaders,
+                           ("coalesced_local", ): single_flight.coalesced_local,
+                           ("coalesced_remote", ): single_flight.coalesced_remote}),
+        counter('thumbnail_cache_lookups_total', "Thumbnail cache lookups", ['result'],
+                {("hit", ): thumbnail_cache.hits,
+                 ("revalidated", ): thumbnail_cache.revalidated,
+                 ("stale", ): thumbnail_cache.stale_served,
+                 ("miss", ): thumbnail_cache.misses}),
+        counter('thumbnail_fetch_failures_total', "Thumbnails that could not be fetched",
+                ['reason'], {(reason, ): n for reason, n in image_service.fetch_failures.items()}),
+        gauge('event_loop_lag_seconds', "Event loop lag at the last sample",
+              loop_monitor.last_lag),
+        gauge('event_loop_max_lag_seconds', "Largest event loop lag seen", loop_monitor.max_lag),
+        counter('event_loop_blocked_seconds', "Time the event loop spent stalled",
+                [], {(): loop_monitor.blocked_seconds}),
+    ]
+
+
+class RequestMetrics:
+    """ASGI middleware timing API requests and counting those in flight.
+
+    Plain ASGI rather than `@app.middleware("http")`, which wraps every
+    response in extra tasks and streams; the route label is the matched
+    path template, so /jobs/{job_id} is one series.
+    """
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_and_record(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        # The route is only known once the router has run
+        self.metrics.in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            self.metrics.in_flight.dec()
+            route = scope.get("route")
+            self.metrics.request_seconds.labels(
+                getattr(route, "path", "unmatched"), str(status)).observe(
+                time.perf_counter() - started)
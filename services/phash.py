@@ -0,0 +1,108 @@
+"""Perceptual fingerprints for ranking gallery tiles against the query image.
+
+A fingerprint is a 64-bit pHash (DCT of a 32x32 greyscale), a 64-bit dHash
+(horizontal gradient signs of a 9x8 greyscale) and a 64-bin colour
+histogram. Everything is plain NumPy on the 150x150 tiles the galleries
+already decode, so it runs in the image executor next to the grid render.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+import cv2
+import numpy as np
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT_32 = _dct_matrix(32)
+_BIT_WEIGHTS = (1 << np.arange(64, dtype=np.uint64)).astype(np.uint64)
+
+
+def _pack_bits(bits: np.ndarray) -> int:
+    return int(np.sum(bits.ravel().astype(np.uint64) * _BIT_WEIGHTS, dtype=np.uint64))
+
+
+def _grey(tile: np.ndarray) -> np.ndarray:
+    return cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY) if tile.ndim == 3 else tile
+
+
+def phash(tile: np.ndarray) -> int:
+    small = cv2.resize(_grey(tile), (32, 32), interpolation=cv2.INTER_AREA).astype(np.float64)
+    low = (_DCT_32 @ small @ _DCT_32.T)[:8, :8]
+    # The DC term only encodes overall brightness; leave it out of the median
+    median = np.median(low.ravel()[1:])
+    return _pack_bits(low > median)
+
+
+def dhash(tile: np.ndarray) -> int:
+    small = cv2.resize(_grey(tile), (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return _pack_bits(small[:, 1:] > small[:, :-1])
+
+
+def color_histogram(tile: np.ndarray) -> np.ndarray:
+    # 4 levels per BGR channel -> 64 bins, normalised to sum to 1
+    quantised = (tile >> 6).reshape(-1, 3).astype(np.int32)
+    bins = quantised[:, 0] * 16 + quantised[:, 1] * 4 + quantised[:, 2]
+    hist = np.bincount(bins, minlength=64).astype(np.float32)
+    return hist / hist.sum()
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+@dataclass
+class Fingerprint:
+    phash: int
+    dhash: int
+    histogram: np.ndarray
+
+    def distance(self, other: "Fingerprint") -> float:
+        """Blend of the three signals in [0, 1]; lower is more similar."""
+        hist_distance = 0.5 * float(np.abs(self.histogram - other.histogram).sum())
+        return (0.5 * hamming(self.phash, other.phash) / 64
+                + 0.3 * hamming(self.dhash, other.dhash) / 64
+                + 0.2 * hist_distance)
+
+    def is_near_duplicate(self, other: "Fingerprint", max_bits: int) -> bool:
+        return (hamming(self.phash, other.phash) <= max_bits
+                and hamming(self.dhash, other.dhash) <= max_bits)
+
+
+def fingerprint(tile: np.ndarray) -> Fingerprint:
+    return Fingerprint(phash(tile), dhash(tile), color_histogram(tile))
+
+
+@dataclass
+class Ranking:
+    # (gallery index, distance) for the kept candidates, closest first
+    candidates: list[tuple[int, float]]
+    # Gallery index of a near-exact match to the query, if any
+    exact_index: Optional[int] = None
+    exact_bits: Optional[int] = None
+
+
+def rank_candidates(query: Fingerprint, candidates: dict[int, Fingerprint],
+                    top_k: int, exact_bits: int) -> Ranking:
+    """Order candidates by distance to the query and keep the closest `top_k`.
+
+    `top_k <= 0` keeps every candidate; `exact_bits < 0` disables the
+    near-exact shortcut.
+    """
+    scored = sorted(((index, fp.distance(query)) for index, fp in candidates.items()),
+                    key=lambda item: item[1])
+    kept = scored[:top_k] if top_k > 0 else scored
+
+    ranking = Ranking(candidates=[(index, round(score, 4)) for index, score in kept])
+    if exact_bits >= 0 and scored:
+        best = candidates[scored[0][0]]
+        if best.is_near_duplicate(query, exact_bits):
+            ranking.exact_index = scored[0][0]
+            ranking.exact_bits = hamming(best.phash, query.phash)
+    return ranking
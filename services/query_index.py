@@ -0,0 +1,276 @@
+import asyncio
+import heapq
+import os
+import time
+from typing import Optional
+from dotenv import load_dotenv
+
+from services.cache import RedisCache
+from services.phash import hamming
+
+
+load_dotenv()
+
+
+class MultiIndexHash:
+    """Multi-index hashing over 64-bit hashes under Hamming distance.
+
+    Each hash is split into four 16-bit chunks with one table per chunk.
+    Two hashes within distance d differ by at most d // 4 bits in at least
+    one chunk, so a lookup only probes the chunk values within that many
+    bit flips and checks the few entries stored under them, instead of
+    scanning every entry the way a BK-tree degrades to on uniform hashes.
+    """
+
+    CHUNKS = 4
+    CHUNK_BITS = 16
+    # Probes flip at most two bits per chunk
+    MAX_DISTANCE = 11
+
+    def __init__(self):
+        self._values: dict[int, str] = {}
+        self._tables: list[dict[int, list[int]]] = [{} for _ in range(self.CHUNKS)]
+
+    @property
+    def size(self) -> int:
+        return len(self._values)
+
+    def _chunks(self, key: int) -> list[int]:
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [(key >> (i * self.CHUNK_BITS)) & mask for i in range(self.CHUNKS)]
+
+    def add(self, key: int, value: str):
+        if key not in self._values:
+            for table, chunk in zip(self._tables, self._chunks(key)):
+                table.setdefault(chunk, []).append(key)
+        self._values[key] = value
+
+    def remove(self, key: int):
+        if self._values.pop(key, None) is None:
+            return
+        for table, chunk in zip(self._tables, self._chunks(key)):
+            entries = table[chunk]
+            entries.remove(key)
+            if not entries:
+                del table[chunk]
+
+    def _probes(self, chunk: int, radius: int):
+        yield chunk
+        if radius >= 1:
+            for i in range(self.CHUNK_BITS):
+                flipped = chunk ^ (1 << i)
+                yield flipped
+                if radius >= 2:
+                    for j in range(i + 1, self.CHUNK_BITS):
+                        yield flipped ^ (1 << j)
+
+    def nearest(self, key: int, max_distance: int) -> Optional[tuple[int, int, str]]:
+        """Return (distance, key, value) of the closest entry within `max_distance`."""
+        exact = self._values.get(key)
+        if exact is not None:
+            return 0, key, exact
+
+        if max_distance > self.MAX_DISTANCE:
+            raise ValueError(f"MultiIndexHash supports max_distance up to {self.MAX_DISTANCE}")
+        radius = max_distance // self.CHUNKS
+
+        best: Optional[tuple[int, int, str]] = None
+        seen = set()
+        for table, chunk in zip(self._tables, self._chunks(key)):
+            for probe in self._probes(chunk, radius):
+                for candidate in table.get(probe, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    distance = hamming(key, candidate)
+                    if distance <= max_distance and (best is None or distance < best[0]):
+                        best = (distance, candidate, self._values[candidate])
+        return best
+
+
+class QueryIndex:
+    """Perceptual-hash index of past query images -> their result cache key.
+
+    Lets a re-upload, resize or recompression of an earlier query image
+    reuse that query's cached `final_result`. Entries live as long as the
+    results they point to (`ttl`) and are dropped early if their result is
+    found gone. They are persisted to a file (QUERY_INDEX_PATH, compacted at
+    startup) and/or Redis: a hash of entries plus a sorted set of their
+    expiry times, which is pruned and read for entries other workers added
+    every QUERY_INDEX_REFRESH_SECONDS.
+    """
+
+    REDIS_KEY = "query_index:entries"
+    EXPIRY_KEY = "query_index:expiry"
+    # Other workers' clocks may be a little behind ours
+    CLOCK_SKEW_SECONDS = 60
+
+    ADD_SCRIPT = (
+        "redis.call('hset', KEYS[1], ARGV[1], ARGV[2]) "
+        "redis.call('zadd', KEYS[2], ARGV[3], ARGV[1])"
+    )
+    # Drop entries expired by ARGV[1], then return hash, key, expiry of
+    # those expiring after ARGV[2]
+    REFRESH_SCRIPT = (
+        "for _, hash in ipairs(redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[1])) do "
+        "redis.call('hdel', KEYS[1], hash) end "
+        "redis.call('zremrangebyscore', KEYS[2], '-inf', ARGV[1]) "
+        "local fresh = redis.call('zrangebyscore', KEYS[2], '(' .. ARGV[2], '+inf', 'withscores') "
+        "local out = {} "
+        "for i = 1, #fresh, 2 do "
+        "local key = redis.call('hget', KEYS[1], fresh[i]) "
+        "if key then table.insert(out, fresh[i]) table.insert(out, key) "
+        "table.insert(out, fresh[i + 1]) end end "
+        "return out"
+    )
+    REMOVE_SCRIPT = (
+        "redis.call('hdel', KEYS[1], ARGV[1]) "
+        "redis.call('zrem', KEYS[2], ARGV[1])"
+    )
+
+    def __init__(self, cache: Optional[RedisCache] = None, ttl: int = 3600):
+        self.max_distance = int(os.getenv('QUERY_INDEX_MAX_DISTANCE', '6'))
+        if not 0 <= self.max_distance <= MultiIndexHash.MAX_DISTANCE:
+            raise ValueError(f"QUERY_INDEX_MAX_DISTANCE must be between 0 and "
+                             f"{MultiIndexHash.MAX_DISTANCE}, got {self.max_distance}")
+        self.path = os.getenv('QUERY_INDEX_PATH') or None
+        self.refresh_seconds = float(os.getenv('QUERY_INDEX_REFRESH_SECONDS', '5'))
+        self.cache = cache
+        self.ttl = ttl
+        self.hashes = MultiIndexHash()
+        # Hash -> wall-clock expiry, and a heap of (expiry, hash) to prune by
+        self._expires: dict[int, float] = {}
+        self._expiry_heap: list[tuple[float, int]] = []
+        # Latest expiry read from Redis, and when we last read it
+        self._seen_until = 0.0
+        self._refreshed_at = 0.0
+        self._refreshing: Optional[asyncio.Task] = None
+
+        self.lookups = 0
+        self.hits = 0
+        self.expired = 0
+        self.lookup_seconds = 0.0
+        self.max_lookup_seconds = 0.0
+
+    @property
+    def size(self) -> int:
+        return self.hashes.size
+
+    def _index(self, phash: int, cache_key: str, expires_at: float):
+        if expires_at <= time.time():
+            return
+        self.hashes.add(phash, cache_key)
+        if self._expires.get(phash, 0.0) < expires_at:
+            self._expires[phash] = expires_at
+            heapq.heappush(self._expiry_heap, (expires_at, phash))
+
+    def _drop(self, phash: int):
+        self.hashes.remove(phash)
+        self._expires.pop(phash, None)
+
+    def prune(self, now: Optional[float] = None):
+        """Drop entries whose results have expired."""
+        now = time.time() if now is None else now
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires_at, phash = heapq.heappop(heap)
+            # Re-added entries leave their older expiry behind in the heap
+            if self._expires.get(phash) == expires_at:
+                self._drop(phash)
+                self.expired += 1
+
+    async def load(self):
+        if self.path and os.path.exists(self.path):
+            await asyncio.to_thread(self._load_file)
+        await self.refresh()
+
+    def _load_file(self):
+        live = []
+        now = time.time()
+        with open(self.path) as f:
+            lines = f.readlines()
+        for line in lines:
+            parts = line.split()
+            # Lines without an expiry predate it; their results are long gone
+            if len(parts) == 3 and float(parts[2]) > now:
+                self._index(int(parts[0], 16), parts[1], float(parts[2]))
+                live.append(line)
+        if len(live) < len(lines):
+            # Compact: rewrite with only the live entries
+            with open(self.path + '.tmp', 'w') as f:
+                f.writelines(live)
+            os.replace(self.path + '.tmp', self.path)
+
+    async def refresh(self):
+        """Prune expired entries, here and in Redis, and read in new ones."""
+        self._refreshed_at = time.monotonic()
+        now = time.time()
+        self.prune(now)
+        if self.cache is None:
+            return
+        since = max(0.0, self._seen_until - self.CLOCK_SKEW_SECONDS)
+        fresh = await self.cache.eval(self.REFRESH_SCRIPT, [self.REDIS_KEY, self.EXPIRY_KEY],
+                                      [now, since])
+        for i in range(0, len(fresh or ()), 3):
+            expires_at = float(fresh[i + 2])
+            self._index(int(fresh[i], 16), fresh[i + 1], expires_at)
+            self._seen_until = max(self._seen_until, expires_at)
+
+    async def lookup(self, phash: int) -> Optional[tuple[int, int, str]]:
+        """(distance, indexed hash, result cache key) of the closest entry.
+
+        Only the in-memory search is timed. A lookup is not a hit until the
+        caller has read the result: see `hit` and `discard`.
+        """
+        if time.monotonic() - self._refreshed_at >= self.refresh_seconds:
+            if self._refreshing is None or self._refreshing.done():
+                # Share one refresh between concurrent lookups
+                self._refreshing = asyncio.create_task(self.refresh())
+            await asyncio.shield(self._refreshing)
+
+        start = time.perf_counter()
+        match = self.hashes.nearest(phash, self.max_distance)
+        elapsed = time.perf_counter() - start
+
+        self.lookups += 1
+        self.lookup_seconds += elapsed
+        self.max_lookup_seconds = max(self.max_lookup_seconds, elapsed)
+        return match
+
+    def hit(self):
+        """The matched entry's result was still cached and is being reused."""
+        self.hits += 1
+
+    async def discard(self, phash: int):
+        """Drop an entry whose result has gone from the cache."""
+        self._drop(phash)
+        self.expired += 1
+        if self.cache is not None:
+            await self.cache.eval(self.REMOVE_SCRIPT, [self.REDIS_KEY, self.EXPIRY_KEY],
+                                  [f"{phash:016x}"])
+
+    async def add(self, phash: int, cache_key: str):
+        expires_at = time.time() + self.ttl
+        self._index(phash, cache_key, expires_at)
+        hex_hash = f"{phash:016x}"
+        if self.path:
+            await asyncio.to_thread(self._append, f"{hex_hash} {cache_key} {expires_at:.0f}\n")
+        if self.cache is not None:
+            await self.cache.eval(self.ADD_SCRIPT, [self.REDIS_KEY, self.EXPIRY_KEY],
+                                  [hex_hash, cache_key, expires_at])
+
+    def _append(self, line: str):
+        with open(self.path, 'a') as f:
+            f.write(line)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.hashes.size,
+            "max_distance": self.max_distance,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_ratio": self.hits / self.lookups if self.lookups else 0.0,
+            "expired": self.expired,
+            "avg_lookup_us": round(self.lookup_seconds / self.lookups * 1e6, 2) if self.lookups else 0.0,
+            "max_lookup_us": round(self.max_lookup_seconds * 1e6, 2),
+        }
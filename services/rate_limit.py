@@ -0,0 +1,253 @@
+import asyncio
+import os
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from email.utils import parsedate_to_datetime
+from typing import Any, Optional
+from dotenv import load_dotenv
+
+from services.cache import RedisCache
+
+
+load_dotenv()
+
+
+class RateLimitedError(Exception):
+    """An upstream answered 429 (or its equivalent)."""
+
+    def __init__(self, upstream: str, retry_after: Optional[float] = None):
+        detail = f", retry after {retry_after:.1f}s" if retry_after is not None else ""
+        super().__init__(f"{upstream} rate limited the request{detail}")
+        self.retry_after = retry_after
+
+
+class RateLimitWaitExceeded(Exception):
+    pass
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Seconds from `Retry-After` (delta or HTTP date) or `retry-after-ms`."""
+    if headers is None:
+        return None
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def rate_limit_of(error: Exception) -> Optional[RateLimitedError]:
+    """The 429 behind `error`, if it is one: ours, or an SDK status error
+    (openai.RateLimitError carries `status_code` and `response.headers`)."""
+    if isinstance(error, RateLimitedError):
+        return error
+    if getattr(error, 'status_code', None) == 429:
+        response = getattr(error, 'response', None)
+        return RateLimitedError(type(error).__name__,
+                                parse_retry_after(getattr(response, 'headers', None)))
+    return None
+
+
+class LocalBucket:
+    """In-process token bucket, used while Redis is unreachable."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def take(self) -> float:
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """Token buckets per provider (and per deployment), shared through Redis.
+
+    Each upstream draws from one bucket: all SerpAPI engines share the
+    `serpapi` account bucket, and LLMRouter draws from one bucket per Azure
+    OpenAI deployment (`azure_openai:<name>`). Rates come from
+    RATE_LIMIT_<BUCKET> (requests per second) and RATE_BURST_<BUCKET>, e.g.
+    RATE_LIMIT_SERPAPI=5 or RATE_LIMIT_AZURE_OPENAI_GPT_4O=2; a bucket without
+    a rate is not throttled, but still honours `block()`, which a 429's
+    Retry-After uses to pause every worker. Callers that find the bucket
+    empty wait their turn instead of sending the request.
+    """
+
+    # KEYS[1] bucket hash; ARGV rate/s, burst, ttl ms. Returns ms to wait, 0 = granted
+    TAKE_SCRIPT = """
+local t = redis.call('time')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local b = redis.call('hmget', KEYS[1], 'tokens', 'ts', 'blocked_until')
+local blocked = tonumber(b[3]) or 0
+if now < blocked then return blocked - now end
+if rate <= 0 then return 0 end
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('pexpire', KEYS[1], ARGV[3])
+return wait
+"""
+
+    # KEYS[1] bucket hash; ARGV block ms, ttl ms
+    BLOCK_SCRIPT = """
+local t = redis.call('time')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+local until_ms = now + tonumber(ARGV[1])
+local blocked = tonumber(redis.call('hget', KEYS[1], 'blocked_until')) or 0
+if until_ms > blocked then redis.call('hset', KEYS[1], 'blocked_until', until_ms) end
+redis.call('pexpire', KEYS[1], math.max(tonumber(ARGV[2]), tonumber(ARGV[1])))
+return 0
+"""
+
+    DEFAULT_BUCKETS = {
+        "serpapi_google": "serpapi",
+        "serpapi_google_images": "serpapi",
+        "serpapi_google_lens": "serpapi",
+    }
+
+    def __init__(self, cache: Optional[RedisCache] = None):
+        self.cache = cache
+        self.max_wait_seconds = float(os.getenv('RATE_LIMIT_MAX_WAIT_SECONDS', '30'))
+        self._local: dict[str, LocalBucket] = {}
+
+        self.acquired: Counter = Counter()
+        self.waits: Counter = Counter()
+        self.wait_seconds: defaultdict[str, float] = defaultdict(float)
+        self.max_wait: defaultdict[str, float] = defaultdict(float)
+        self.throttled: Counter = Counter()
+
+    def bucket_of(self, upstream: str) -> str:
+        return self.DEFAULT_BUCKETS.get(upstream, upstream)
+
+    @staticmethod
+    def _env_name(bucket: str) -> str:
+        return re.sub(r'[^A-Z0-9]+', '_', bucket.upper()).strip('_')
+
+    def limits(self, bucket: str) -> tuple[float, float]:
+        name = self._env_name(bucket)
+        rate = float(os.getenv(f'RATE_LIMIT_{name}', '0'))
+        burst = float(os.getenv(f'RATE_BURST_{name}', str(max(1.0, rate))))
+        return rate, burst
+
+    def _local_bucket(self, bucket: str) -> LocalBucket:
+        if bucket not in self._local:
+            self._local[bucket] = LocalBucket(*self.limits(bucket))
+        return self._local[bucket]
+
+    async def _take(self, bucket: str) -> float:
+        """Seconds until a token is available; 0 means one was taken."""
+        rate, burst = self.limits(bucket)
+        if self.cache is not None:
+            ttl_ms = int(max(60.0, burst / rate if rate > 0 else 0) * 1000)
+            wait_ms = await self.cache.eval(self.TAKE_SCRIPT, [f"ratelimit:{bucket}"],
+                                            [rate, burst, ttl_ms])
+            if wait_ms is not None:
+                return int(wait_ms) / 1000
+        return self._local_bucket(bucket).take()
+
+    async def try_acquire(self, upstream: str) -> bool:
+        """Take a token only if one is free right now (used for hedges)."""
+        bucket = self.bucket_of(upstream)
+        if await self._take(bucket) > 0:
+            return False
+        self.acquired[bucket] += 1
+        return True
+
+    async def acquire(self, upstream: str, budget: Optional[float] = None) -> float:
+        """Wait for a token; returns the seconds spent waiting.
+
+        Raises RateLimitWaitExceeded if none frees up within `budget` (or
+        RATE_LIMIT_MAX_WAIT_SECONDS).
+        """
+        bucket = self.bucket_of(upstream)
+        limit = self.max_wait_seconds if budget is None else min(budget, self.max_wait_seconds)
+        start = time.monotonic()
+        slept = False
+        while True:
+            wait = await self._take(bucket)
+            waited = time.monotonic() - start
+            if wait <= 0:
+                break
+            if waited + wait > limit:
+                self._record_wait(bucket, waited)
+                raise RateLimitWaitExceeded(
+                    f"{bucket} is rate limited; no capacity within {limit:.1f}s")
+            # A little jitter so queued callers do not all retry on the same tick
+            await asyncio.sleep(wait + random.uniform(0, min(0.05, wait)))
+            slept = True
+
+        self.acquired[bucket] += 1
+        if not slept:
+            return 0.0
+        self._record_wait(bucket, waited)
+        return waited
+
+    def _record_wait(self, bucket: str, waited: float):
+        self.waits[bucket] += 1
+        self.wait_seconds[bucket] += waited
+        self.max_wait[bucket] = max(self.max_wait[bucket], waited)
+
+    async def block(self, upstream: str, seconds: float):
+        """Pause the upstream's bucket for every worker (after a 429)."""
+        bucket = self.bucket_of(upstream)
+        self.throttled[bucket] += 1
+        if self.cache is not None:
+            done = await self.cache.eval(self.BLOCK_SCRIPT, [f"ratelimit:{bucket}"],
+                                         [int(seconds * 1000), 60000])
+            if done is not None:
+                return
+        self._local_bucket(bucket).block(seconds)
+
+    def stats(self) -> dict[str, Any]:
+        buckets = set(self.acquired) | set(self.waits) | set(self.throttled)
+        stats = {}
+        for bucket in sorted(buckets):
+            rate, burst = self.limits(bucket)
+            stats[bucket] = {
+                "rate_per_second": rate or None,
+                "burst": burst if rate else None,
+                "acquired": self.acquired[bucket],
+                "waited": self.waits[bucket],
+                "wait_seconds": round(self.wait_seconds[bucket], 3),
+                "max_wait_seconds": round(self.max_wait[bucket], 3),
+                "throttled_429": self.throttled[bucket],
+            }
+        return stats
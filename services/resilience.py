@@ -0,0 +1,308 @@
+import asyncio
+import os
+import random
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Optional
+from dotenv import load_dotenv
+
+from services.metrics import Metrics
+from services.rate_limit import RateLimiter, RateLimitWaitExceeded, rate_limit_of
+
+
+load_dotenv()
+
+# Loop time by which the current call chain must finish, set by `within`
+_deadline_at: ContextVar[Optional[float]] = ContextVar('deadline_at', default=None)
+
+
+async def within(aw: Awaitable[Any], timeout: float) -> Any:
+    """`asyncio.wait_for` that marks its deadline, so an upstream call it
+    cancels can tell a blown budget from a caller giving up for other
+    reasons (a cache hit, a client that went away)."""
+    deadline_at = asyncio.get_running_loop().time() + timeout
+    outer = _deadline_at.get()
+    token = _deadline_at.set(deadline_at if outer is None else min(outer, deadline_at))
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    finally:
+        _deadline_at.reset(token)
+
+
+def deadline_expired() -> bool:
+    deadline_at = _deadline_at.get()
+    # The timeout callback can run up to the loop's clock resolution early
+    return deadline_at is not None and asyncio.get_running_loop().time() >= deadline_at - 0.01
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, upstream: str, retry_in: float):
+        super().__init__(f"{upstream} is unavailable (circuit open, retry in {retry_in:.0f}s)")
+        self.upstream = upstream
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    After `failure_threshold` failures in a row the circuit opens and calls
+    fail fast for `reset_seconds`; then one trial call is let through
+    (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def retry_in(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                self.times_opened += 1
+                print(f"Circuit for {self.name} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+
+class LatencyWindow:
+    """Recent successful call latencies, for the hedging delay."""
+
+    def __init__(self, size: int = 200):
+        self.samples: deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Upstreams:
+    """Circuit breakers, latency tracking and optional hedging per upstream.
+
+    Every outbound dependency (each SerpAPI engine, smartproxy, imgbb,
+    Azure OpenAI) is called through `call(name, fn)`. Upstreams listed in
+    HEDGE_UPSTREAMS get a duplicate call if the first has not answered
+    after their observed p95 latency; the first success wins and the other
+    is cancelled.
+
+    With a `limiter`, each call first takes a token from the upstream's
+    bucket, and a 429 pauses that bucket for every worker and is retried
+    (up to RATE_LIMIT_MAX_RETRIES times, with jittered backoff, within the
+    caller's budget) instead of counting against the breaker.
+    """
+
+    def __init__(self, limiter: Optional[RateLimiter] = None, metrics: Optional[Metrics] = None):
+        self.limiter = limiter
+        self.metrics = metrics
+        self.failure_threshold = int(os.getenv('BREAKER_FAILURES', '5'))
+        self.reset_seconds = float(os.getenv('BREAKER_RESET_SECONDS', '30'))
+        self.hedged_upstreams = {
+            name.strip() for name in os.getenv('HEDGE_UPSTREAMS', '').split(',') if name.strip()}
+        self.hedge_quantile = float(os.getenv('HEDGE_QUANTILE', '0.95'))
+        # Don't hedge on a handful of samples
+        self.hedge_min_samples = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+        self.max_retries = int(os.getenv('RATE_LIMIT_MAX_RETRIES', '3'))
+        self.backoff_base = float(os.getenv('RATE_LIMIT_BACKOFF_SECONDS', '0.5'))
+        self.backoff_max = float(os.getenv('RATE_LIMIT_BACKOFF_MAX_SECONDS', '8'))
+
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.latencies: dict[str, LatencyWindow] = {}
+        self.calls: Counter = Counter()
+        self.failures: Counter = Counter()
+        self.rejected: Counter = Counter()
+        self.timeouts: Counter = Counter()
+        self.hedges: Counter = Counter()
+        self.hedge_wins: Counter = Counter()
+        self.retries_429: Counter = Counter()
+        self.rate_limited: Counter = Counter()
+
+    def breaker(self, name: str) -> CircuitBreaker:
+        if name not in self.breakers:
+            self.breakers[name] = CircuitBreaker(name, self.failure_threshold, self.reset_seconds)
+            self.latencies[name] = LatencyWindow()
+        return self.breakers[name]
+
+    def hedge_delay(self, name: str) -> Optional[float]:
+        window = self.latencies[name]
+        if name not in self.hedged_upstreams or len(window.samples) < self.hedge_min_samples:
+            return None
+        return window.percentile(self.hedge_quantile)
+
+    def backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Full-jitter exponential backoff, never shorter than Retry-After."""
+        jittered = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is None:
+            return jittered
+        return retry_after + jittered * 0.1
+
+    async def call(self, name: str, fn: Callable[[], Awaitable[Any]],
+                   budget: Optional[float] = None) -> Any:
+        """Call `fn` through the upstream's breaker and rate limit. `budget`
+        bounds the time spent waiting for tokens and retrying 429s."""
+        breaker = self.breaker(name)
+        if not breaker.allow():
+            self.rejected[name] += 1
+            raise CircuitOpenError(name, breaker.retry_in())
+
+        give_up_at = None if budget is None else time.monotonic() + budget
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                if self.limiter is not None:
+                    await self.limiter.acquire(
+                        name, None if give_up_at is None else give_up_at - time.monotonic())
+                    start = time.perf_counter()
+                self.calls[name] += 1
+                delay = self.hedge_delay(name)
+                result = await (self._hedged(name, fn, delay) if delay is not None else fn())
+                break
+            except asyncio.CancelledError:
+                if deadline_expired():
+                    # Abandoned by its deadline: an upstream that keeps blowing the
+                    # budget should trip the breaker just like one that errors
+                    self.timeouts[name] += 1
+                    breaker.record_failure()
+                else:
+                    # The caller stopped waiting for its own reasons; this says
+                    # nothing about the upstream, but frees a half-open trial
+                    breaker.trial_in_flight = False
+                raise
+            except RateLimitWaitExceeded:
+                # Our own throttle, not the upstream's health
+                self.rate_limited[name] += 1
+                breaker.trial_in_flight = False
+                raise
+            except Exception as e:
+                limited = rate_limit_of(e)
+                if limited is None:
+                    self.failures[name] += 1
+                    breaker.record_failure()
+                    raise
+
+                wait = self.backoff(attempt, limited.retry_after)
+                attempt += 1
+                if self.limiter is not None:
+                    await self.limiter.block(name, wait)
+                out_of_time = give_up_at is not None and time.monotonic() + wait > give_up_at
+                if attempt > self.max_retries or out_of_time:
+                    self.rate_limited[name] += 1
+                    breaker.trial_in_flight = False
+                    raise
+                self.retries_429[name] += 1
+                print(f"{name} rate limited, retrying in {wait:.2f}s "
+                      f"(attempt {attempt}/{self.max_retries})")
+                if self.limiter is None:
+                    await asyncio.sleep(wait)
+                # Otherwise acquire() waits out the block, shared with other callers
+
+        breaker.record_success()
+        elapsed = time.perf_counter() - start
+        self.latencies[name].add(elapsed)
+        if self.metrics is not None:
+            self.metrics.upstream_seconds.labels(name).observe(elapsed)
+        return result
+
+    async def _hedged(self, name: str, fn: Callable[[], Awaitable[Any]], delay: float) -> Any:
+        first = asyncio.ensure_future(fn())
+        pending = {first}
+        error: Optional[BaseException] = None
+        try:
+            # Everything, this first wait included, is inside the try so that
+            # a cancelled caller never leaves a call running past its deadline
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if done:
+                return first.result()
+
+            if self.limiter is not None and not await self.limiter.try_acquire(name):
+                # No spare capacity for a duplicate call
+                return await first
+            self.hedges[name] += 1
+            second = asyncio.ensure_future(fn())
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins[name] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        stats = {}
+        for name, breaker in self.breakers.items():
+            window = self.latencies[name]
+            p50 = window.percentile(0.5)
+            p95 = window.percentile(0.95)
+            stats[name] = {
+                "state": breaker.state,
+                "times_opened": breaker.times_opened,
+                "calls": self.calls[name],
+                "failures": self.failures[name],
+                "timeouts": self.timeouts[name],
+                "rejected": self.rejected[name],
+                "hedges": self.hedges[name],
+                "hedge_wins": self.hedge_wins[name],
+                "retries_429": self.retries_429[name],
+                "rate_limited": self.rate_limited[name],
+                "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            }
+        return stats
+
+
+class Deadline:
+    """A request's latency budget, with a tighter cap per engine."""
+
+    def __init__(self, budget_seconds: float, engine_seconds: float):
+        self.start = time.monotonic()
+        self.budget_seconds = budget_seconds
+        self.engine_seconds = engine_seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.budget_seconds - (time.monotonic() - self.start))
+
+    def engine_remaining(self) -> float:
+        elapsed = time.monotonic() - self.start
+        return max(0.0, min(self.budget_seconds, self.engine_seconds) - elapsed)
@@ -1,17 +1,20 @@
-from serpapi import GoogleSearch
-import aiohttp
 from typing import Optional
 from dotenv import load_dotenv
 import os
 import asyncio
 from typing import Any
+from services.http_client import HttpClient
+from services.serpapi_client import SerpApiClient
+from services.rate_limit import RateLimitedError, parse_retry_after
 
 load_dotenv()
 
 
 class SearchService:
-    def __init__(self):
-        self.url = "https://scraper-api.smartproxy.com/v2/scrape"
+    def __init__(self, http_client: HttpClient):
+        self.http_client = http_client
+        self.serpapi = SerpApiClient(http_client)
+        self.url = os.getenv('SMARTPROXY_URL', "https://scraper-api.smartproxy.com/v2/scrape")
         self.google_key: Optional[str] = os.getenv('GOOGLE_API_KEY')
         self.serp_auth: Optional[str] = os.getenv('SERP_API_AUTH')
 
@@ -29,9 +32,13 @@ class SearchService:
             "authorization": self.serp_auth
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(self.url, json=payload, headers=headers) as response:
-                return await response.text()
+        session = self.http_client.session
+        async with session.post(self.url, json=payload, headers=headers) as response:
+            if response.status == 429:
+                raise RateLimitedError("smartproxy", parse_retry_after(response.headers))
+            # An error body is not a result page; raise so it is neither parsed nor cached
+            response.raise_for_status()
+            return await response.text()
 
     async def google_search(self, query: str):
         params = {
@@ -43,9 +50,7 @@ class SearchService:
             "gl": "us",
             "hl": "en"
         }
-        search = GoogleSearch(params)
-        results = await asyncio.to_thread(search.get_dict)
-        return results
+        return await self.serpapi.search(params)
 
     async def google_image_search(self, image_url: str):
         params = {
@@ -54,9 +59,7 @@ class SearchService:
             "google_domain": "google.com",
             "image_url": image_url
         }
-        search = GoogleSearch(params)
-        results = await asyncio.to_thread(search.get_dict)
-        return results
+        return await self.serpapi.search(params)
 
     async def google_lens_search(self, image_url: str) -> dict[Any, Any]:
         params = {
@@ -65,16 +68,17 @@ class SearchService:
             "google_domain": "google.com",
             "url": image_url
         }
-        search = GoogleSearch(params)
-        results = await asyncio.to_thread(search.get_dict)
-        return results
+        return await self.serpapi.search(params)
 
 
 # Example usage
 async def main():
-    search_service = SearchService()
+    http_client = HttpClient()
+    await http_client.start()
+    search_service = SearchService(http_client)
     result = await search_service.amazon_search("huawei")
     print(result)
+    await http_client.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,66 @@
+import asyncio
+import json
+import os
+from typing import Any
+from dotenv import load_dotenv
+
+from services.http_client import HttpClient
+from services.rate_limit import RateLimitedError, parse_retry_after
+
+
+load_dotenv()
+
+
+class SerpApiError(Exception):
+    """SerpAPI answered with an error status or an `error` field."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"SerpAPI error {status}: {message}")
+        self.status = status
+
+
+class SerpApiClient:
+    """Async replacement for `serpapi.GoogleSearch(params).get_dict()`.
+
+    Sends the same request the library does (GET /search with the params
+    plus `output=json`) over the shared aiohttp session, so SerpAPI calls
+    reuse pooled keep-alive connections instead of tying up a thread and a
+    fresh `requests` connection each. Unlike `get_dict`, errors raise: 429
+    as RateLimitedError, any other error status or `error` field as
+    SerpApiError, so the breaker sees them and they are never cached. A
+    search that succeeded with no results is returned as is. Bodies above
+    SERPAPI_OFFLOOP_PARSE_BYTES are parsed in a worker thread so large
+    result pages do not stall the event loop.
+    """
+
+    def __init__(self, http_client: HttpClient):
+        self.http_client = http_client
+        self.backend = os.getenv('SERPAPI_BACKEND', 'https://serpapi.com')
+        self.offloop_parse_bytes = int(os.getenv('SERPAPI_OFFLOOP_PARSE_BYTES', str(64 * 1024)))
+
+    async def search(self, params: dict[str, Any]) -> dict[Any, Any]:
+        query = {key: str(value) for key, value in params.items() if value is not None}
+        query['output'] = 'json'
+        query['source'] = 'python'
+
+        session = self.http_client.session
+        async with session.get(f"{self.backend}/search", params=query,
+                               headers={"Accept-Encoding": "gzip, deflate"}) as response:
+            if response.status == 429:
+                raise RateLimitedError("serpapi", parse_retry_after(response.headers))
+            status = response.status
+            body = await response.read()
+
+        try:
+            if len(body) > self.offloop_parse_bytes:
+                data = dict(await asyncio.get_running_loop().run_in_executor(None, json.loads, body))
+            else:
+                data = dict(json.loads(body))
+        except ValueError:
+            raise SerpApiError(status, body[:200].decode('utf-8', 'replace'))
+        if status >= 400:
+            raise SerpApiError(status, data.get('error', 'no error message'))
+        if 'error' in data and data.get('search_metadata', {}).get('status') != 'Success':
+            # "Google hasn't returned any results" comes with status Success
+            raise SerpApiError(status, data['error'])
+        return data
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Optional
+from dotenv import load_dotenv
+
+from services.cache import RedisCache
+
+
+load_dotenv()
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls so only one does the work.
+
+    Within a worker, callers with the same key await the leader's future.
+    Across workers, the leader holds a Redis lock (`lock:<key>`) while it
+    computes; callers in other workers poll `result_key` until the leader
+    writes it, and take over if the lock is released or expires without a
+    result. Nobody waits longer than SINGLE_FLIGHT_TIMEOUT before computing
+    on its own.
+    """
+
+    def __init__(self, cache: Optional[RedisCache] = None):
+        self.cache = cache
+        self.timeout = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', '60'))
+        self.lock_ttl = int(os.getenv('SINGLE_FLIGHT_LOCK_TTL', '120'))
+        self.poll_interval = float(os.getenv('SINGLE_FLIGHT_POLL_INTERVAL', '0.1'))
+        self._inflight: dict[str, asyncio.Future] = {}
+
+        self.leaders = 0
+        self.coalesced_local = 0
+        self.coalesced_remote = 0
+        self.timeouts = 0
+
+    async def do(self, key: str, compute: Callable[[], Awaitable[Any]],
+                 result_key: Optional[str] = None) -> Any:
+        """Run `compute` once per key across concurrent callers.
+
+        `result_key` is where the leader's `compute` caches its JSON result;
+        without it only in-process coalescing applies.
+        """
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await self._follow(key, inflight, compute, result_key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._lead(key, compute, result_key)
+        except asyncio.CancelledError:
+            # Followers retry instead of inheriting our cancellation
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark it retrieved so a leader with no followers does not warn
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _follow(self, key: str, inflight: asyncio.Future,
+                      compute: Callable[[], Awaitable[Any]],
+                      result_key: Optional[str]) -> Any:
+        try:
+            result = await asyncio.wait_for(asyncio.shield(inflight), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return await compute()
+        except asyncio.CancelledError:
+            if not inflight.cancelled():
+                raise
+            return await self.do(key, compute, result_key)
+        self.coalesced_local += 1
+        return result
+
+    async def _lead(self, key: str, compute: Callable[[], Awaitable[Any]],
+                    result_key: Optional[str]) -> Any:
+        if self.cache is None or result_key is None:
+            self.leaders += 1
+            return await compute()
+
+        lock_key = f"lock:{key}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.timeout
+        while not await self.cache.acquire_lock(lock_key, token, self.lock_ttl):
+            # Another worker is leading; its result lands in result_key
+            cached = await self.cache.get(result_key)
+            if cached is not None:
+                self.coalesced_remote += 1
+                return json.loads(cached)
+            if time.monotonic() >= deadline:
+                self.timeouts += 1
+                return await compute()
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            # The previous leader may have finished between our last poll
+            # and taking the lock
+            cached = await self.cache.get(result_key)
+            if cached is not None:
+                self.coalesced_remote += 1
+                return json.loads(cached)
+            self.leaders += 1
+            return await compute()
+        finally:
+            await self.cache.release_lock(lock_key, token)
+
+    def stats(self) -> dict:
+        coalesced = self.coalesced_local + self.coalesced_remote
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "coalesced_local": self.coalesced_local,
+            "coalesced_remote": self.coalesced_remote,
+            "timeouts": self.timeouts,
+            "coalesced_ratio": coalesced / (coalesced + self.leaders)
+            if coalesced + self.leaders else 0.0,
+        }
@@ -0,0 +1,85 @@
+import json
+import os
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Optional
+from dotenv import load_dotenv
+
+from services.cache import RedisCache
+from services.single_flight import SingleFlight
+
+
+load_dotenv()
+
+# Default TTLs in seconds; override with STAGE_TTL_<STAGE>, e.g. STAGE_TTL_AMAZON_SEARCH
+DEFAULT_TTLS = {
+    "product_query": 7 * 86400,
+    "amazon_search": 6 * 3600,
+    "google_search": 6 * 3600,
+    "google_image_search": 86400,
+    "google_lens_search": 86400,
+    "gallery": 86400,
+    "matching": 86400,
+}
+
+
+class StageCache:
+    """Caches each /search pipeline stage independently in Redis.
+
+    Stages get their own key space (`stage:<stage>:<key>`) and TTL, so two
+    photos that produce the same product query share the Amazon/Google
+    results, and a failure late in the pipeline keeps everything that
+    already completed for the retry. Concurrent misses for the same stage
+    key in this worker share one computation.
+    """
+
+    def __init__(self, cache: RedisCache):
+        self.cache = cache
+        self.ttls = {
+            stage: int(os.getenv(f"STAGE_TTL_{stage.upper()}", str(ttl)))
+            for stage, ttl in DEFAULT_TTLS.items()
+        }
+        self.hits: defaultdict[str, int] = defaultdict(int)
+        self.misses: defaultdict[str, int] = defaultdict(int)
+        self.inflight = SingleFlight()
+
+    @staticmethod
+    def _key(stage: str, key: str) -> str:
+        return f"stage:{stage}:{key}"
+
+    def _decode(self, stage: str, cached: Optional[str]) -> Optional[Any]:
+        if cached is None:
+            self.misses[stage] += 1
+            return None
+        self.hits[stage] += 1
+        return json.loads(cached)
+
+    async def get(self, stage: str, key: str) -> Optional[Any]:
+        return self._decode(stage, await self.cache.get(self._key(stage, key)))
+
+    async def set(self, stage: str, key: str, value: Any):
+        await self.cache.setex(self._key(stage, key), self.ttls[stage], json.dumps(value))
+
+    async def get_or_compute(self, stage: str, key: str,
+                             compute: Callable[[], Awaitable[Any]]) -> Any:
+        cached = await self.get(stage, key)
+        if cached is not None:
+            return cached
+
+        async def compute_and_store():
+            value = await compute()
+            await self.set(stage, key, value)
+            return value
+
+        return await self.inflight.do(self._key(stage, key), compute_and_store)
+
+    def stats(self) -> dict:
+        stats = {}
+        for stage in DEFAULT_TTLS:
+            hits, misses = self.hits[stage], self.misses[stage]
+            stats[stage] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+            }
+        stats["coalesced"] = self.inflight.coalesced_local
+        return stats
@@ -0,0 +1,140 @@
+import asyncio
+import time
+from collections import Counter, defaultdict
+from typing import Any, Awaitable, Callable, Optional
+
+
+class StageGraph:
+    """Runs pipeline stages as soon as the stages they depend on finish.
+
+    Stages are added with the names of their dependencies, whose results are
+    passed to the stage function positionally:
+
+        graph.add("query", get_query)
+        graph.add("search", lambda query: search(query), "query")
+
+    Each stage records when it started and finished relative to `start()`,
+    so `timeline()` and `critical_path()` show where a request spent its time.
+    """
+
+    def __init__(self):
+        self._stages: dict[str, tuple[Callable[..., Awaitable[Any]], tuple[str, ...]]] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._t0 = 0.0
+        self.started: dict[str, float] = {}
+        self.finished: dict[str, float] = {}
+
+    def add(self, name: str, fn: Callable[..., Awaitable[Any]], *deps: str):
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+        self._stages[name] = (fn, deps)
+
+    async def _run_stage(self, name: str) -> Any:
+        fn, deps = self._stages[name]
+        values = [await self._tasks[dep] for dep in deps]
+        self.started[name] = time.perf_counter() - self._t0
+        try:
+            return await fn(*values)
+        finally:
+            self.finished[name] = time.perf_counter() - self._t0
+
+    @staticmethod
+    def _retrieve(task: asyncio.Task):
+        # Failures surface through dependents or wait(); don't warn about
+        # stages nobody awaited directly
+        if not task.cancelled():
+            task.exception()
+
+    def start(self):
+        self._t0 = time.perf_counter()
+        for name in self._stages:
+            task = asyncio.create_task(self._run_stage(name))
+            task.add_done_callback(self._retrieve)
+            self._tasks[name] = task
+
+    def task(self, name: str) -> asyncio.Task:
+        return self._tasks[name]
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+    async def wait(self) -> dict[str, Any]:
+        """Wait for every stage; the first failure cancels the rest."""
+        try:
+            await asyncio.gather(*self._tasks.values())
+        except BaseException:
+            self.cancel()
+            raise
+        return {name: task.result() for name, task in self._tasks.items()}
+
+    async def run(self) -> dict[str, Any]:
+        self.start()
+        return await self.wait()
+
+    def timeline(self) -> list[dict]:
+        return [
+            {
+                "stage": name,
+                "deps": list(self._stages[name][1]),
+                "start_ms": round(self.started[name] * 1000, 1),
+                "end_ms": round(self.finished[name] * 1000, 1),
+            }
+            for name in sorted(self.started, key=self.started.get)
+            if name in self.finished
+        ]
+
+    def critical_path(self) -> list[str]:
+        """The chain of stages that determined the finish time: the last stage
+        to finish, then whichever of its dependencies finished last, and so on."""
+        if not self.finished:
+            return []
+        path = [max(self.finished, key=self.finished.get)]
+        while True:
+            deps = [dep for dep in self._stages[path[-1]][1] if dep in self.finished]
+            if not deps:
+                break
+            path.append(max(deps, key=self.finished.get))
+        return path[::-1]
+
+
+class StageTimings:
+    """Aggregates StageGraph timelines for /stats."""
+
+    def __init__(self):
+        self.runs = 0
+        self.total_seconds = 0.0
+        self.durations: defaultdict[str, float] = defaultdict(float)
+        self.starts: defaultdict[str, float] = defaultdict(float)
+        self.counts: Counter = Counter()
+        self.critical: Counter = Counter()
+        self.last_timeline: Optional[list[dict]] = None
+
+    def record(self, graph: StageGraph):
+        if not graph.finished:
+            return
+        self.runs += 1
+        self.total_seconds += max(graph.finished.values())
+        for name, finished in graph.finished.items():
+            self.counts[name] += 1
+            self.starts[name] += graph.started[name]
+            self.durations[name] += finished - graph.started[name]
+        for name in graph.critical_path():
+            self.critical[name] += 1
+        self.last_timeline = graph.timeline()
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "avg_total_ms": round(self.total_seconds / self.runs * 1000, 1) if self.runs else 0.0,
+            "stages": {
+                name: {
+                    "avg_start_ms": round(self.starts[name] / count * 1000, 1),
+                    "avg_duration_ms": round(self.durations[name] / count * 1000, 1),
+                    "critical_path_ratio": round(self.critical[name] / count, 3),
+                }
+                for name, count in self.counts.items()
+            },
+            "last_timeline": self.last_timeline,
+        }
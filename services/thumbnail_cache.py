@@ -0,0 +1,250 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from services.cache import RedisCache
+from services.grid_renderer import TILE_SIZE
+
+
+load_dotenv()
+
+TILE_SHAPE = (TILE_SIZE, TILE_SIZE, 3)
+TILE_BYTES = TILE_SIZE * TILE_SIZE * 3
+
+
+@dataclass
+class CachedTile:
+    tile: bytes  # raw 150x150 BGR pixels, ready to drop into a grid
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    stored_at: float = 0.0
+
+    def array(self) -> np.ndarray:
+        return np.frombuffer(self.tile, dtype=np.uint8).reshape(TILE_SHAPE)
+
+    def dumps(self) -> bytes:
+        header = json.dumps({
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "stored_at": self.stored_at,
+        }).encode('utf-8')
+        return header + b"\n" + self.tile
+
+    @classmethod
+    def loads(cls, blob: bytes) -> Optional["CachedTile"]:
+        header, sep, tile = blob.partition(b"\n")
+        if not sep or len(tile) != TILE_BYTES:
+            return None
+        meta = json.loads(header)
+        return cls(tile=tile, etag=meta.get("etag"),
+                   last_modified=meta.get("last_modified"),
+                   stored_at=meta.get("stored_at", 0.0))
+
+
+class ThumbnailCache:
+    """Decoded, already-resized thumbnail tiles keyed by source URL.
+
+    Lookups go memory LRU -> disk directory -> Redis (when given a
+    RedisCache, whose fail-soft helpers skip Redis while it is down),
+    promoting hits into the faster tiers. Entries older than
+    THUMBNAIL_CACHE_FRESH_SECONDS are still served, but callers are
+    expected to revalidate them with the stored ETag / Last-Modified first.
+    A gallery's tiles are looked up with `get_many` and stored with
+    `put_many`, so each tier costs one round trip per gallery, not per tile.
+    """
+
+    def __init__(self, redis_cache: Optional[RedisCache] = None):
+        self.max_bytes = int(float(os.getenv('THUMBNAIL_CACHE_MAX_MB', '128')) * 1024 * 1024)
+        self.fresh_seconds = float(os.getenv('THUMBNAIL_CACHE_FRESH_SECONDS', '86400'))
+        self.disk_dir = os.getenv('THUMBNAIL_CACHE_DIR') or None
+        self.disk_max_entries = int(os.getenv('THUMBNAIL_CACHE_DISK_MAX_ENTRIES', '50000'))
+        self.redis_ttl = int(os.getenv('THUMBNAIL_CACHE_REDIS_TTL', str(7 * 86400)))
+        self.redis = redis_cache
+
+        self._memory: "OrderedDict[str, CachedTile]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_entries = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_entries = sum(
+                1 for name in os.listdir(self.disk_dir) if name.endswith('.tile'))
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stale_served = 0
+        self.stores = 0
+        self.evictions = 0
+        self.tier_hits = {"memory": 0, "disk": 0, "redis": 0}
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def is_fresh(self, entry: CachedTile) -> bool:
+        return time.time() - entry.stored_at < self.fresh_seconds
+
+    @staticmethod
+    def conditional_headers(entry: Optional[CachedTile]) -> dict:
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    async def get(self, url: str) -> Optional[CachedTile]:
+        return (await self.get_many([url]))[0]
+
+    async def get_many(self, urls: list[str]) -> list[Optional[CachedTile]]:
+        """Look up several URLs at once: one disk pass and one Redis MGET
+        for whatever the memory tier does not have."""
+        keys = [self.key(url) for url in urls]
+        entries: list[Optional[CachedTile]] = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.tier_hits["memory"] += 1
+                entries[i] = entry
+            else:
+                missing.append(i)
+
+        if missing and self.disk_dir:
+            found = await asyncio.to_thread(self._disk_read_many, [keys[i] for i in missing])
+            missing = self._fill(entries, keys, missing, found, "disk")
+
+        if missing and self.redis is not None:
+            blobs = await self.redis.mget_bytes([f"thumb:{keys[i]}" for i in missing])
+            found = [CachedTile.loads(blob) if blob else None for blob in blobs]
+            missing = self._fill(entries, keys, missing, found, "redis")
+
+        return entries
+
+    def _fill(self, entries: list[Optional[CachedTile]], keys: list[str], missing: list[int],
+              found: list[Optional[CachedTile]], tier: str) -> list[int]:
+        """Promote a slower tier's hits into memory; returns what is still missing."""
+        still_missing = []
+        for i, entry in zip(missing, found):
+            if entry is None:
+                still_missing.append(i)
+                continue
+            self.tier_hits[tier] += 1
+            self._memory_put(keys[i], entry)
+            entries[i] = entry
+        return still_missing
+
+    async def put(self, url: str, tile: np.ndarray, etag: Optional[str] = None,
+                  last_modified: Optional[str] = None):
+        await self.put_many([(url, tile, etag, last_modified)])
+
+    async def put_many(self, items: list[tuple[str, np.ndarray, Optional[str], Optional[str]]]):
+        """Store (url, tile, etag, last_modified) entries with one disk pass
+        and one pipelined Redis write."""
+        now = time.time()
+        await self._store_many([
+            (self.key(url), CachedTile(tile=np.ascontiguousarray(tile, dtype=np.uint8).tobytes(),
+                                       etag=etag, last_modified=last_modified, stored_at=now))
+            for url, tile, etag, last_modified in items])
+        self.stores += len(items)
+
+    async def touch(self, url: str, entry: CachedTile):
+        """Mark an entry fresh again after a 304 Not Modified."""
+        entry.stored_at = time.time()
+        await self._store_many([(self.key(url), entry)])
+        self.revalidated += 1
+
+    async def _store_many(self, entries: list[tuple[str, CachedTile]]):
+        if not entries:
+            return
+        for key, entry in entries:
+            self._memory_put(key, entry)
+        writes = []
+        if self.disk_dir:
+            writes.append(asyncio.to_thread(self._disk_write_many, entries))
+        if self.redis is not None:
+            writes.append(self.redis.setex_many_bytes(
+                [(f"thumb:{key}", self.redis_ttl, entry.dumps()) for key, entry in entries]))
+        await asyncio.gather(*writes)
+
+    def _memory_put(self, key: str, entry: CachedTile):
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous.tile)
+        self._memory[key] = entry
+        self._memory_bytes += len(entry.tile)
+        while self._memory_bytes > self.max_bytes and self._memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.tile)
+            self.evictions += 1
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.tile")  # type: ignore[arg-type]
+
+    def _disk_read(self, key: str) -> Optional[CachedTile]:
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = CachedTile.loads(f.read())
+            os.utime(path)  # mtime doubles as the disk tier's LRU clock
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def _disk_read_many(self, keys: list[str]) -> list[Optional[CachedTile]]:
+        return [self._disk_read(key) for key in keys]
+
+    def _disk_write_many(self, entries: list[tuple[str, CachedTile]]):
+        for key, entry in entries:
+            self._disk_write(key, entry)
+
+    def _disk_write(self, key: str, entry: CachedTile):
+        path = self._disk_path(key)
+        existed = os.path.exists(path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(entry.dumps())
+        os.replace(tmp_path, path)
+        if not existed:
+            self._disk_entries += 1
+        if self._disk_entries > self.disk_max_entries:
+            self._disk_evict()
+
+    def _disk_evict(self):
+        # Drop the least recently used tenth in one pass rather than one file per write
+        files = [entry for entry in os.scandir(self.disk_dir) if entry.name.endswith('.tile')]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        excess = len(files) - self.disk_max_entries + self.disk_max_entries // 10
+        for entry in files[:max(excess, 0)]:
+            try:
+                os.remove(entry.path)
+                self.evictions += 1
+            except OSError:
+                pass
+        self._disk_entries = len(files) - max(excess, 0)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.revalidated + self.stale_served + self.misses
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "stale_served": self.stale_served,
+            "misses": self.misses,
+            "hit_ratio": (lookups - self.misses) / lookups if lookups else 0.0,
+            "tier_hits": dict(self.tier_hits),
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_entries": self._disk_entries,
+        }
@@ -0,0 +1,80 @@
+import pytest
+
+from services.candidates import GALLERY_SLOTS, Candidates, parse_candidates
+
+
+def amazon_payload(organic, choices=()):
+    return {'results': [{'content': {'results': {'results': {
+        'organic': list(organic), 'amazons_choices': list(choices)}}}}]}
+
+
+def amazon_item(pos, title):
+    return {'pos': pos, 'title': title, 'url': f'/dp/{title}', 'price': 9.99,
+            'url_image': f'https://img/{title}.jpg'}
+
+
+def test_slot_maps_gallery_labels_to_items():
+    candidates = parse_candidates('gis', {'image_results': [
+        {'position': 1, 'title': 'a', 'link': 'https://a', 'thumbnail': 'https://t/a'},
+        {'position': 2, 'title': 'no thumbnail', 'link': 'https://b'},
+        {'position': 3, 'title': 'c', 'link': 'https://c', 'thumbnail': 'https://t/c'},
+    ]})
+
+    # Slot 0 is the query image; results without a thumbnail are never drawn
+    assert candidates.slot(0) is None
+    assert candidates.slot(1).title == 'a'
+    assert candidates.slot(2).title == 'c'
+    assert candidates.slot(3) is None
+    assert candidates.slot(-1) is None
+    assert candidates.thumbnails('https://query') == ['https://query', 'https://t/a', 'https://t/c']
+
+
+def test_amazon_position_comes_from_pos():
+    candidates = parse_candidates('amz', amazon_payload(
+        [amazon_item(1, 'first'), amazon_item(2, 'second')], [amazon_item(7, 'choice')]))
+
+    assert [item.position for item in candidates.items] == [1, 2, 7]
+    assert candidates.slot(3).title == 'choice'
+    assert candidates.slot(1).link == 'https://www.amazon.com/dp/first'
+
+
+def test_serpapi_position_and_price():
+    candidates = parse_candidates('lens', {'visual_matches': [
+        {'position': 4, 'title': 'lamp', 'link': 'https://lamp', 'thumbnail': 'https://t/lamp',
+         'price': {'value': '$19.99', 'extracted_value': 19.99}},
+    ]})
+
+    match = candidates.slot(1)
+    assert match.position == 4
+    assert match.to_match() == {'title': 'lamp', 'price': '$19.99', 'link': 'https://lamp',
+                                'image': 'https://t/lamp'}
+
+
+def test_amazon_accepts_raw_text():
+    payload = '{"results": [{"content": {"results": {"results": ' \
+              '{"organic": [], "amazons_choices": []}}}}]}'
+    assert len(parse_candidates('amz', payload)) == 0
+
+
+def test_truncated_to_gallery_slots():
+    results = [{'position': i, 'title': str(i), 'thumbnail': f'https://t/{i}'}
+               for i in range(1, 40)]
+    candidates = parse_candidates('gs', {'organic_results': results})
+
+    assert len(candidates) == GALLERY_SLOTS - 1
+    assert candidates.slot(GALLERY_SLOTS - 1).title == str(GALLERY_SLOTS - 1)
+    assert candidates.slot(GALLERY_SLOTS) is None
+
+
+def test_round_trip():
+    candidates = parse_candidates('amz', amazon_payload([amazon_item(3, 'x')]))
+    restored = Candidates.from_dict(candidates.to_dict())
+
+    assert restored.engine == 'amz'
+    assert restored.slot(1).position == 3
+    assert restored.slot(1).to_match() == candidates.slot(1).to_match()
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        parse_candidates('bing', {})
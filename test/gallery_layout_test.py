@@ -0,0 +1,98 @@
+from services.gallery_layout import (
+    TILE_SIZES, SheetLayout, fixed_tokens, partitions, plan_packing, plan_sheet, seen_unscaled, vision_tokens)
+
+ENGINES = ['amz', 'gs', 'gis', 'lens']
+
+
+def test_vision_tokens():
+    assert vision_tokens(512, 512) == 85 + 170
+    assert vision_tokens(1024, 1024) == 85 + 170 * 4
+    # Fitted in 2048x2048, then the short side scaled to 768: 1536x768
+    assert vision_tokens(4096, 2048) == 85 + 170 * 6
+    assert vision_tokens(4096, 2048, "low") == 85
+
+
+def test_seen_unscaled():
+    assert seen_unscaled(2048, 768)
+    assert not seen_unscaled(2049, 700)
+    assert not seen_unscaled(800, 800)
+    assert seen_unscaled(512, 300, "low")
+    assert not seen_unscaled(600, 300, "low")
+
+
+def test_fixed_tokens():
+    assert fixed_tokens(13) == 425
+    assert fixed_tokens(26) == 765
+
+
+def test_plan_sheet_is_cheapest_readable_layout():
+    sheet = plan_sheet(['amz'], [13])
+
+    assert sheet.tokens == vision_tokens(sheet.width, sheet.height) == 255
+    assert seen_unscaled(sheet.width, sheet.height)
+    assert sheet.columns * sheet.tile_size == sheet.width
+    assert not sheet.headed
+    # No other allowed tile size and column count is cheaper
+    for tile_size in TILE_SIZES:
+        if tile_size < 96:
+            continue
+        for columns in range(1, 14):
+            other = SheetLayout(['amz'], [13], tile_size, columns)
+            if seen_unscaled(other.width, other.height):
+                assert vision_tokens(other.width, other.height) >= sheet.tokens
+
+
+def test_plan_sheet_respects_min_tile():
+    sheet = plan_sheet(ENGINES, [26] * 4, min_tile=120)
+    assert sheet is None or sheet.tile_size >= 120
+    assert plan_sheet(['amz'], [500]) is None
+
+
+def test_partitions():
+    assert len(list(partitions(ENGINES))) == 15
+    assert list(partitions([])) == [[]]
+    for partition in partitions(ENGINES):
+        assert sorted(engine for group in partition for engine in group) == sorted(ENGINES)
+
+
+def test_plan_packing_single_gallery():
+    plan = plan_packing({'amz': 13})
+    assert (plan.tokens, plan.fixed_tokens) == (255, 425)
+    assert len(plan.sheets) == 1
+
+
+def test_plan_packing_four_galleries_share_a_sheet():
+    plan = plan_packing(dict.fromkeys(ENGINES, 13))
+
+    assert (plan.tokens, plan.fixed_tokens) == (595, 1700)
+    [sheet] = plan.sheets
+    assert sheet.headed
+    assert (sheet.tile_size, sheet.width, sheet.height) == (96, 480, 1488)
+
+
+def test_plan_packing_full_galleries_split_in_two():
+    plan = plan_packing(dict.fromkeys(ENGINES, 26))
+
+    assert (plan.tokens, plan.fixed_tokens) == (1190, 3060)
+    assert len(plan.sheets) == 2
+    assert sorted(engine for sheet in plan.sheets for engine in sheet.engines) == sorted(ENGINES)
+
+
+def test_plan_packing_without_pack_is_one_sheet_each():
+    plan = plan_packing(dict.fromkeys(ENGINES, 13), pack=False)
+
+    assert [sheet.engines for sheet in plan.sheets] == [[engine] for engine in ENGINES]
+    assert plan.tokens == 4 * 255
+
+
+def test_plan_packing_skips_empty_galleries():
+    plan = plan_packing({'amz': 13, 'gs': 0})
+    assert [sheet.engines for sheet in plan.sheets] == [['amz']]
+
+
+def test_plan_packing_falls_back_to_fixed_grid():
+    plan = plan_packing({'amz': 500})
+
+    [sheet] = plan.sheets
+    assert (sheet.tile_size, sheet.columns) == (150, 6)
+    assert plan.tokens == plan.fixed_tokens == fixed_tokens(500)
@@ -0,0 +1,55 @@
+import numpy as np
+
+from services.grid_renderer import (
+    HEADER_HEIGHT, LABEL_HEIGHT, MAX_LABELS, GridRenderer, image_mime_type, to_data_url)
+
+
+def tiles(count: int, size: int = 150) -> list[np.ndarray]:
+    return [np.full((size, size, 3), 10 * i % 256, dtype=np.uint8) for i in range(count)]
+
+
+def test_render_labels_cells_and_blanks_the_last_row():
+    renderer = GridRenderer(columns=6)
+    grid = renderer.render(tiles(8), labels=[0, 3, 5, 7, 9, 11, 13, 15])
+
+    assert grid.shape == (2 * 170, 900, 3)
+    assert (grid[:150, 150:300] == 10).all()
+    assert (grid[170:320, 300:] == 0).all()
+
+
+def test_sheets_share_one_buffer_whatever_their_size():
+    renderer = GridRenderer()
+    big = renderer.render_sheet([("Gallery: amz", tiles(13, 96), list(range(13))),
+                                 ("Gallery: gs", tiles(13, 96), list(range(13)))], 5, 96)
+    assert big.shape == (2 * (HEADER_HEIGHT + 3 * (96 + LABEL_HEIGHT)), 480, 3)
+    capacity = renderer._sheet_buffer.size
+
+    for columns, tile_size in [(4, 104), (3, 120), (6, 96), (2, 136)]:
+        sheet = renderer.render_sheet([(None, tiles(7), list(range(7)))], columns, tile_size)
+        assert np.shares_memory(sheet, renderer._sheet_buffer)
+    assert renderer._sheet_buffer.size == capacity
+
+
+def test_reused_buffer_draws_the_same_sheet_as_a_fresh_one():
+    blocks = [(None, tiles(7), list(range(7)))]
+    reused = GridRenderer()
+    reused.render_sheet([("Gallery: amz", tiles(26, 96), list(range(26)))], 13, 96)
+    expected = GridRenderer().render_sheet(blocks, 4, 104).copy()
+
+    assert np.array_equal(reused.render_sheet(blocks, 4, 104), expected)
+
+
+def test_label_strips_are_bounded():
+    renderer = GridRenderer()
+    for index in range(MAX_LABELS + 50):
+        renderer.label(index)
+    assert len(renderer._labels) == MAX_LABELS
+    assert (0, 150) not in renderer._labels
+
+
+def test_mime_types():
+    assert image_mime_type(b'\x89PNG\r\n') == 'image/png'
+    assert image_mime_type(b'\xff\xd8\xff\xe0') == 'image/jpeg'
+    assert image_mime_type(b'RIFF\0\0\0\0WEBPVP8 ') == 'image/webp'
+    assert image_mime_type(b'<html>') == 'application/octet-stream'
+    assert to_data_url(b'\xff\xd8\xff').startswith('data:image/jpeg;base64,')
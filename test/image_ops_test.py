@@ -0,0 +1,69 @@
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from services.grid_renderer import TILE_SIZE
+from services.image_ops import (
+    decode_frame, decode_image, decode_tile, image_size, ingest_image, reduced_flag)
+
+
+def jpeg(width: int, height: int, exif: bool = False) -> bytes:
+    pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+    buffer = BytesIO()
+    if exif:
+        tags = Image.Exif()
+        tags[0x010F] = "Camera Maker"
+        image.save(buffer, 'JPEG', quality=95, exif=tags)
+    else:
+        image.save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue()
+
+
+def test_image_size_reads_the_header_only():
+    assert image_size(jpeg(640, 480)) == (640, 480)
+    assert image_size(b'<html></html>') is None
+    assert image_size(b'') is None
+
+
+def test_reduced_flag_keeps_the_target_covered():
+    assert reduced_flag(1600, 150) == cv2.IMREAD_REDUCED_COLOR_8
+    assert reduced_flag(1199, 150) == cv2.IMREAD_REDUCED_COLOR_4
+    assert reduced_flag(300, 150) == cv2.IMREAD_REDUCED_COLOR_2
+    assert reduced_flag(299, 150) == cv2.IMREAD_COLOR
+
+
+def test_large_thumbnails_decode_at_reduced_scale():
+    frame = decode_frame(jpeg(1600, 1280))
+    # 1/8 scale: still at least a tile on the short side
+    assert frame.shape == (160, 200, 3)
+    assert decode_image(jpeg(1600, 1280)).shape == (TILE_SIZE, TILE_SIZE, 3)
+    assert decode_frame(jpeg(200, 120)).shape == (120, 200, 3)
+
+
+def test_undecodable_bytes_get_the_error_tile():
+    assert decode_frame(b'') is None
+    assert decode_frame(b'not an image') is None
+    assert decode_tile(b'not an image').shape == (TILE_SIZE, TILE_SIZE, 3)
+    assert (decode_tile(None) == decode_tile(None)).all()
+
+
+def test_ingest_shrinks_to_the_max_edge():
+    original = jpeg(3000, 2000)
+    ingested = ingest_image(original, 1024, 85)
+
+    assert (ingested.width, ingested.height) == (1024, 683)
+    assert (ingested.original_width, ingested.original_height) == (3000, 2000)
+    assert ingested.original_bytes == len(original)
+    assert len(ingested.data) < len(original)
+    assert image_size(ingested.data) == (1024, 683)
+
+
+def test_ingest_keeps_small_images_at_their_size_and_drops_exif():
+    ingested = ingest_image(jpeg(400, 300, exif=True), 1024, 85)
+
+    assert (ingested.width, ingested.height) == (400, 300)
+    assert not Image.open(BytesIO(ingested.data)).getexif()
+    assert ingest_image(b'not an image', 1024, 85) is None
@@ -0,0 +1,192 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+from services.image_service import ImageService
+from services.resilience import CircuitOpenError, Upstreams
+from services.thumbnail_cache import TILE_SHAPE, ThumbnailCache
+
+
+class FakeResponse:
+    def __init__(self, status=200, body=b'', content_type='image/jpeg', headers=None,
+                 content_length=None, chunk_size=64 * 1024):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.content_length = content_length
+        self.chunk_size = chunk_size
+        self.read_bytes = 0
+        self.closed = False
+        self.content = self
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self.body), self.chunk_size):
+            chunk = self.body[start:start + self.chunk_size]
+            self.read_bytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = dict(responses)
+        self.requests = []
+
+    def get(self, url, timeout=None, headers=None):
+        self.requests.append((url, headers or {}))
+        response = self.responses[url]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def image_service(cache=None) -> ImageService:
+    return ImageService(None, None, cache or ThumbnailCache())
+
+
+def tile(value: int) -> np.ndarray:
+    return np.full(TILE_SHAPE, value, dtype=np.uint8)
+
+
+def test_fresh_tile_skips_the_download(monkeypatch):
+    monkeypatch.delenv('THUMBNAIL_CACHE_DIR', raising=False)
+    service = image_service()
+    session = FakeSession({})
+
+    async def run():
+        await service.thumbnail_cache.put('https://t/a', tile(5), '"v1"', None)
+        return await service.fetch_image(session, 'https://t/a')
+
+    item, validators = asyncio.run(run())
+    assert (item == 5).all() and validators is None
+    assert session.requests == []
+    assert service.thumbnail_cache.hits == 1
+
+
+def test_stale_tile_is_revalidated(monkeypatch):
+    monkeypatch.delenv('THUMBNAIL_CACHE_DIR', raising=False)
+    monkeypatch.setenv('THUMBNAIL_CACHE_FRESH_SECONDS', '60')
+    service = image_service()
+    cache = service.thumbnail_cache
+    session = FakeSession({'https://t/a': FakeResponse(status=304)})
+
+    async def run():
+        await cache.put('https://t/a', tile(5), '"v1"', 'Mon')
+        cache._memory[cache.key('https://t/a')].stored_at -= 120
+        return await service.fetch_image(session, 'https://t/a')
+
+    item, validators = asyncio.run(run())
+    assert (item == 5).all() and validators is None
+    assert session.requests == [('https://t/a', {'If-None-Match': '"v1"',
+                                                 'If-Modified-Since': 'Mon'})]
+    assert cache.revalidated == 1
+    assert time.time() - cache._memory[cache.key('https://t/a')].stored_at < 5
+
+
+def test_changed_thumbnail_is_downloaded_with_its_validators(monkeypatch):
+    monkeypatch.delenv('THUMBNAIL_CACHE_DIR', raising=False)
+    service = image_service()
+    session = FakeSession({'https://t/a': FakeResponse(
+        body=b'\xff\xd8\xff' + b'\0' * 20, headers={'ETag': '"v2"', 'Last-Modified': 'Tue'})})
+
+    item, validators = asyncio.run(service.fetch_image(session, 'https://t/a'))
+    assert item.startswith(b'\xff\xd8\xff')
+    assert validators == ('"v2"', 'Tue')
+    assert service.thumbnail_cache.misses == 1
+
+
+def test_stale_tile_is_served_when_the_host_fails(monkeypatch):
+    monkeypatch.delenv('THUMBNAIL_CACHE_DIR', raising=False)
+    monkeypatch.setenv('THUMBNAIL_CACHE_FRESH_SECONDS', '0')
+    service = image_service()
+    session = FakeSession({'https://t/a': FakeResponse(status=503),
+                           'https://t/b': asyncio.TimeoutError()})
+
+    async def run():
+        await service.thumbnail_cache.put('https://t/a', tile(5))
+        return (await service.fetch_image(session, 'https://t/a'),
+                await service.fetch_image(session, 'https://t/b'))
+
+    (stale, _), (missing, _) = asyncio.run(run())
+    assert (stale == 5).all()
+    assert missing is None
+    assert service.thumbnail_cache.stale_served == 1
+    assert service.fetch_failures == {"http_503": 1, "timeout": 1}
+
+
+def test_gallery_uploads_go_through_the_imgbb_breaker(monkeypatch):
+    monkeypatch.setenv('BREAKER_FAILURES', '2')
+    monkeypatch.setenv('GALLERY_TRANSPORT', 'upload')
+    upstreams = Upstreams()
+    service = ImageService(None, None, ThumbnailCache(), upstreams=upstreams)
+    uploads = []
+
+    async def upload_image(file_content):
+        uploads.append(file_content)
+        raise ConnectionError("imgbb is down")
+    service.upload_image = upload_image
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                await service.publish(b'sheet')
+        with pytest.raises(CircuitOpenError):
+            await service.publish(b'sheet')
+        # Inline sheets never touch imgbb
+        assert (await service.publish(b'sheet', inline=True)).startswith('data:')
+
+    asyncio.run(run())
+    assert len(uploads) == 2
+    assert upstreams.failures['imgbb'] == 2
+
+
+def test_thumbnail_over_the_byte_cap_is_dropped(monkeypatch):
+    monkeypatch.setenv('THUMBNAIL_MAX_BYTES', '1000')
+    service = image_service()
+    declared = FakeResponse(body=b'\xff\xd8\xff' + b'\0' * 2000, content_length=2003)
+    streamed = FakeResponse(body=b'\xff\xd8\xff' + b'\0' * 5000, chunk_size=400)
+
+    async def run():
+        return (await service.read_thumbnail(declared, 'https://t/a'),
+                await service.read_thumbnail(streamed, 'https://t/b'))
+
+    assert asyncio.run(run()) == (None, None)
+    # A declared length is refused before any of the body is read
+    assert declared.closed and declared.read_bytes == 0
+    # Without one, reading stops at the first chunk past the cap
+    assert streamed.closed and streamed.read_bytes == 1200
+    assert service.fetch_failures == {"too_large": 2}
+
+
+def test_thumbnail_types_are_checked():
+    service = image_service()
+    jpeg = b'\xff\xd8\xff\xe0' + b'\0' * 20
+    responses = {
+        'typed': FakeResponse(body=jpeg),
+        'html': FakeResponse(body=b'<html></html>', content_type='text/html'),
+        'sniffed': FakeResponse(body=jpeg, content_type='application/octet-stream'),
+        'unknown': FakeResponse(body=b'<html><body>nope</body></html>',
+                                content_type='binary/octet-stream'),
+    }
+
+    async def run():
+        return {name: await service.read_thumbnail(response, f'https://t/{name}')
+                for name, response in responses.items()}
+
+    read = asyncio.run(run())
+    assert read == {'typed': jpeg, 'html': None, 'sniffed': jpeg, 'unknown': None}
+    assert responses['html'].closed and responses['html'].read_bytes == 0
+    assert responses['unknown'].closed
+    assert not responses['sniffed'].closed
+    assert service.fetch_failures == {"not_image": 2}
@@ -0,0 +1,96 @@
+import asyncio
+
+import fakeredis
+import fakeredis.aioredis
+
+from services.cache import RedisCache
+from services.job_queue import JobQueue
+
+
+def job_queue(monkeypatch, **env) -> JobQueue:
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    cache = RedisCache()
+    cache.text = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(),
+                                              decode_responses=True)
+    return JobQueue(cache)
+
+
+def test_claim_oldest_first_and_complete(monkeypatch):
+    queue = job_queue(monkeypatch)
+
+    async def run():
+        first = await queue.enqueue({"image_url": "https://a"})
+        second = await queue.enqueue({"image_url": "https://b"})
+
+        assert await queue.claim() == (first, {"image_url": "https://a"})
+        job = await queue.get(first)
+        assert (job["status"], job["attempts"]) == ("running", 1)
+
+        await queue.complete(first, {"ok": True})
+        job = await queue.get(first)
+        assert (job["status"], job["result"]) == ("done", {"ok": True})
+
+        assert (await queue.claim())[0] == second
+        assert await queue.claim() is None
+
+        stats = await queue.stats()
+        assert (stats["enqueued"], stats["completed"], stats["processing"]) == (2, 1, 1)
+
+    asyncio.run(run())
+
+
+def test_failed_job_is_retried_then_failed(monkeypatch):
+    queue = job_queue(monkeypatch, JOB_MAX_ATTEMPTS='2')
+
+    async def run():
+        job_id = await queue.enqueue({})
+        for attempt in range(2):
+            claimed, _ = await queue.claim()
+            assert claimed == job_id
+            await queue.fail(job_id, "boom")
+
+        job = await queue.get(job_id)
+        assert (job["status"], job["attempts"], job["error"]) == ("failed", 2, "boom")
+        assert await queue.claim() is None
+        assert (await queue.stats())["retried"] == 1
+
+    asyncio.run(run())
+
+
+def test_expired_claims_are_requeued(monkeypatch):
+    queue = job_queue(monkeypatch, JOB_VISIBILITY_SECONDS='0.05')
+
+    async def run():
+        job_id = await queue.enqueue({})
+        await queue.claim()
+        assert await queue.requeue_expired() == 0
+
+        await asyncio.sleep(0.06)
+        assert await queue.requeue_expired() == 1
+        assert await queue.requeue_expired() == 0
+        assert (await queue.get(job_id))["status"] == "queued"
+        assert (await queue.claim())[0] == job_id
+        assert (await queue.stats())["expired"] == 1
+
+    asyncio.run(run())
+
+
+def test_heartbeat_keeps_claim(monkeypatch):
+    queue = job_queue(monkeypatch, JOB_VISIBILITY_SECONDS='0.05')
+
+    async def run():
+        job_id = await queue.enqueue({})
+        await queue.claim()
+        await asyncio.sleep(0.03)
+        await queue.heartbeat(job_id)
+        await asyncio.sleep(0.03)
+        assert await queue.requeue_expired() == 0
+
+        # A worker failing the job after its claim lapsed does not queue it twice
+        await asyncio.sleep(0.06)
+        assert await queue.requeue_expired() == 1
+        await queue.fail(job_id, "late")
+        assert (await queue.stats())["depth"] == 1
+
+    asyncio.run(run())
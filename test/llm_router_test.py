@@ -0,0 +1,112 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+from openai import APIConnectionError, APIStatusError
+
+from services.llm_router import LLMRouter
+from services.rate_limit import RateLimitedError
+
+REQUEST = httpx.Request('POST', 'https://azure.test/chat/completions')
+
+
+def status_error(status: int, headers=None) -> APIStatusError:
+    response = httpx.Response(status, headers=headers, request=REQUEST)
+    return APIStatusError(f"status {status}", response=response, body=None)
+
+
+def router(monkeypatch, *names) -> LLMRouter:
+    monkeypatch.setenv('AZURE_KEY', 'test')
+    monkeypatch.setenv('LLM_EXPLORE_RATE', '0')
+    monkeypatch.setenv('AZURE_OPENAI_DEPLOYMENTS', json.dumps(
+        [{"name": name, "endpoint": f"https://{name}.test/", "deployment": "gpt-4o"}
+         for name in names]))
+    return LLMRouter()
+
+
+def answering(router: LLMRouter, outcomes: dict):
+    """Replace the API call: each deployment answers or raises from `outcomes`."""
+    calls = []
+
+    async def call(deployment, kwargs):
+        calls.append(deployment.name)
+        outcome = outcomes[deployment.name]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    router._call = call
+    return calls
+
+
+@pytest.mark.parametrize('configured', [None, '', '[]', '{"name": "east"}'])
+def test_without_a_deployment_list_one_deployment_is_built(monkeypatch, configured):
+    if configured is None:
+        monkeypatch.delenv('AZURE_OPENAI_DEPLOYMENTS', raising=False)
+    else:
+        monkeypatch.setenv('AZURE_OPENAI_DEPLOYMENTS', configured)
+    monkeypatch.setenv('AZURE_OPENAI_ENDPOINT', 'https://single.test/')
+    monkeypatch.setenv('AZURE_OPENAI_DEPLOYMENT', 'gpt-4o-mini')
+
+    assert LLMRouter._configs() == [{"endpoint": 'https://single.test/',
+                                     "deployment": 'gpt-4o-mini'}]
+
+
+def test_deployments_are_named_for_their_buckets(monkeypatch):
+    monkeypatch.setenv('AZURE_KEY', 'test')
+    monkeypatch.delenv('AZURE_OPENAI_DEPLOYMENTS', raising=False)
+    monkeypatch.setenv('AZURE_OPENAI_DEPLOYMENT', 'gpt-4o')
+    assert [d.bucket for d in LLMRouter().deployments] == ["azure_openai:gpt-4o"]
+
+    listed = router(monkeypatch, "east", "west")
+    assert [d.bucket for d in listed.deployments] == ["azure_openai:east", "azure_openai:west"]
+
+
+def test_ranking_prefers_untried_then_fast_then_idle(monkeypatch):
+    llm = router(monkeypatch, "slow", "fast", "fresh", "cold")
+    slow, fast, fresh, cold = llm.deployments
+    slow.latency, fast.latency = 2.0, 0.5
+    fast.in_flight = 1
+    cold.cooldown_until = time.monotonic() + 30
+
+    assert [d.name for d in llm.ranked()] == ["fresh", "fast", "slow", "cold"]
+
+    # Almost no quota left puts a deployment behind every healthy one
+    fresh.remaining_tokens, fresh.quota_seen_at = 10, time.monotonic()
+    assert [d.name for d in llm.ranked()] == ["fast", "slow", "fresh", "cold"]
+
+
+def test_failures_move_the_call_to_the_next_deployment(monkeypatch):
+    llm = router(monkeypatch, "east", "west", "north")
+    calls = answering(llm, {"east": status_error(503), "west": APIConnectionError(request=REQUEST),
+                            "north": "completion"})
+
+    assert asyncio.run(llm.chat(messages=[])) == "completion"
+    assert calls == ["east", "west", "north"]
+    assert llm.failovers == 2
+    east, west, _ = llm.deployments
+    assert east.cooling_down(time.monotonic()) and west.cooling_down(time.monotonic())
+    # Cooling deployments are tried last next time
+    assert [d.name for d in llm.ranked()] == ["north", "east", "west"]
+
+
+def test_client_errors_are_not_retried_elsewhere(monkeypatch):
+    llm = router(monkeypatch, "east", "west")
+    calls = answering(llm, {"east": status_error(400), "west": "completion"})
+
+    with pytest.raises(APIStatusError):
+        asyncio.run(llm.chat(messages=[]))
+    assert calls == ["east"]
+
+
+def test_every_deployment_throttled_is_a_rate_limit(monkeypatch):
+    llm = router(monkeypatch, "east", "west")
+    answering(llm, {"east": status_error(429, {'retry-after': '7'}),
+                    "west": status_error(429, {'retry-after-ms': '3000'})})
+
+    with pytest.raises(RateLimitedError) as raised:
+        asyncio.run(llm.chat(messages=[]))
+    assert raised.value.retry_after == 3.0
+    assert [d.throttled for d in llm.deployments] == [1, 1]
+    assert all(d.remaining_requests == 0 for d in llm.deployments)
@@ -0,0 +1,310 @@
+import asyncio
+import json
+from collections import Counter
+from contextlib import asynccontextmanager
+from io import BytesIO
+
+import fakeredis
+import fakeredis.aioredis
+import httpx
+import numpy as np
+import pytest
+from PIL import Image
+
+import main
+from main import match_galleries, match_index, usable_reply
+from services.image_service import Gallery
+from services.matching_service import UnusableMatchError
+from services.query_index import QueryIndex
+from services.resilience import Deadline, Upstreams
+
+# Nothing listens here, so every thumbnail fetch fails fast and is drawn as
+# an error tile
+THUMBNAILS = 'http://127.0.0.1:9'
+
+
+class StageCacheStub:
+    """Caches what `compute` returns, like StageCache, without Redis."""
+
+    def __init__(self):
+        self.values = {}
+        self.computed = 0
+
+    async def get_or_compute(self, stage, key, compute):
+        if (stage, key) not in self.values:
+            self.computed += 1
+            self.values[(stage, key)] = await compute()
+        return self.values[(stage, key)]
+
+
+class MatchingServiceStub:
+    def __init__(self, *replies):
+        self.replies = list(replies)
+
+    async def get_matching_images(self, urls):
+        return json.dumps(self.replies.pop(0))
+
+
+def galleries(labels=None):
+    return [Gallery(engine, url=f"https://i.ibb.co/{engine}.png", labels=labels)
+            for engine in ("amz", "gs", "gis", "lens")]
+
+
+def services(*replies):
+    return {"stage_cache": StageCacheStub(), "upstreams": Upstreams(),
+            "matching_service": MatchingServiceStub(*replies)}
+
+
+def test_match_index():
+    assert match_index({"amz": 3}, "amz") == 3
+    assert match_index({"amz": "7"}, "amz") == 7
+    assert match_index(5, "amz") == 5
+    assert match_index({"amz": None}, "amz") is None
+    assert match_index({"amz": "none"}, "amz") is None
+    assert match_index({"amz": [1, 2]}, "amz") is None
+    assert match_index({"amz": True}, "amz") is None
+    assert match_index({}, "amz") is None
+    # The query image is never a match
+    assert match_index({"amz": 0}, "amz") is None
+
+
+def test_match_index_must_be_drawn_on_the_gallery():
+    labels = [0, 4, 9, 17]
+    assert match_index({"amz": 9}, "amz", labels) == 9
+    assert match_index({"amz": 5}, "amz", labels) is None
+    assert match_index({"amz": 0}, "amz", labels) is None
+    assert match_index({"amz": 30}, "amz", list(range(26))) is None
+
+
+def test_usable_reply():
+    reply = {"amz": None, "gs": 3}
+    assert usable_reply(reply, galleries()) is reply
+    with pytest.raises(UnusableMatchError):
+        usable_reply({"amz": None, "gs": "none", "gis": 0, "lens": 99}, galleries(list(range(13))))
+
+
+def test_unusable_gpt_reply_fails_only_its_engine():
+    stubs = services({"amz": None, "gs": "none", "gis": 3, "lens": 0})
+    failures = {}
+
+    async def run():
+        return await match_galleries(stubs, galleries(), Deadline(10, 5), failures, [])
+
+    indices, decisions = asyncio.run(run())
+    assert indices == {"gis": 3}
+    assert decisions["gis"].index == 3
+    assert decisions["amz"].index is None
+    assert sorted(failures) == ["amz", "gs", "lens"]
+    assert "no usable match index" in failures["amz"]
+
+
+def test_reply_without_any_usable_index_is_not_cached():
+    stubs = services({"amz": None, "gs": 40, "gis": "none", "lens": 0},
+                     {"amz": 2, "gs": 4, "gis": 6, "lens": 8})
+    first, second = {}, {}
+
+    async def run():
+        await match_galleries(stubs, galleries(list(range(13))), Deadline(10, 5), first, [])
+        return await match_galleries(stubs, galleries(list(range(13))), Deadline(10, 5), second, [])
+
+    indices, _ = asyncio.run(run())
+    assert "no usable match index" in first["matching"]
+    assert indices == {"amz": 2, "gs": 4, "gis": 6, "lens": 8}
+    assert second == {}
+    assert stubs["stage_cache"].computed == 2
+
+
+class FakeUpstreams:
+    """Stands in for the search engines, imgbb and GPT behind the app."""
+
+    def __init__(self, monkeypatch):
+        self.calls = Counter()
+        # What GPT answers for each engine's gallery
+        self.indices = {"amz": 1, "gs": 2, "gis": 3, "lens": 4}
+
+        server = fakeredis.FakeServer()
+        monkeypatch.setattr(main.redis_cache, 'text',
+                            fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+        monkeypatch.setattr(main.redis_cache, 'binary',
+                            fakeredis.aioredis.FakeRedis(server=server))
+        monkeypatch.setattr(main, 'query_index', QueryIndex(main.redis_cache, main.RESULT_TTL))
+        upstreams = Upstreams(main.rate_limiter, main.metrics)
+        monkeypatch.setattr(main, 'upstreams', upstreams)
+        monkeypatch.setattr(main.image_service, 'upstreams', upstreams)
+        monkeypatch.setattr(main.image_service, 'gallery_transport', 'upload')
+
+        for name in ('amazon_search', 'google_search', 'google_image_search',
+                     'google_lens_search'):
+            monkeypatch.setattr(main.search_service, name, getattr(self, name))
+        monkeypatch.setattr(main.image_service, 'get_product_query', self.get_product_query)
+        monkeypatch.setattr(main.image_service, 'upload_image', self.upload_image)
+        monkeypatch.setattr(main.matching_service, 'get_matching_images',
+                            self.get_matching_images)
+
+    @staticmethod
+    def results(key: str, count: int) -> list[dict]:
+        return [{'position': i, 'title': f'{key}{i}', 'link': f'https://{key}/{i}',
+                 'thumbnail': f'{THUMBNAILS}/{key}/{i}'} for i in range(1, count + 1)]
+
+    async def amazon_search(self, query):
+        self.calls['search'] += 1
+        organic = [{'pos': i, 'title': f'amz{i}', 'url': f'/dp/{i}', 'price': 9.99,
+                    'url_image': f'{THUMBNAILS}/amz/{i}'} for i in range(1, 8)]
+        return json.dumps({'results': [{'content': {'results': {'results': {
+            'organic': organic, 'amazons_choices': []}}}}]})
+
+    async def google_search(self, query):
+        self.calls['search'] += 1
+        return {'organic_results': self.results('gs', 7)}
+
+    async def google_image_search(self, image_url):
+        self.calls['search'] += 1
+        return {'image_results': self.results('gis', 7)}
+
+    async def google_lens_search(self, image_url):
+        self.calls['search'] += 1
+        return {'visual_matches': self.results('lens', 7)}
+
+    async def get_product_query(self, image_url, detail=None):
+        self.calls['product_query'] += 1
+        return json.dumps({'query': 'red water bottle'})
+
+    async def upload_image(self, file_content):
+        self.calls['upload'] += 1
+        return f'https://i.ibb.co/{self.calls["upload"]}.jpg'
+
+    async def get_matching_images(self, galleries, detail=None):
+        self.calls['gpt'] += 1
+        return json.dumps({engine: self.indices[engine] for engine in galleries})
+
+
+@pytest.fixture
+def fake_upstreams(monkeypatch):
+    return FakeUpstreams(monkeypatch)
+
+
+@asynccontextmanager
+async def client():
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test',
+                                     timeout=None) as http:
+            yield http
+
+
+async def stream_events(http, **params) -> list[dict]:
+    response = await http.post('/search/stream', params=params)
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_stream_emits_each_engine_then_the_result(fake_upstreams):
+    async def run():
+        async with client() as http:
+            return (await stream_events(http, image_url=f'{THUMBNAILS}/query.jpg'),
+                    await stream_events(http, image_url=f'{THUMBNAILS}/query.jpg'))
+
+    events, replayed = asyncio.run(run())
+    assert events[0] == {"event": "query", "query": "red water bottle",
+                         "original_image": f'{THUMBNAILS}/query.jpg'}
+    assert sorted(event["engine"] for event in events[1:-1]) == ["amz", "gis", "gs", "lens"]
+    assert all(event["event"] == "match" for event in events[1:-1])
+    result = events[-1]["result"]
+    assert result["errors"] == {}
+    assert result["matches"]["amazon"]["title"] == "amz1"
+    assert result["matches"]["google_lens"]["title"] == "lens4"
+    # Each engine is matched by its own GPT call
+    assert fake_upstreams.calls["gpt"] == 4
+
+    # A complete result is cached and replayed in the same shape
+    assert [event["event"] for event in replayed] == [event["event"] for event in events]
+    assert replayed[-1]["result"]["matches"] == result["matches"]
+    assert fake_upstreams.calls["search"] == 4
+
+
+def test_stream_reports_an_unmatched_engine_and_does_not_cache(fake_upstreams):
+    fake_upstreams.indices["gs"] = None
+
+    async def run():
+        async with client() as http:
+            first = await stream_events(http, image_url=f'{THUMBNAILS}/query.jpg')
+            fake_upstreams.indices["gs"] = 2
+            return first, await stream_events(http, image_url=f'{THUMBNAILS}/query.jpg')
+
+    first, retry = asyncio.run(run())
+    [error] = [event for event in first if event["event"] == "error"]
+    assert error["engine"] == "gs"
+    assert "no usable match index" in error["detail"]
+    assert "google_search" not in first[-1]["result"]["matches"]
+    assert "no usable match index" in first[-1]["result"]["errors"]["gs"]
+
+    # Nothing was cached for gs, so the retry asks GPT again and completes
+    assert retry[-1]["result"]["errors"] == {}
+    assert retry[-1]["result"]["matches"]["google_search"]["title"] == "gs2"
+    assert fake_upstreams.calls["gpt"] == 5
+
+
+def jpeg(seed: int = 0) -> bytes:
+    pixels = np.random.default_rng(seed).integers(0, 256, (64, 64, 3), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def test_repeat_upload_reuses_the_hosted_copy(fake_upstreams):
+    deduplicated = main.upload_stats["deduplicated"]
+
+    async def run():
+        async with client() as http:
+            first = await http.post('/search', files={'image': ('q.jpg', jpeg(), 'image/jpeg')})
+            calls = fake_upstreams.calls.copy()
+            second = await http.post('/search', files={'image': ('q.jpg', jpeg(), 'image/jpeg')})
+            return first, second, calls
+
+    first, second, calls = asyncio.run(run())
+    assert first.status_code == second.status_code == 200
+    assert second.json()["original_image"] == first.json()["original_image"]
+    # The same bytes again: no upload (query or galleries), GPT call or search
+    assert fake_upstreams.calls == calls
+    assert main.upload_stats["deduplicated"] == deduplicated + 1
+
+
+async def batch_events(http, **request) -> list[dict]:
+    response = await http.post('/search/batch', **request)
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_batch_runs_each_distinct_image_once(fake_upstreams):
+    image_urls = [f'{THUMBNAILS}/a.jpg', f'{THUMBNAILS}/b.jpg', f'{THUMBNAILS}/a.jpg']
+    files = [('images', ('x.jpg', jpeg(1), 'image/jpeg')),
+             ('images', ('y.jpg', jpeg(1), 'image/jpeg'))]
+
+    async def run():
+        async with client() as http:
+            return await batch_events(http, data={'image_urls': image_urls}, files=files)
+
+    events = asyncio.run(run())
+    items = {event["index"]: event for event in events if event["event"] == "item"}
+    assert sorted(items) == [0, 1, 2, 3, 4]
+    assert all(item["status"] == 200 for item in items.values())
+    assert items[2]["duplicate_of"] == 0
+    assert items[4]["duplicate_of"] == 3
+    assert items[2]["result"] == items[0]["result"]
+    assert events[-1] == {"event": "done", "items": 5, "unique_items": 3,
+                          "distinct_queries": 1, "failed": 0}
+
+
+def test_batch_uploads_are_capped_in_total(fake_upstreams, monkeypatch):
+    upload = jpeg()
+    monkeypatch.setattr(main, 'BATCH_MAX_BYTES', 2 * len(upload))
+    files = [('images', (f'{i}.jpg', upload, 'image/jpeg')) for i in range(3)]
+
+    async def run():
+        async with client() as http:
+            return await http.post('/search/batch', files=files)
+
+    response = asyncio.run(run())
+    assert response.status_code == 413
+    assert str(2 * len(upload)) in response.json()["detail"]
+    assert fake_upstreams.calls == {}
@@ -0,0 +1,63 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from services.candidates import Candidate, Candidates
+from services.matching_service import MatchingService
+
+
+class FakeLLM:
+    """Answers every chat call with the next canned reply."""
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = []
+
+    async def chat(self, **kwargs):
+        self.calls.append(kwargs)
+        message = SimpleNamespace(content=json.dumps(self.replies.pop(0)))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+@pytest.mark.parametrize('reply, index', [
+    ({"amz": 4}, 4),
+    ({"amz": "7"}, 7),
+    # With one gallery GPT sometimes names its own key
+    ({"closest_match": 3}, 3),
+    ({"amz": None}, None),
+    ({"amz": "none"}, None),
+    ({"gs": 2, "gis": 5}, None),
+])
+def test_get_matching_image(reply, index):
+    service = MatchingService(FakeLLM(reply))
+    assert asyncio.run(service.get_matching_image("amz", "https://i.test/amz.png")) == index
+
+
+def test_extract_matching_objects_reads_the_chosen_slot():
+    candidates = {engine: Candidates(engine, [
+        Candidate(engine, i, f"{engine}{i}", f"https://{engine}/{i}", 9.99, f"https://t/{engine}/{i}")
+        for i in range(1, 4)]) for engine in ("amz", "lens")}
+    service = MatchingService(FakeLLM())
+
+    extracted = asyncio.run(service.extract_matching_objects(
+        {"amz": 2, "lens": 9, "gs": 1}, candidates))
+    assert extracted == {"amazon": {"title": "amz2", "price": 9.99, "link": "https://amz/2",
+                                    "image": "https://t/amz/2"}}
+
+
+def test_packed_sheets_name_their_galleries_top_to_bottom(monkeypatch):
+    monkeypatch.setenv('VISION_DETAIL_MATCHING', 'high')
+    llm = FakeLLM({"amz": 1, "gs": 2, "lens": 3})
+    service = MatchingService(llm)
+
+    reply = asyncio.run(service.get_matching_sheets(
+        [(["amz", "gs"], "https://i.test/packed.png"), (["lens"], "https://i.test/lens.png")]))
+    assert json.loads(reply) == {"amz": 1, "gs": 2, "lens": 3}
+    content = llm.calls[0]["messages"][1]["content"]
+    assert [part.get("text") for part in content[::2]] == [
+        "Galleries: amz, gs (top to bottom)", "Gallery: lens"]
+    assert [part["image_url"] for part in content[1::2]] == [
+        {"url": "https://i.test/packed.png", "detail": "high"},
+        {"url": "https://i.test/lens.png", "detail": "high"}]
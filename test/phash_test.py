@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+
+from services.phash import fingerprint, hamming, rank_candidates
+
+
+def tile(seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    return cv2.resize(small, (150, 150), interpolation=cv2.INTER_LINEAR)
+
+
+def test_recompressed_tile_is_near_duplicate():
+    original = tile(1)
+    _, encoded = cv2.imencode('.jpg', original, [cv2.IMWRITE_JPEG_QUALITY, 60])
+    recompressed = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+
+    a, b = fingerprint(original), fingerprint(recompressed)
+    assert a.is_near_duplicate(b, 4)
+    assert not a.is_near_duplicate(fingerprint(tile(2)), 4)
+    assert a.distance(b) < a.distance(fingerprint(tile(2)))
+
+
+def test_rank_orders_by_distance_and_keeps_top_k():
+    query = fingerprint(tile(1))
+    candidates = {index: fingerprint(tile(seed))
+                  for index, seed in [(1, 5), (2, 1), (3, 6), (4, 7)]}
+
+    ranking = rank_candidates(query, candidates, top_k=2, exact_bits=4)
+
+    assert len(ranking.candidates) == 2
+    assert ranking.candidates[0] == (2, 0.0)
+    assert ranking.candidates[0][1] <= ranking.candidates[1][1]
+    assert ranking.exact_index == 2
+    assert ranking.exact_bits == 0
+
+
+def test_rank_keeps_everything_without_top_k():
+    query = fingerprint(tile(1))
+    candidates = {index: fingerprint(tile(index + 10)) for index in range(1, 6)}
+
+    ranking = rank_candidates(query, candidates, top_k=0, exact_bits=4)
+
+    distances = [distance for _, distance in ranking.candidates]
+    assert sorted(index for index, _ in ranking.candidates) == [1, 2, 3, 4, 5]
+    assert distances == sorted(distances)
+    assert ranking.exact_index is None
+
+
+def test_rank_exact_shortcut_can_be_disabled():
+    query = fingerprint(tile(1))
+    ranking = rank_candidates(query, {1: fingerprint(tile(1))}, top_k=0, exact_bits=-1)
+
+    assert ranking.exact_index is None
+    assert ranking.exact_bits is None
+
+
+def test_rank_no_candidates():
+    ranking = rank_candidates(fingerprint(tile(1)), {}, top_k=5, exact_bits=4)
+    assert ranking.candidates == []
+    assert ranking.exact_index is None
+
+
+def test_hamming():
+    assert hamming(0, 0) == 0
+    assert hamming(0b1011, 0b0001) == 2
+    assert hamming(0, (1 << 64) - 1) == 64
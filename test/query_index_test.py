@@ -0,0 +1,137 @@
+import asyncio
+import random
+import time
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+
+from services.cache import RedisCache
+from services.phash import hamming
+from services.query_index import MultiIndexHash, QueryIndex
+
+
+def flip(key: int, *bits: int) -> int:
+    for bit in bits:
+        key ^= 1 << bit
+    return key
+
+
+def test_nearest_exact_and_within_distance():
+    index = MultiIndexHash()
+    index.add(0x0123456789abcdef, 'a')
+    index.add(0xfedcba9876543210, 'b')
+
+    assert index.nearest(0x0123456789abcdef, 0) == (0, 0x0123456789abcdef, 'a')
+    near = flip(0x0123456789abcdef, 0, 17, 40)
+    assert index.nearest(near, 3) == (3, 0x0123456789abcdef, 'a')
+    assert index.nearest(near, 2) is None
+
+
+def test_nearest_picks_closest():
+    index = MultiIndexHash()
+    base = 0x00ff00ff00ff00ff
+    index.add(flip(base, 1, 2, 3, 4), 'far')
+    index.add(flip(base, 60), 'close')
+
+    assert index.nearest(base, 6) == (1, flip(base, 60), 'close')
+
+
+def test_nearest_matches_brute_force():
+    rng = random.Random(0)
+    index = MultiIndexHash()
+    keys = [rng.getrandbits(64) for _ in range(500)]
+    for key in keys:
+        index.add(key, hex(key))
+
+    for _ in range(200):
+        base = rng.choice(keys)
+        query = flip(base, *rng.sample(range(64), rng.randint(0, 11)))
+        distance = hamming(query, base)
+        match = index.nearest(query, MultiIndexHash.MAX_DISTANCE)
+        assert match is not None
+        assert match[0] == min(hamming(query, key) for key in keys)
+        assert match[0] <= distance
+
+
+def test_remove():
+    index = MultiIndexHash()
+    index.add(0x1234, 'a')
+    index.add(0x1234, 'b')
+    assert index.size == 1
+    assert index.nearest(0x1235, 1) == (1, 0x1234, 'b')
+
+    index.remove(0x1234)
+    index.remove(0x1234)
+    assert index.size == 0
+    assert index.nearest(0x1234, 4) is None
+    assert all(not table for table in index._tables)
+
+
+def test_max_distance_is_enforced():
+    with pytest.raises(ValueError):
+        MultiIndexHash().nearest(0x1234, MultiIndexHash.MAX_DISTANCE + 1)
+
+
+def test_query_index_validates_max_distance(monkeypatch):
+    monkeypatch.setenv('QUERY_INDEX_MAX_DISTANCE', '12')
+    with pytest.raises(ValueError):
+        QueryIndex()
+
+
+def test_entries_expire(monkeypatch):
+    monkeypatch.delenv('QUERY_INDEX_PATH', raising=False)
+    monkeypatch.setenv('QUERY_INDEX_MAX_DISTANCE', '6')
+
+    async def run():
+        index = QueryIndex(ttl=60)
+        await index.add(0x1234, 'result:a')
+        assert await index.lookup(0x1235) == (1, 0x1234, 'result:a')
+
+        index.prune(time.time() + 61)
+        assert index.size == 0
+        assert index.stats()["expired"] == 1
+
+    asyncio.run(run())
+
+
+def test_file_is_compacted(monkeypatch, tmp_path):
+    path = tmp_path / 'query_index'
+    path.write_text(f"{0x1:016x} result:old {time.time() - 10:.0f}\n"
+                    f"{0x2:016x} result:legacy\n"
+                    f"{0x3:016x} result:live {time.time() + 600:.0f}\n")
+    monkeypatch.setenv('QUERY_INDEX_PATH', str(path))
+    monkeypatch.setenv('QUERY_INDEX_MAX_DISTANCE', '6')
+
+    async def run():
+        index = QueryIndex()
+        await index.load()
+        assert index.size == 1
+        assert (await index.lookup(0x3))[2] == 'result:live'
+
+    asyncio.run(run())
+    assert path.read_text().split()[1] == 'result:live'
+    assert len(path.read_text().splitlines()) == 1
+
+
+def test_workers_share_entries_through_redis(monkeypatch):
+    monkeypatch.delenv('QUERY_INDEX_PATH', raising=False)
+    monkeypatch.setenv('QUERY_INDEX_MAX_DISTANCE', '6')
+    monkeypatch.setenv('QUERY_INDEX_REFRESH_SECONDS', '0')
+
+    async def run():
+        cache = RedisCache()
+        cache.text = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(),
+                                                  decode_responses=True)
+        first, second = QueryIndex(cache), QueryIndex(cache)
+        await first.load()
+        await second.load()
+
+        await first.add(0xabcd, 'result:a')
+        assert await second.lookup(0xabcc) == (1, 0xabcd, 'result:a')
+
+        await second.discard(0xabcd)
+        assert await cache.text.hgetall(QueryIndex.REDIS_KEY) == {}
+        assert await cache.text.zcard(QueryIndex.EXPIRY_KEY) == 0
+
+    asyncio.run(run())
@@ -0,0 +1,113 @@
+import asyncio
+import time
+from email.utils import formatdate
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+
+from services.cache import RedisCache
+from services.rate_limit import (
+    RateLimitedError, RateLimiter, RateLimitWaitExceeded, parse_retry_after, rate_limit_of)
+
+
+def redis_cache() -> RedisCache:
+    cache = RedisCache()
+    cache.text = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(),
+                                              decode_responses=True)
+    return cache
+
+
+class StatusError(Exception):
+    """Shaped like openai.RateLimitError."""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = type('Response', (), {'headers': headers or {}})()
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after({}) is None
+    assert parse_retry_after({'retry-after': '3'}) == 3.0
+    assert parse_retry_after({'retry-after': '-2'}) == 0.0
+    assert parse_retry_after({'retry-after-ms': '1500', 'retry-after': '9'}) == 1.5
+    assert parse_retry_after({'retry-after-ms': 'soon', 'retry-after': '9'}) == 9.0
+    assert parse_retry_after({'retry-after': 'whenever'}) is None
+    in_a_minute = parse_retry_after({'retry-after': formatdate(time.time() + 60, usegmt=True)})
+    assert 55 < in_a_minute <= 60
+
+
+def test_rate_limit_of():
+    ours = RateLimitedError("serpapi", 2.0)
+    assert rate_limit_of(ours) is ours
+    assert rate_limit_of(StatusError(500)) is None
+    assert rate_limit_of(ValueError("nope")) is None
+
+    found = rate_limit_of(StatusError(429, {'retry-after': '4'}))
+    assert found.retry_after == 4.0
+    assert "StatusError rate limited" in str(found)
+
+
+def test_engines_share_the_serpapi_bucket(monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_SERPAPI', '1')
+    monkeypatch.setenv('RATE_BURST_SERPAPI', '2')
+    limiter = RateLimiter(redis_cache())
+
+    async def run():
+        return [await limiter.try_acquire(upstream)
+                for upstream in ('serpapi_google', 'serpapi_google_lens', 'serpapi_google_images')]
+
+    assert asyncio.run(run()) == [True, True, False]
+    assert limiter.acquired == {"serpapi": 2}
+    assert limiter.limits("azure_openai:gpt-4o") == (0.0, 1.0)
+
+
+def test_unlimited_bucket_still_honours_a_block(monkeypatch):
+    monkeypatch.delenv('RATE_LIMIT_AZURE_OPENAI_GPT_4O', raising=False)
+    limiter = RateLimiter(redis_cache())
+
+    async def run():
+        assert await limiter.try_acquire("azure_openai:gpt-4o")
+        await limiter.block("azure_openai:gpt-4o", 30)
+        assert not await limiter.try_acquire("azure_openai:gpt-4o")
+        with pytest.raises(RateLimitWaitExceeded):
+            await limiter.acquire("azure_openai:gpt-4o", budget=1)
+
+    asyncio.run(run())
+    stats = limiter.stats()["azure_openai:gpt-4o"]
+    assert stats["throttled_429"] == 1
+    assert stats["waited"] == 1
+    assert stats["rate_per_second"] is None
+
+
+def test_acquire_waits_for_the_next_token(monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_SERPAPI', '20')
+    monkeypatch.setenv('RATE_BURST_SERPAPI', '1')
+    limiter = RateLimiter(redis_cache())
+
+    async def run():
+        return [await limiter.acquire("serpapi_google") for _ in range(2)]
+
+    first, second = asyncio.run(run())
+    assert first == 0.0
+    assert 0 < second < 1
+    assert limiter.waits == {"serpapi": 1}
+
+
+def test_local_buckets_stand_in_while_redis_is_down(monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_SERPAPI', '1')
+    monkeypatch.setenv('RATE_BURST_SERPAPI', '1')
+    cache = redis_cache()
+    cache._down_until = time.monotonic() + 60
+    limiter = RateLimiter(cache)
+
+    async def run():
+        assert await limiter.try_acquire("serpapi_google")
+        assert not await limiter.try_acquire("serpapi_google")
+        await limiter.block("other", 30)
+        assert not await limiter.try_acquire("other")
+
+    asyncio.run(run())
+    assert set(limiter._local) == {"serpapi", "other"}
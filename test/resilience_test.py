@@ -0,0 +1,179 @@
+import asyncio
+import time
+
+import pytest
+
+from services.resilience import CircuitBreaker, CircuitOpenError, Deadline, Upstreams, within
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker('serp', failure_threshold=3, reset_seconds=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert 0 < breaker.retry_in() <= 30
+    assert breaker.times_opened == 1
+
+
+def test_breaker_half_open_allows_one_trial():
+    breaker = CircuitBreaker('serp', failure_threshold=1, reset_seconds=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    # A failed trial re-opens straight away
+    breaker.record_failure()
+    assert breaker.state == "open"
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.times_opened == 1
+
+
+def test_deadline():
+    deadline = Deadline(budget_seconds=10, engine_seconds=2)
+    assert 9.9 < deadline.remaining() <= 10
+    assert 1.9 < deadline.engine_remaining() <= 2
+
+    deadline = Deadline(budget_seconds=1, engine_seconds=5)
+    assert deadline.engine_remaining() <= 1
+
+    deadline.start -= 2
+    assert deadline.remaining() == 0.0
+    assert deadline.engine_remaining() == 0.0
+
+
+async def hang():
+    await asyncio.sleep(10)
+
+
+async def fail():
+    raise RuntimeError("upstream error")
+
+
+def test_failures_open_the_circuit(monkeypatch):
+    monkeypatch.setenv('BREAKER_FAILURES', '2')
+
+    async def run():
+        upstreams = Upstreams()
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await upstreams.call('gs', fail)
+        with pytest.raises(CircuitOpenError):
+            await upstreams.call('gs', fail)
+        assert upstreams.failures['gs'] == 2
+        assert upstreams.rejected['gs'] == 1
+
+    asyncio.run(run())
+
+
+def test_caller_cancellation_does_not_trip_breaker(monkeypatch):
+    monkeypatch.setenv('BREAKER_FAILURES', '2')
+
+    async def run():
+        upstreams = Upstreams()
+        for _ in range(5):
+            task = asyncio.create_task(upstreams.call('gs', hang))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        assert upstreams.breaker('gs').state == "closed"
+        assert upstreams.timeouts['gs'] == 0
+
+    asyncio.run(run())
+
+
+def test_blown_deadlines_trip_breaker(monkeypatch):
+    monkeypatch.setenv('BREAKER_FAILURES', '2')
+
+    async def run():
+        upstreams = Upstreams()
+        for _ in range(2):
+            with pytest.raises(asyncio.TimeoutError):
+                await within(upstreams.call('gs', hang), 0.02)
+        assert upstreams.breaker('gs').state == "open"
+        assert upstreams.timeouts['gs'] == 2
+
+    asyncio.run(run())
+
+
+def test_cancelled_half_open_trial_frees_the_slot():
+    async def run():
+        upstreams = Upstreams()
+        breaker = upstreams.breaker('gs')
+        breaker.reset_seconds = 0
+        breaker.failure_threshold = 1
+        breaker.record_failure()
+
+        task = asyncio.create_task(upstreams.call('gs', hang))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert breaker.allow()
+
+    asyncio.run(run())
+
+
+def test_hedged_calls_are_cancelled_with_the_caller(monkeypatch):
+    monkeypatch.setenv('HEDGE_UPSTREAMS', 'lens')
+    monkeypatch.setenv('HEDGE_MIN_SAMPLES', '1')
+
+    async def run():
+        upstreams = Upstreams()
+        upstreams.breaker('lens')
+        upstreams.latencies['lens'].add(0.5)
+        started = []
+
+        async def tracked():
+            started.append(asyncio.current_task())
+            await hang()
+
+        # Cancelled while still waiting out the hedge delay
+        task = asyncio.create_task(upstreams.call('lens', tracked))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0)
+        assert len(started) == 1
+        assert started[0].cancelled()
+
+    asyncio.run(run())
+
+
+def test_hedge_wins_when_first_call_is_slow(monkeypatch):
+    monkeypatch.setenv('HEDGE_UPSTREAMS', 'lens')
+    monkeypatch.setenv('HEDGE_MIN_SAMPLES', '1')
+
+    async def run():
+        upstreams = Upstreams()
+        upstreams.breaker('lens')
+        upstreams.latencies['lens'].add(0.02)
+        calls = []
+
+        async def first_slow():
+            calls.append(asyncio.current_task())
+            if len(calls) == 1:
+                await hang()
+            return "second"
+
+        assert await upstreams.call('lens', first_slow) == "second"
+        await asyncio.sleep(0)
+        assert upstreams.hedges['lens'] == 1
+        assert upstreams.hedge_wins['lens'] == 1
+        assert calls[0].cancelled()
+
+    asyncio.run(run())
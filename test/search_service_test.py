@@ -0,0 +1,106 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from services.rate_limit import RateLimitedError
+from services.search_service import SearchService
+from services.serpapi_client import SerpApiClient, SerpApiError
+
+
+class FakeResponse:
+    def __init__(self, status=200, body=b'{}', headers=None):
+        self.status = status
+        self.body = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.headers = headers or {}
+
+    async def read(self):
+        return self.body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def get(self, url, params=None, headers=None):
+        self.requests.append((url, params))
+        return self.response
+
+
+def client(response) -> tuple[SerpApiClient, FakeSession]:
+    session = FakeSession(response)
+    return SerpApiClient(SimpleNamespace(session=session)), session
+
+
+def search(response, params=None):
+    serpapi, _ = client(response)
+    return asyncio.run(serpapi.search(params or {"engine": "google", "q": "bottle"}))
+
+
+def test_search_sends_the_library_request(monkeypatch):
+    monkeypatch.setenv('SERPAPI_BACKEND', 'https://serp.test')
+    serpapi, session = client(FakeResponse(body={"organic_results": [{"position": 1}]}))
+
+    data = asyncio.run(serpapi.search({"engine": "google", "q": "bottle", "num": 10,
+                                       "location": None}))
+    assert data == {"organic_results": [{"position": 1}]}
+    assert session.requests == [('https://serp.test/search', {
+        "engine": "google", "q": "bottle", "num": "10", "output": "json", "source": "python"})]
+
+
+def test_large_bodies_parse_the_same(monkeypatch):
+    monkeypatch.setenv('SERPAPI_OFFLOOP_PARSE_BYTES', '16')
+    body = {"visual_matches": [{"position": i, "title": f"item {i}"} for i in range(50)]}
+    assert search(FakeResponse(body=body)) == body
+
+
+def test_rate_limit_carries_retry_after():
+    with pytest.raises(RateLimitedError) as raised:
+        search(FakeResponse(status=429, headers={'retry-after': '12'}))
+    assert raised.value.retry_after == 12.0
+
+
+@pytest.mark.parametrize('response, message', [
+    (FakeResponse(status=401, body={"error": "Invalid API key."}), "401: Invalid API key."),
+    (FakeResponse(status=503, body=b'<html>Bad gateway</html>'), "503: <html>Bad gateway"),
+    (FakeResponse(status=500, body={}), "500: no error message"),
+    (FakeResponse(body={"error": "Your searches for the month are exhausted.",
+                        "search_metadata": {"status": "Error"}}), "200: Your searches"),
+])
+def test_errors_raise(response, message):
+    with pytest.raises(SerpApiError) as raised:
+        search(response)
+    assert message in str(raised.value)
+    assert raised.value.status == response.status
+
+
+def test_a_search_without_results_is_not_an_error():
+    body = {"error": "Google hasn't returned any results for this query.",
+            "search_metadata": {"status": "Success"}}
+    assert search(FakeResponse(body=body)) == body
+
+
+def test_engines_search_through_serpapi(monkeypatch):
+    monkeypatch.setenv('GOOGLE_API_KEY', 'key')
+    session = FakeSession(FakeResponse(body={"visual_matches": []}))
+    service = SearchService(SimpleNamespace(session=session))
+
+    async def run():
+        await service.google_search("red bottle")
+        await service.google_image_search("https://i.test/q.jpg")
+        await service.google_lens_search("https://i.test/q.jpg")
+
+    asyncio.run(run())
+    params = [params for _, params in session.requests]
+    assert [p["engine"] for p in params] == ["google", "google_reverse_image", "google_lens"]
+    assert params[0]["q"] == "red bottle"
+    assert params[1]["image_url"] == params[2]["url"] == "https://i.test/q.jpg"
+    assert all(p["api_key"] == "key" for p in params)
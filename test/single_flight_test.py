@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from services.single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_compute():
+    async def run():
+        flight = SingleFlight()
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return {"calls": calls}
+
+        results = await asyncio.gather(*(flight.do('key', compute) for _ in range(5)))
+        assert results == [{"calls": 1}] * 5
+        assert calls == 1
+        assert flight.stats()["leaders"] == 1
+        assert flight.stats()["coalesced_local"] == 4
+        assert flight.stats()["in_flight"] == 0
+
+        # Finished keys are not remembered
+        assert await flight.do('key', compute) == {"calls": 2}
+
+    asyncio.run(run())
+
+
+def test_different_keys_run_separately():
+    async def run():
+        flight = SingleFlight()
+
+        async def compute(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        assert await asyncio.gather(flight.do('a', lambda: compute(1)),
+                                    flight.do('b', lambda: compute(2))) == [1, 2]
+        assert flight.leaders == 2
+
+    asyncio.run(run())
+
+
+def test_leader_error_reaches_followers():
+    async def run():
+        flight = SingleFlight()
+
+        async def compute():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("search failed")
+
+        results = await asyncio.gather(*(flight.do('key', compute) for _ in range(3)),
+                                       return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+    asyncio.run(run())
+
+
+def test_follower_takes_over_from_cancelled_leader():
+    async def run():
+        flight = SingleFlight()
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return calls
+
+        leader = asyncio.create_task(flight.do('key', compute))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do('key', compute))
+        await asyncio.sleep(0.005)
+        leader.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert await follower == 2
+
+    asyncio.run(run())
+
+
+def test_follower_gives_up_after_timeout(monkeypatch):
+    monkeypatch.setenv('SINGLE_FLIGHT_TIMEOUT', '0.02')
+
+    async def run():
+        flight = SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(0.2)
+            return "leader"
+
+        async def fast():
+            return "own"
+
+        leader = asyncio.create_task(flight.do('key', slow))
+        await asyncio.sleep(0)
+        assert await flight.do('key', fast) == "own"
+        assert flight.timeouts == 1
+        assert await leader == "leader"
+
+    asyncio.run(run())
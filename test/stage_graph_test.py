@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+from services.stage_graph import StageGraph, StageTimings
+
+
+def test_stages_run_after_their_dependencies():
+    async def run():
+        graph = StageGraph()
+        order = []
+
+        def stage(name, value, delay=0.0):
+            async def fn(*deps):
+                await asyncio.sleep(delay)
+                order.append(name)
+                return value + sum(deps)
+            return fn
+
+        graph.add("query", stage("query", 1, 0.02))
+        graph.add("upload", stage("upload", 10, 0.01))
+        graph.add("search", stage("search", 100), "query")
+        graph.add("match", stage("match", 1000), "search", "upload")
+
+        results = await graph.run()
+        assert results == {"query": 1, "upload": 10, "search": 101, "match": 1111}
+        assert order == ["upload", "query", "search", "match"]
+        assert graph.started["search"] >= graph.finished["query"]
+        assert graph.critical_path() == ["query", "search", "match"]
+        assert [row["stage"] for row in graph.timeline()][-1] == "match"
+
+    asyncio.run(run())
+
+
+def test_independent_stages_run_concurrently():
+    async def run():
+        graph = StageGraph()
+
+        async def slow():
+            await asyncio.sleep(0.05)
+
+        for name in ("a", "b", "c"):
+            graph.add(name, slow)
+        await graph.run()
+        assert max(graph.finished.values()) < 0.1
+
+    asyncio.run(run())
+
+
+def test_unknown_dependency():
+    graph = StageGraph()
+    with pytest.raises(ValueError):
+        graph.add("search", lambda query: query, "query")
+
+
+def test_failure_cancels_other_stages():
+    async def run():
+        graph = StageGraph()
+        reached = []
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upload failed")
+
+        async def slow():
+            await asyncio.sleep(1)
+            reached.append("slow")
+
+        async def dependent(_):
+            reached.append("dependent")
+
+        graph.add("upload", fail)
+        graph.add("search", slow)
+        graph.add("match", dependent, "upload")
+
+        with pytest.raises(RuntimeError):
+            await graph.run()
+        await asyncio.sleep(0)
+        assert graph.task("search").cancelled()
+        assert graph.task("match").done()
+        assert reached == []
+
+    asyncio.run(run())
+
+
+def test_cancelling_the_caller_cancels_every_stage():
+    async def run():
+        graph = StageGraph()
+
+        async def slow():
+            await asyncio.sleep(1)
+
+        graph.add("a", slow)
+        graph.add("b", slow, "a")
+        waiter = asyncio.create_task(graph.run())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await asyncio.sleep(0)
+        assert graph.task("a").cancelled()
+        assert graph.task("b").cancelled()
+
+    asyncio.run(run())
+
+
+def test_timings_aggregate_runs():
+    async def run():
+        timings = StageTimings()
+        for _ in range(2):
+            graph = StageGraph()
+
+            async def noop(*_):
+                return None
+
+            graph.add("query", noop)
+            graph.add("search", noop, "query")
+            await graph.run()
+            timings.record(graph)
+
+        stats = timings.stats()
+        assert stats["runs"] == 2
+        assert stats["stages"]["search"]["critical_path_ratio"] == 1.0
+        assert [row["stage"] for row in stats["last_timeline"]] == ["query", "search"]
+
+    asyncio.run(run())
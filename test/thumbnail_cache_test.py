@@ -0,0 +1,130 @@
+import asyncio
+import time
+
+import fakeredis
+import fakeredis.aioredis
+import numpy as np
+from redis.exceptions import ConnectionError
+
+from services.cache import RedisCache
+from services.thumbnail_cache import TILE_BYTES, TILE_SHAPE, CachedTile, ThumbnailCache
+
+
+def tile(value: int) -> np.ndarray:
+    return np.full(TILE_SHAPE, value, dtype=np.uint8)
+
+
+def redis_cache() -> RedisCache:
+    cache = RedisCache()
+    cache.binary = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer())
+    return cache
+
+
+class CountingRedis:
+    """Counts round trips to the wrapped RedisCache."""
+
+    def __init__(self, cache: RedisCache):
+        self.cache = cache
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.cache, name)
+
+        async def call(*args):
+            self.calls.append(name)
+            return await method(*args)
+        return call
+
+
+def test_tile_round_trips_with_validators():
+    entry = CachedTile(tile(3).tobytes(), etag='"abc"', last_modified='Mon', stored_at=12.0)
+    loaded = CachedTile.loads(entry.dumps())
+
+    assert (loaded.etag, loaded.last_modified, loaded.stored_at) == ('"abc"', 'Mon', 12.0)
+    assert (loaded.array() == 3).all()
+    assert CachedTile.loads(b'{}\n' + b'\0' * (TILE_BYTES - 1)) is None
+    assert CachedTile.loads(b'no header') is None
+
+
+def test_conditional_headers_and_freshness(monkeypatch):
+    monkeypatch.setenv('THUMBNAIL_CACHE_FRESH_SECONDS', '60')
+    cache = ThumbnailCache()
+    entry = CachedTile(tile(0).tobytes(), etag='"v1"', last_modified='Mon', stored_at=time.time())
+
+    assert cache.conditional_headers(None) == {}
+    assert cache.conditional_headers(entry) == {'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon'}
+    assert cache.is_fresh(entry)
+    entry.stored_at -= 61
+    assert not cache.is_fresh(entry)
+
+
+def test_memory_tier_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setenv('THUMBNAIL_CACHE_MAX_MB', str(2.5 * TILE_BYTES / 1024 / 1024))
+    monkeypatch.delenv('THUMBNAIL_CACHE_DIR', raising=False)
+    cache = ThumbnailCache()
+
+    async def run():
+        await cache.put_many([('a', tile(1), None, None), ('b', tile(2), None, None)])
+        await cache.get('a')
+        await cache.put('c', tile(3))
+        return await cache.get_many(['a', 'b', 'c'])
+
+    a, b, c = asyncio.run(run())
+    assert (a.array() == 1).all() and b is None and (c.array() == 3).all()
+    assert cache.evictions == 1
+    assert cache.stats()["memory_entries"] == 2
+
+
+def test_disk_and_redis_tiers_are_promoted(monkeypatch, tmp_path):
+    shared = redis_cache()
+
+    async def run():
+        monkeypatch.setenv('THUMBNAIL_CACHE_DIR', str(tmp_path))
+        writer = ThumbnailCache(shared)
+        await writer.put_many([(f'https://t/{i}', tile(i), None, None) for i in range(3)])
+
+        from_disk = ThumbnailCache(shared)
+        found = await from_disk.get_many(['https://t/0', 'https://t/1', 'https://t/x'])
+        assert [entry is not None for entry in found] == [True, True, False]
+        assert from_disk.tier_hits == {"memory": 0, "disk": 2, "redis": 0}
+
+        monkeypatch.delenv('THUMBNAIL_CACHE_DIR')
+        from_redis = ThumbnailCache(shared)
+        await from_redis.get_many(['https://t/0', 'https://t/2'])
+        await from_redis.get_many(['https://t/0', 'https://t/2'])
+        assert from_redis.tier_hits == {"memory": 2, "disk": 0, "redis": 2}
+        assert (from_redis._memory[from_redis.key('https://t/2')].array() == 2).all()
+
+    asyncio.run(run())
+
+
+def test_a_gallery_costs_one_redis_round_trip_each_way(monkeypatch):
+    monkeypatch.delenv('THUMBNAIL_CACHE_DIR', raising=False)
+    redis = CountingRedis(redis_cache())
+    urls = [f'https://t/{i}' for i in range(26)]
+
+    async def run():
+        await ThumbnailCache(redis).put_many([(url, tile(1), None, None) for url in urls])
+        found = await ThumbnailCache(redis).get_many(urls)
+        assert all(entry is not None for entry in found)
+
+    asyncio.run(run())
+    assert redis.calls == ['setex_many_bytes', 'mget_bytes']
+
+
+def test_redis_down_is_a_miss(monkeypatch):
+    monkeypatch.delenv('THUMBNAIL_CACHE_DIR', raising=False)
+    shared = redis_cache()
+
+    async def fail(*args, **kwargs):
+        raise ConnectionError("refused")
+    shared.binary.mget = fail
+
+    async def run():
+        cache = ThumbnailCache(shared)
+        assert await cache.get_many(['https://t/0', 'https://t/1']) == [None, None]
+        assert await cache.get('https://t/2') is None
+
+    asyncio.run(run())
+    # The second lookup skipped Redis instead of waiting on it again
+    assert (shared.errors, shared.skipped) == (1, 1)
@@ -0,0 +1,101 @@
+"""Worker process for searches queued with POST /jobs.
+
+Pulls jobs from the Redis queue and runs them through the same cache and
+pipeline as /search, with the same services. Start as many workers as
+needed, on any node that reaches the same Redis:
+
+    python worker.py --concurrency 4
+"""
+import argparse
+import asyncio
+import os
+import signal
+
+from fastapi import HTTPException
+from redis.exceptions import RedisError
+
+import main
+from models.search_models import SearchResult
+from services.job_queue import JobQueue
+
+POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '0.5'))
+REQUEUE_INTERVAL = float(os.getenv('JOB_REQUEUE_INTERVAL', '5'))
+
+
+async def keep_visible(queue: JobQueue, job_id: str):
+    while True:
+        await asyncio.sleep(queue.visibility_seconds / 3)
+        try:
+            await queue.heartbeat(job_id)
+        except (RedisError, OSError) as e:
+            print(f"Heartbeat for job {job_id} failed: {str(e)}")
+
+
+async def run_job(services: dict, queue: JobQueue, job_id: str, payload: dict):
+    heartbeat = asyncio.create_task(keep_visible(queue, job_id))
+    try:
+        result = await main.search_image(
+            services, payload["image_url"], None, payload.get("content_hash"), None)
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        print(f"Job {job_id} failed: {detail}")
+        await queue.fail(job_id, str(detail))
+        return
+    finally:
+        heartbeat.cancel()
+    await queue.complete(job_id, SearchResult(**result).model_dump())
+
+
+async def work(services: dict, queue: JobQueue, stopping: asyncio.Event):
+    while not stopping.is_set():
+        try:
+            claimed = await queue.claim()
+            if claimed is not None:
+                await run_job(services, queue, *claimed)
+                continue
+        except (RedisError, OSError) as e:
+            # The job, if any, becomes visible again once its deadline lapses
+            print(f"Job queue error: {str(e)}")
+        try:
+            await asyncio.wait_for(stopping.wait(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def requeue_expired(queue: JobQueue, stopping: asyncio.Event):
+    while not stopping.is_set():
+        try:
+            requeued = await queue.requeue_expired()
+            if requeued:
+                print(f"Requeued {requeued} jobs past their visibility timeout")
+        except (RedisError, OSError) as e:
+            print(f"Job queue error: {str(e)}")
+        try:
+            await asyncio.wait_for(stopping.wait(), REQUEUE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_worker(concurrency: int):
+    async with main.lifespan(main.app):
+        services = main.get_services()
+        queue = services["job_queue"]
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            # Finish the jobs in hand, then exit
+            loop.add_signal_handler(sig, stopping.set)
+
+        print(f"Worker {os.getpid()} started with {concurrency} concurrent jobs")
+        await asyncio.gather(
+            requeue_expired(queue, stopping),
+            *[work(services, queue, stopping) for _ in range(concurrency)])
+        print(f"Worker {os.getpid()} stopped")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int,
+                        default=int(os.getenv('JOB_WORKER_CONCURRENCY', '4')))
+    args = parser.parse_args()
+    asyncio.run(run_worker(args.concurrency))